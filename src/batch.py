@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from array import array
+from debug import debug
+from scheduler import Message
+from threading import Thread
+import time
+
+"""
+    Compact storage for big campaigns.
+
+    A MessageBatch keeps one row per recipient in flat columns instead of one
+    object per message:
+
+        numbers     array('L') (64 bit), the destination digits as an
+                    integer with a leading 1 so leading zeros survive
+        templates   array('H'), index in the shared list of texts
+        offsets     array('L'), end of the row variables in values
+        values      bytearray, row variables joined by SEPARATOR
+        status      bytearray, one status byte per row
+
+    About 20 bytes per row plus its variables, so ten million recipients take
+    a few hundred MB. Status scans and updates work on whole slices in C.
+
+    The Feeder hands rows to the scheduler as Messages a window at a time, so
+    only the messages about to be sent exist as objects.
+"""
+
+QUEUED, DISPATCHED, SENT, FAILED = 0, 1, 2, 3
+SEPARATOR = "\x1f"
+WINDOW = 1000
+POLL = .5
+
+
+def pack_number(number):
+    """
+    Destination as an integer, leading zeros included.
+    """
+
+    number = "%s" % number
+    if not number.isdigit() or len(number) > 18:
+        raise ValueError("Not a packable number: %r" % number)
+    return int("1" + number)
+
+
+def unpack_number(packed):
+    return str(packed)[1:]
+
+
+class MessageBatch(object):
+    def __init__(self, templates=(), lane=None, campaign=None):
+        """
+        :templates: texts with %s placeholders filled with the row variables.
+        """
+
+        self.templates = list(templates)
+        self.lane = lane
+        self.campaign = campaign
+        self.numbers = array("L")
+        self.template_ids = array("H")
+        self.offsets = array("L")
+        self.values = bytearray()
+        self.status = bytearray()
+
+
+    def __len__(self):
+        return len(self.numbers)
+
+
+    def add_template(self, text):
+        self.templates.append(text)
+        return len(self.templates) - 1
+
+
+    def append(self, number, template=0, variables=()):
+        """
+        Add a recipient, returns its row.
+        """
+
+        self.numbers.append(pack_number(number))
+        self.template_ids.append(template)
+        self.values += SEPARATOR.join(variables)
+        self.offsets.append(len(self.values))
+        self.status.append(QUEUED)
+        return len(self.numbers) - 1
+
+
+    def extend(self, rows, template=0):
+        """
+        Add (number, variables) rows sharing template.
+        """
+
+        start = len(self)
+        values = self.values
+        offsets = self.offsets
+        for number, variables in rows:
+            self.numbers.append(pack_number(number))
+            values += SEPARATOR.join(variables)
+            offsets.append(len(values))
+        added = len(self) - start
+        self.template_ids.extend(array("H", [template]) * added)
+        self.status.extend(bytearray([QUEUED]) * added)
+        return added
+
+
+    def number(self, row):
+        return unpack_number(self.numbers[row])
+
+
+    def variables(self, row):
+        start = self.offsets[row - 1] if row else 0
+        values = str(self.values[start:self.offsets[row]])
+        return tuple(values.split(SEPARATOR)) if values else ()
+
+
+    def text(self, row):
+        template = self.templates[self.template_ids[row]]
+        variables = self.variables(row)
+        return template % variables if variables else template
+
+
+    def find(self, status=QUEUED, start=0):
+        """
+        First row at or after start with status, -1 if none.
+        """
+
+        return self.status.find(chr(status), start)
+
+
+    def rows(self, status=QUEUED, start=0, stop=None):
+        """
+        Iterate the rows with status.
+        """
+
+        stop = len(self) if stop is None else stop
+        needle = chr(status)
+        row = self.status.find(needle, start, stop)
+        while row >= 0:
+            yield row
+            row = self.status.find(needle, row + 1, stop)
+
+
+    def count(self, status=QUEUED):
+        return self.status.count(chr(status))
+
+
+    def counts(self):
+        return dict((status, self.count(status)) for status in (QUEUED,
+            DISPATCHED, SENT, FAILED))
+
+
+    def mark(self, rows, status):
+        """
+        Set status on rows, an iterable of row numbers or a slice.
+        """
+
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(self))
+            self.status[rows] = bytearray([status]) * len(xrange(start, stop,
+                step))
+        else:
+            for row in rows:
+                self.status[row] = status
+
+
+    def replace(self, old, new, start=0, stop=None):
+        """
+        Change every old status to new in the range, like DISPATCHED back to
+        QUEUED after a restart.
+        """
+
+        stop = len(self) if stop is None else stop
+        self.status[start:stop] = self.status[start:stop].replace(chr(old),
+            chr(new))
+
+
+    def message(self, row, id=None):
+        """
+        The Message for row, to be sent through the scheduler.
+        """
+
+        message = Message(id if id is not None else row, self.number(row),
+            self.text(row), self.lane, campaign=self.campaign)
+        message.batch = self
+        message.row = row
+        return message
+
+
+    def done(self, message, result=None, error=None):
+        """
+        Scheduler callback for messages of this batch.
+        """
+
+        self.status[message.row] = SENT if error is None else FAILED
+
+
+class Feeder(Thread):
+    def __init__(self, scheduler, batch, window=WINDOW, poll=POLL):
+        """
+        Keeps up to window messages of batch queued in the scheduler, creating
+        them as the lane drains.
+        """
+
+        Thread.__init__(self, name="feeder-%s" % (batch.campaign or id(batch)))
+        self.daemon = True
+        self.scheduler = scheduler
+        self.batch = batch
+        self.window = window
+        self.poll = poll
+        # Set here, a stop before the thread runs must hold
+        self.running = True
+
+
+    def run(self):
+        batch = self.batch
+        lane = batch.lane or self.scheduler.lanes[-1]
+        row = 0
+        while self.running:
+            room = self.window - len(self.scheduler.queues[lane])
+            if room > 0:
+                rows = []
+                for row in batch.rows(QUEUED, row):
+                    rows.append(row)
+                    if len(rows) >= room:
+                        break
+                batch.mark(rows, DISPATCHED)
+                for row in rows:
+                    self.scheduler.put(batch.message(row))
+                if not rows and not batch.count(DISPATCHED):
+                    debug("Feeder: %s done, %r" % (self.name, batch.counts()))
+                    break
+            time.sleep(self.poll)
+
+
+    def stop(self):
+        self.running = False
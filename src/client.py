@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from threading import Thread
+import json
+import socket
+
+"""
+    Client side of the submission service, kept apart so command line tools
+    can talk to a running metaserver without importing the server side.
+"""
+
+SOCKET = "/tmp/smsd.sock"
+CHUNK = 1 << 16
+
+
+def submit(requests, path=SOCKET):
+    """
+    Client helper, sends requests (dicts) and returns the replies in order.
+    """
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+
+    def writer():
+        client.sendall("".join(json.dumps(request) + "\n"
+            for request in requests))
+        client.shutdown(socket.SHUT_WR)
+
+    # Replies are read while writing, big batches would fill both buffers
+    thread = Thread(target=writer)
+    thread.start()
+
+    data = []
+    while True:
+        chunk = client.recv(CHUNK)
+        if not chunk:
+            break
+        data.append(chunk)
+    thread.join()
+    client.close()
+
+    return [json.loads(line) for line in "".join(data).splitlines()]
@@ -1,15 +1,209 @@
 #!/usr/bin/env python
 #-*- coding: UTF-8 -*-
-import time
+from Queue import Queue, Full, Empty
+from threading import Thread, Lock, current_thread
+import atexit
+import json
 import sys
+import time
+
+"""
+    Logging for the whole project.
+
+    Calls only enqueue a tuple, formatting (repr, % interpolation, json) and
+    writing happen in a background thread. When the queue is full records are
+    dropped and counted instead of blocking the caller. Chatty per modem
+    output goes through sample(), which lets at most RATE records per second
+    and key through.
+"""
 
 INICIO = time.time()
 VERBOSE = 1
+DEBUG, INFO, WARNING, ERROR, CRITICAL = 10, 20, 30, 40, 50
+NAMES = {DEBUG: "D", INFO: "I", WARNING: "W", ERROR: "E", CRITICAL: "C"}
+LEVEL = DEBUG
+FORMAT = "text"
+QUEUE_SIZE = 10000
+RATE = 5
+BURST = 20
 
-def debug(*args):
-    if VERBOSE:
-        mensaje = " ".join((repr(e) for e in args))
+
+class Writer(Thread):
+    def __init__(self, outputs=None, size=QUEUE_SIZE):
+        """
+        :outputs: list of (file, minimum level).
+        """
+
+        Thread.__init__(self, name="debug-writer")
+        self.daemon = True
+        self.outputs = outputs or [(sys.stderr, DEBUG)]
+        self.queue = Queue(size)
+        self.dropped = 0
+        self.errors = 0
+
+
+    def put(self, record):
         try:
-            sys.stderr.write("%7.2f %s\n" % (time.time() - INICIO, mensaje.decode("latin-1")))
-        except:
-            pass
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self.write(record)
+            except Exception:
+                self.errors += 1
+            finally:
+                self.queue.task_done()
+
+            if self.queue.empty():
+                for file, level in self.outputs:
+                    try:
+                        file.flush()
+                    except (IOError, ValueError):
+                        self.errors += 1
+
+
+    def write(self, record):
+        line = format_record(record)
+        for file, level in self.outputs:
+            if record[1] >= level:
+                file.write(line)
+
+
+    def flush(self):
+        if self.is_alive():
+            self.queue.join()
+
+
+def format_record(record):
+    created, level, thread, message, args, fields = record
+    if message is None:
+        message = " ".join(repr(arg) for arg in args)
+    elif args:
+        message = message % args
+
+    if isinstance(message, str):
+        message = message.decode("latin-1")
+
+    if FORMAT == "json":
+        fields = dict(fields, time=created, level=NAMES.get(level, level),
+            thread=thread, message=message)
+        return json.dumps(fields) + "\n"
+
+    line = u"%7.2f %s" % (created - INICIO, message)
+    if fields:
+        line += u" " + u" ".join(u"%s=%r" % item
+            for item in sorted(fields.items()))
+    return (line + u"\n").encode("utf-8")
+
+
+_writer = None
+_writer_lock = Lock()
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = Writer()
+                _writer.start()
+                atexit.register(_writer.flush)
+    return _writer
+
+
+def set_outputs(outputs):
+    """
+    Replace the outputs, a list of (file, minimum level).
+    """
+
+    writer = get_writer()
+    writer.flush()
+    writer.outputs = outputs
+
+
+def set_level(level):
+    global LEVEL
+    LEVEL = level
+
+
+def enabled(level=DEBUG):
+    return level >= LEVEL and (VERBOSE or level > DEBUG)
+
+
+def log(level, message, *args, **fields):
+    """
+    Structured log call, message is %-interpolated with args in the writer
+    thread. fields are appended as key=value (or keys of the json record).
+    """
+
+    if enabled(level):
+        get_writer().put((time.time(), level, current_thread().name, message,
+            args, fields))
+
+
+def debug(*args):
+    if enabled(DEBUG):
+        get_writer().put((time.time(), DEBUG, current_thread().name, None,
+            args, {}))
+
+
+class Sampler(object):
+    def __init__(self, rate=RATE, burst=BURST):
+        """
+        Token bucket per key, rate records per second with bursts of burst.
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.suppressed = {}
+
+
+    def allow(self, key):
+        now = time.time()
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = tokens, now
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return False
+        self.buckets[key] = tokens - 1, now
+        return True
+
+
+_sampler = Sampler()
+
+
+def sample(key, message, *args, **fields):
+    """
+    Rate limited debug record for key (usually the modem).
+    """
+
+    if enabled(DEBUG) and _sampler.allow(key):
+        suppressed = _sampler.suppressed.pop(key, 0)
+        if suppressed:
+            fields["suppressed"] = suppressed
+        fields["key"] = key
+        log(DEBUG, message, *args, **fields)
+
+
+TIMINGS = []
+
+
+def mark(label, start=INICIO):
+    """
+    Record the time since start (by default since this module was imported)
+    for the startup timing report.
+    """
+
+    TIMINGS.append((label, time.time() - start))
+
+
+def report_timings(file=sys.stderr):
+    for label, elapsed in TIMINGS:
+        file.write("%-20s %7.1f ms\n" % (label, elapsed * 1000))
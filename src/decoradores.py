@@ -1,24 +1,59 @@
 #!/usr/bin/env python
 #-*- coding: UTF-8 -*-
-import pickle
 import sys
 import os
 import time
-import signal
-import inspect
 
-try:
-    from multiprocessing import Queue, Process
-    MP = True
-except ImportError:
-    MP = False
+# multiprocessing, inspect, ctypes, signal and pickle are imported where used,
+# they are most of the startup time of every script importing this module
 
-from debug import debug
+from debug import debug, enabled
 from functools import wraps
 from threading import Thread
 
 
 VERBOSE = False
+CLOCK_MONOTONIC = 1
+
+_clock = None
+
+
+def _get_clock_gettime():
+    import ctypes
+    import ctypes.util
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    for name in ("rt", "c"):
+        try:
+            library = ctypes.CDLL(ctypes.util.find_library(name) or None,
+                use_errno=True)
+            clock_gettime = library.clock_gettime
+        except (OSError, AttributeError):
+            continue
+
+        def monotonic():
+            timespec = Timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+                return time.time()
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+        return monotonic
+
+
+def monotonic():
+    """
+    Seconds from an unspecified point, never going backwards when the wall
+    clock is set. Falls back to time.time where clock_gettime is missing.
+    The clock is looked up on the first call, ctypes is slow to import.
+    """
+
+    global _clock
+    if _clock is None:
+        _clock = _get_clock_gettime() or time.time
+    return _clock()
+
 
 class Asyncobj(Thread):
     def __init__(self, func, *args, **kwargs):
@@ -61,6 +96,18 @@ class Async:
         return self.func.func_name
 
 
+def get_multiprocessing():
+    """
+    Returns (Queue, Process) or None where multiprocessing is missing.
+    """
+
+    try:
+        from multiprocessing import Queue, Process
+    except ImportError:
+        return None
+    return Queue, Process
+
+
 def nothreadsafe(func):
 
     def container(queue, *args, **kwargs):
@@ -68,6 +115,7 @@ def nothreadsafe(func):
 
     @wraps(func)
     def dfunc(*args, **kwargs):
+        Queue, Process = get_multiprocessing()
         queue = Queue()
 
         proc = Process(None, container, None, (queue,) + args, kwargs)
@@ -100,7 +148,9 @@ class TimeoutExc(Exception):
         self.value = value
 
 def mptimeout(timeout, func, *args, **kwargs):
+    import inspect
     assert inspect.isfunction(func) or inspect.ismethod(func)
+    Queue, Process = get_multiprocessing()
 
     @wraps(func)
     def newfunc(queue, args, kwargs):
@@ -124,6 +174,8 @@ def mptimeout(timeout, func, *args, **kwargs):
 #        return queue.get()
 
 def signaltimeout(timeout, func, *args, **kwargs):
+    import signal
+
     def handler(snum, frame):
         raise TimeoutExc
 
@@ -145,7 +197,7 @@ def Timeout(time, default=None):
         def decorated(*args, **kwargs):
 
             try:
-                if MP:
+                if get_multiprocessing():
                     return mptimeout(time, func, *args, **kwargs)
                 else:
                     return signaltimeout(time, func, *args, **kwargs)
@@ -181,6 +233,7 @@ class FunctionList(dict):
 
 class Cache:
     def __init__(self, limite=100 * 86400, ruta=None, flush_frequency=1):
+        import pickle
         self.count = 0
         self.limite = limite
         self.ruta = ruta
@@ -236,6 +289,7 @@ class Cache:
         return call
 
     def flush(self):
+        import pickle
 
         if self.ruta:
             try:
@@ -340,6 +394,10 @@ def Verbose(calling=1, returning=0):
         @wraps(func)
         def dfunc(*args, **kwargs):
 
+            # get_depth walks the stack, not worth it if nothing is logged
+            if not enabled():
+                return func(*args, **kwargs)
+
             if calling > 1:
                 debug("%s> %s(%s, %s)" % (" " * get_depth(), func.func_name,
                     args, kwargs))
@@ -349,6 +407,7 @@ def Verbose(calling=1, returning=0):
             result = func(*args, **kwargs)
 
             if returning > 2:
+                import inspect
                 debug('%s< %s, file "%s", line %s' % (" " * get_depth(),
                     func.func_name, relpath(inspect.getfile(func)),
                     inspect.getsourcelines(func)[-1]))
@@ -376,6 +435,7 @@ DeprecationWarning)
         @wraps(func)
         def dfunc(*args, **kwargs):
             if level > 0:
+                import inspect
                 debug(" W: Usind deprecated %s from %s" % (func.func_name,
                     inspect.getfile(func)))
 
@@ -1,16 +1,13 @@
 #!/usr/bin/python
 
-from dbus.mainloop.glib import DBusGMainLoop
-from debug import debug
+from debug import log, set_outputs, DEBUG, INFO, WARNING, ERROR, CRITICAL
 from decoradores import Verbose, get_depth
+from functools import partial
 import csv
-import dbus
-import gobject
-import logging
-import logging.handlers
 import optparse
 import os
 import shutil
+import sys
 import time
 
 
@@ -20,16 +17,50 @@ CONF_FILES = [os.path.expanduser("~/.%s" % APP_NAME),
 LOG_FILE = os.path.expanduser("~/.%s.log" % APP_NAME)
 DEV_CONF_PATH = "../configs"
 VERBOSE = 20
+COALESCE_MS = 500
+WAKE_MS = 500
+
+dbus = gobject = None
+
+
+def import_dbus():
+    """
+    dbus and gobject take most of the startup time, they are only imported
+    when a Monitor is created.
+    """
+
+    global dbus, gobject
+    if dbus is None:
+        import dbus.mainloop.glib
+        import gobject
+    return dbus, gobject
 
 
 class Monitor(object):
     def __init__(self, on_added_device_device=None,
-            on_removed_device_device=None):
+            on_removed_device_device=None, on_added_devices=None,
+            coalesce=COALESCE_MS):
+        """
+        Connects to HAL. Existing modems are enumerated from the main loop,
+        once it is running, so creating the Monitor is cheap.
+
+        Hot plug events are collected for coalesce milliseconds and handled
+        together, a hub reset ends up as one batch. The added modems of a
+        batch are given at once to on_added_devices, as a list of
+        (path, model), or one by one to on_added_device_device.
+        """
+
         dummy_func = lambda *args:args
         self.on_added_device_device = on_added_device_device or dummy_func
         self.on_removed_device_device = on_removed_device_device or  dummy_func
-
-        self.loop = DBusGMainLoop()
+        self.on_added_devices = on_added_devices or (lambda devices:
+            [self.on_added_device_device(*device) for device in devices])
+        self.coalesce = coalesce
+        self.events = {}
+        self.timer = None
+
+        import_dbus()
+        self.loop = dbus.mainloop.glib.DBusGMainLoop()
         self.system = dbus.SystemBus(mainloop=self.loop)
 
         hal_manager_proxy = self.system.get_object('org.freedesktop.Hal',
@@ -38,11 +69,11 @@ class Monitor(object):
             'org.freedesktop.Hal.Manager')
 
         # Connects the wrappers
-        self.system.add_signal_receiver(self.add_device, 'DeviceAdded',
+        self.system.add_signal_receiver(self.device_added, 'DeviceAdded',
             'org.freedesktop.Hal.Manager', 'org.freedesktop.Hal',
             '/org/freedesktop/Hal/Manager')
 
-        self.system.add_signal_receiver(self.remove_device,
+        self.system.add_signal_receiver(self.device_removed,
             'DeviceRemoved', 'org.freedesktop.Hal.Manager',
             'org.freedesktop.Hal', '/org/freedesktop/Hal/Manager')
 
@@ -50,10 +81,63 @@ class Monitor(object):
         self.models = dict(reader)
 
         self.modems = {}
+        gobject.idle_add(self.scan)
+        # Python signal handlers only run when the loop gets back to Python
+        gobject.timeout_add(WAKE_MS, lambda: True)
+        self.loop = gobject.MainLoop()
+
+
+    def scan(self):
+        """
+        Adds the modems already plugged in.
+        """
+
         for modem in self.get_all_modems():
-            self.add_device(modem)
+            self.events[modem] = "added"
+        return self.flush_events()
+
+
+    def device_added(self, udi):
+        self.queue_event(udi, "added")
+
+
+    def device_removed(self, udi):
+        self.queue_event(udi, "removed")
+
+
+    def queue_event(self, udi, event):
+        """
+        Keeps only the last event of each device until the window closes.
+        """
+
+        self.events[udi] = event
+        if self.timer is None:
+            self.timer = gobject.timeout_add(self.coalesce, self.flush_events)
 
-        self.loop = gobject.MainLoop()
+
+    def flush_events(self):
+        """
+        Handles the collected events, removals first.
+        """
+
+        events, self.events = self.events, {}
+        self.timer = None
+        debug("Handling %d device events" % len(events))
+
+        for udi, event in events.items():
+            if event == "removed" or udi in self.modems:
+                self.remove_device(udi)
+
+        added = []
+        for udi, event in events.items():
+            if event == "added":
+                modem = self.probe(udi)
+                if modem:
+                    added.append(modem)
+
+        if added:
+            self.on_added_devices(added)
+        return False
 
 
     def get_device(self, udi):
@@ -73,19 +157,25 @@ class Monitor(object):
             print("= %s, %s" % path_cset)
 
 
-    def add_device(self, udi):
+    def probe(self, udi):
+        """
+        Registers udi if it is a modem, returns its (path, model).
+        """
+
         cset = self.get_cset(udi)
 
         if cset:
 #            time.sleep(4) #HACK: sleep until the modem wake up.
             model = self.models[cset]
+            self.modems[udi] = self.get_path(udi), model
+            debug("+ %s, %s" % self.modems[udi])
+            return self.modems[udi]
 
-            if cset:
-                self.modems[udi] = self.get_path(udi), model
-                debug("+ %s, %s" % self.modems[udi])
-                return self.on_added_device_device(*self.modems[udi])
-            else:
-                return
+
+    def add_device(self, udi):
+        modem = self.probe(udi)
+        if modem:
+            return self.on_added_device_device(*modem)
 
 
     def remove_device(self, udi):
@@ -194,28 +284,20 @@ def main(options, args):
         return 0
 
 
+debug = ident(partial(log, DEBUG))
+moreinfo = ident(partial(log, INFO))
+info = ident(partial(log, WARNING)) # Default
+warning = ident(partial(log, ERROR))
+error = ident(partial(log, CRITICAL))
+
+
 if __name__ == "__main__":
     # == Reading the options of the execution ==
     options, args = get_options()
     VERBOSE = (options.quiet - options.verbose) * 10 + 30
 
-format = "%(asctime)s - %(message)s"
-logging.basicConfig(format=format, filename=LOG_FILE, level=0)
-logger = logging.getLogger()
-logger.handlers[0].setLevel(VERBOSE - 10)
+    set_outputs([(open(LOG_FILE, "a"), VERBOSE - 10), (sys.stderr, VERBOSE)])
 
-stderr = logging.StreamHandler()
-stderr.setLevel(VERBOSE)
-logger.addHandler(stderr)
-
-debug = ident(logger.debug)
-moreinfo = ident(logger.info)
-info = ident(logger.warning) # Default
-warning = ident(logger.error)
-error = ident(logger.critical)
-
-
-if __name__ == "__main__":
     debug("Verbose level: %s" % VERBOSE)
     debug("""Options: '%s', args: '%s'""" % (options, args))
 
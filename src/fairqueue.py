@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from collections import deque
+from ConfigParser import RawConfigParser, Error as ConfigError
+from debug import debug
+import os
+
+"""
+    Weighted fair sharing of the modems between campaigns.
+
+    Several customers' campaigns run together. A FairQueue holds one FIFO
+    per campaign and serves them by deficit round robin: when a campaign
+    gets its turn it is credited weight * QUANTUM messages, and it is served
+    until the credit runs out or its queue empties. Only campaigns with
+    queued messages are in the round, so the share of an idle campaign goes
+    to the others at once. Every put and take is O(1) whatever the number
+    of campaigns.
+
+    Weights come from campains/<name>/config.ini:
+
+        [campaign]
+        weight = 3
+
+    Campaigns without one, and messages without campaign, weigh 1.
+"""
+
+CAMPAIGNS = "../campains"
+CONFIG = "config.ini"
+SECTION = "campaign"
+WEIGHT = 1.
+QUANTUM = 4
+MIN_WEIGHT = 1. / QUANTUM
+SKIP = 16
+
+
+def load_shares(directory=CAMPAIGNS):
+    """
+    {campaign: weight} of the campaign directories that set a weight.
+    """
+
+    shares = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name, CONFIG)
+        if not os.path.isfile(path):
+            continue
+        parser = RawConfigParser()
+        try:
+            parser.read(path)
+            if parser.has_option(SECTION, "weight"):
+                shares[name] = max(MIN_WEIGHT, parser.getfloat(SECTION,
+                    "weight"))
+        except (ConfigError, ValueError), error:
+            debug("Campaign %s: %s" % (name, error))
+    return shares
+
+
+class Flow(deque):
+    __slots__ = ("campaign", "deficit", "active")
+
+    def __init__(self, campaign):
+        deque.__init__(self)
+        self.campaign = campaign
+        self.deficit = 0.
+        self.active = False
+
+
+class FairQueue(object):
+    def __init__(self, shares=None):
+        """
+        :shares: {campaign: weight}, read on every turn so it can be
+            updated in place.
+        """
+
+        self.shares = shares if shares is not None else {}
+        self.flows = {}
+        self.active = deque()
+        self.turn = None
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    def _flow(self, message):
+        flow = self.flows.get(message.campaign)
+        if flow is None:
+            flow = self.flows[message.campaign] = Flow(message.campaign)
+        if not flow.active:
+            flow.active = True
+            self.active.append(flow)
+        return flow
+
+
+    def append(self, message):
+        self._flow(message).append(message)
+        self.size += 1
+
+
+    def appendleft(self, message):
+        self._flow(message).appendleft(message)
+        self.size += 1
+
+
+    def head(self):
+        """
+        The message take would return to a worker excluded from none.
+        """
+
+        return self.active[0][0] if self.active else None
+
+
+    def take(self, worker=None):
+        """
+        Next message for worker, skipping those that failed on it. The
+        campaign on turn is searched first, then the following ones.
+        """
+
+        if not self.active:
+            return None
+
+        flow = self.active[0]
+        if flow is not self.turn:
+            # Its turn starts
+            flow.deficit += max(MIN_WEIGHT, self.shares.get(flow.campaign,
+                WEIGHT)) * QUANTUM
+            self.turn = flow
+
+        for index in xrange(min(SKIP, len(self.active))):
+            flow = self.active[index]
+            for position in xrange(min(SKIP, len(flow))):
+                excluded = flow[position].excluded
+                if not excluded or worker not in excluded:
+                    message = flow[position]
+                    del flow[position]
+                    self.charge(flow, index)
+                    return message
+
+
+    def charge(self, flow, index):
+        """
+        Account a message taken from the active flow at index.
+        """
+
+        self.size -= 1
+        flow.deficit -= 1
+        if not flow:
+            # Idle, it leaves the round and its credit
+            flow.active = False
+            flow.deficit = 0.
+            if index:
+                del self.active[index]
+            else:
+                self.active.popleft()
+                self.turn = None
+            del self.flows[flow.campaign]
+        elif index == 0 and flow.deficit < 1:
+            self.active.rotate(-1)
+            self.turn = None
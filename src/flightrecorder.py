@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from array import array
+from threading import Lock
+import json
+import optparse
+import os
+import sys
+import time
+
+"""
+    Flight recorder of a gnokii session.
+
+    Always on: every command written to the shell and every chunk read back
+    is copied into a ring preallocated per modem (CAPACITY bytes of data and
+    ENTRIES records of time, kind, position and length). Recording is a
+    slice assignment, nothing is formatted or written until a dump: on
+    timeouts, when the shell dies, when the circuit breaker trips, and on
+    request (smsd dump).
+
+    Dumps are json lines, {"time", "kind", "data"}, oldest first. Running
+    this module with -r dump is a fake gnokii shell that answers every
+    command with the output recorded after it, at the recorded pace, so the
+    failure can be reproduced with Gnokii(executable=[...]):
+
+        Gnokii(executable=["python", "flightrecorder.py", "-r", dump])
+"""
+
+CAPACITY = 64 * 1024
+ENTRIES = 1024
+DIRECTORY = "/tmp"
+KEEP = 20
+COMMAND, OUTPUT, EVENT = 0, 1, 2
+KINDS = ("command", "output", "event")
+PROMPT = "gnokii> "
+
+
+class FlightRecorder(object):
+    def __init__(self, name, capacity=CAPACITY, entries=ENTRIES,
+        directory=DIRECTORY, keep=KEEP):
+        """
+        :keep: dumps of this modem left in directory, older ones are
+            removed.
+        """
+
+        self.name = "%s" % name
+        self.directory = directory
+        self.keep = keep
+        self.prefix = "flight-%s-" % self.name.strip("/").replace("/", ".")
+        self.data = bytearray(capacity)
+        self.times = array("d", [0.]) * entries
+        self.kinds = bytearray(entries)
+        self.starts = array("L", [0]) * entries
+        self.lengths = array("L", [0]) * entries
+        self.written = 0
+        self.count = 0
+        self.lock = Lock()
+
+
+    def record(self, kind, data):
+        """
+        Append data, only its last capacity bytes if longer. Unicode is
+        recorded utf-8 encoded.
+        """
+
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        capacity = len(self.data)
+        data = data[-capacity:]
+        with self.lock:
+            index = self.count % len(self.kinds)
+            start = self.written % capacity
+            end = start + len(data)
+            if end <= capacity:
+                self.data[start:end] = data
+            else:
+                split = capacity - start
+                self.data[start:] = data[:split]
+                self.data[:end - capacity] = data[split:]
+            self.times[index] = time.time()
+            self.kinds[index] = kind
+            self.starts[index] = self.written
+            self.lengths[index] = len(data)
+            self.written += len(data)
+            self.count += 1
+
+
+    def entries(self):
+        """
+        (time, kind, data) of the records still in the ring, oldest first.
+        """
+
+        capacity = len(self.data)
+        with self.lock:
+            first = max(0, self.count - len(self.kinds))
+            records = []
+            for number in xrange(first, self.count):
+                index = number % len(self.kinds)
+                start, length = self.starts[index], self.lengths[index]
+                if start < self.written - capacity:
+                    # Its data was overwritten already
+                    continue
+                offset = start % capacity
+                if offset + length <= capacity:
+                    data = str(self.data[offset:offset + length])
+                else:
+                    data = str(self.data[offset:] + self.data[:offset +
+                        length - capacity])
+                records.append((self.times[index], self.kinds[index], data))
+        return records
+
+
+    def dump(self, reason="request", path=None):
+        """
+        Write the transcript to path (by default a new file in directory,
+        keeping only the last keep ones), returns the path.
+        """
+
+        self.record(EVENT, "dump: %s" % reason)
+        rotate = path is None
+        path = path or os.path.join(self.directory, "%s%d.jsonl" % (
+            self.prefix, time.time() * 1000))
+        with open(path, "w") as file:
+            for created, kind, data in self.entries():
+                file.write(json.dumps({"time": created, "kind": KINDS[kind],
+                    "data": data.decode("latin-1")}) + "\n")
+        if rotate:
+            self.rotate()
+        return path
+
+
+    def rotate(self):
+        """
+        Remove the oldest dumps of this modem beyond keep, so a flapping
+        modem can't fill the directory.
+        """
+
+        dumps = []
+        for name in os.listdir(self.directory):
+            stamp = name[len(self.prefix):-len(".jsonl")]
+            if name.startswith(self.prefix) and name.endswith(".jsonl") and (
+                stamp.isdigit()):
+                dumps.append((int(stamp), name))
+        for stamp, name in sorted(dumps)[:max(0, len(dumps) - self.keep)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+def load(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def read_until(fd, buffer, separator):
+    """
+    Read fd until separator, returns (chunk up to separator, rest). The
+    chunk is empty at end of file.
+    """
+
+    while separator not in buffer:
+        data = os.read(fd, 4096)
+        if not data:
+            return "", buffer
+        buffer += data
+    index = buffer.index(separator) + len(separator)
+    return buffer[:index], buffer[index:]
+
+
+def replay(records, input=0, output=sys.stdout):
+    """
+    Act as the gnokii shell of the transcript: for each command read from
+    the input fd, write the output recorded after the same command, keeping
+    the recorded delays. Commands not in the transcript get an empty answer.
+    """
+
+    position = 0
+    buffer = ""
+    output.write(PROMPT)
+    output.flush()
+    while True:
+        line, buffer = read_until(input, buffer, "\n")
+        if not line:
+            return 0
+        command = line.split(" ", 1)[0].strip()
+        if not command:
+            continue
+        if command == "--sendsms":
+            # The text follows up to the end of text mark
+            text, buffer = read_until(input, buffer, "\x03")
+            line += text
+
+        for index in xrange(position, len(records)):
+            record = records[index]
+            if record["kind"] == "command" and (record["data"].split(" ",
+                1)[0].strip() == command):
+                break
+        else:
+            output.write(line.split("\n")[0] + "\n" + PROMPT)
+            output.flush()
+            continue
+
+        last = record["time"]
+        position = index + 1
+        while position < len(records) and records[position]["kind"] != (
+            "command"):
+            record = records[position]
+            position += 1
+            if record["kind"] == "output":
+                time.sleep(max(0, record["time"] - last))
+                last = record["time"]
+                output.write(record["data"].encode("latin-1"))
+                output.flush()
+
+
+def get_options():
+    # Instance the parser and define the usage message
+    optparser = optparse.OptionParser(usage="""
+    %prog -r dump [--config file] [--phone name] [--shell]
+
+    Fake gnokii shell replaying a flight recorder dump.
+    """, version="%prog .1")
+
+    # Define the options and the actions of each one
+    optparser.add_option("-r", "--replay", dest="replay",
+        help="Flight recorder dump to replay")
+    optparser.add_option("--config", dest="config",
+        help="Ignored, accepted as gnokii does")
+    optparser.add_option("--phone", dest="phone",
+        help="Ignored, accepted as gnokii does")
+    optparser.add_option("--shell", action="store_true", dest="shell",
+        help="Ignored, accepted as gnokii does")
+
+    # Process the options
+    options, args = optparser.parse_args()
+    if not options.replay:
+        optparser.error("a dump to replay is needed")
+    return options, args
+
+
+def main(options, args):
+    return replay(load(options.replay))
+
+
+if __name__ == "__main__":
+    options, args = get_options()
+    exit(main(options, args))
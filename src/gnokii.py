@@ -1,21 +1,58 @@
 #!/usr/bin/env python
 #-*- coding: UTF-8 -*-
 
-from decoradores import Verbose, Timeout, debug
+from debug import sample
+from decoradores import Verbose, debug, monotonic
+from flightrecorder import FlightRecorder, COMMAND, OUTPUT, EVENT
+from mms import MMSParser
 from subprocess import Popen, PIPE, STDOUT
-from tempfile import mkstemp, mktemp
+from tempfile import mkdtemp
+from threading import Event, Thread, Lock
+from Queue import Queue
+import errno
 import fcntl
-import fileinput
 import os
 import re
+import select
+import shutil
 import sys
 import time
 
 EOF = "\n\03"
 EOL = "\n"
-READ_PAUSE = .2
+READ_SIZE = 4096
 READ_TIMEOUT = 5
+DRAIN_TIMEOUT = .5
+STREAM_POLL = .1
+TIMEOUTS = {
+    "--sendsms": 30,
+    "--savesms": 10,
+    "--getmms": 60,
+    "--getsms": 30,
+    "--deletesms": 30,
+    "--smsreader": 60,
+    "--monitor": 10,
+    "--netmonitor": 10,
+    "--reset": 30,
+    "--identify": 2,
+    "--version": 2,
+    "--help": 2,
+}
 RESULT_RE = r'(?ms).*?$\n(.*?)^gnokii>'
+COMMANDS = ("help", "version", "monitor", "getspeeddial", "setspeeddial",
+    "dialvoice", "senddtmf", "answercall", "hangup", "divert",
+    "getdisplaystatus", "displayoutput", "getprofile", "setprofile",
+    "getactiveprofile", "setactiveprofile", "netmonitor", "reset", "gettodo",
+    "writetodo", "deletealltodos", "getcalendarnote", "writecalendarnote",
+    "deletecalendarnote", "getsms", "deletesms", "sendsms", "savesms",
+    "getsmsc", "setsmsc", "createsmsfolder", "deletesmsfolder",
+    "getsmsfolderstatus", "smsreader", "getmms", "identify",
+    "entersecuritycode", "getsecuritycode", "getsecuritycodestatus",
+    "getlocksinfo")
+FIELD_RE = re.compile(r'^\s*([^:\n]+?)\s*:\s*(.*?)\s*$', re.M)
+SMSC_RE = re.compile(r'^(?:gnokii> )?(\d+);(.*)$', re.M)
+FIFO = object()
+CONTROL_RE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]|[^\x08\n]\x08|\x08')
 
 """
     Why use this module instead of smsd (http://wiki.gnokii.org/index.php/SMSD)?
@@ -24,8 +61,42 @@ RESULT_RE = r'(?ms).*?$\n(.*?)^gnokii>'
 """
 
 
+def parse_fields(output):
+    """
+    Parses "Key : value" lines, as printed by identify, into a dict.
+    """
+
+    return dict(FIELD_RE.findall(output))
+
+
+def parse_smsc(output):
+    """
+    Parses the lines of getsmsc --raw, "id;name;default name;format;validity;
+    smsc type;smsc number;recipient type;recipient number", into a list of
+    {"location", "name", "number"}. Locations without number are left out.
+    """
+
+    centers = []
+    for location, rest in SMSC_RE.findall(output):
+        fields = rest.split(";")
+        if len(fields) < 6 or not fields[5].strip():
+            continue
+        centers.append({"location": int(location), "name": fields[0],
+            "number": fields[5].strip()})
+    return centers
+
+
+class GnokiiTimeout(IOError):
+    def __init__(self, command, timeout, output=""):
+        IOError.__init__(self, "%s timed out after %ss" % (command, timeout))
+        self.command = command
+        self.timeout = timeout
+        self.output = output
+
+
 class Gnokii(object):
-    def __init__(self, config=None, phone=None):
+    def __init__(self, config=None, phone=None, timeouts=None,
+        executable=None):
         """
         Create a server interface:
 
@@ -33,9 +104,19 @@ class Gnokii(object):
             locations.
         :phone: phone section name of the config file to reads parameters.
             phone=foo reads the [phone_foo] section.
+        :timeouts: seconds allowed per command, e.g. {"--sendsms": 30},
+            overrides TIMEOUTS. Other commands get READ_TIMEOUT.
+        :executable: command line to run instead of the gnokii in the PATH,
+            like a flightrecorder replay.
         """
 
+        self.config = config
+        self.phone = phone
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        self.executable = executable
+        self.recorder = FlightRecorder(config or phone or "gnokii")
         self._proc = None
+        self._desync = False
 
 
 #    @Verbose(1, 1)
@@ -58,10 +139,20 @@ class Gnokii(object):
         """
 
         if not self.is_alive():
-            exepath = "".join(Popen(['which', 'gnokii'], 
-                stdout=PIPE).stdout.readlines()).strip()
-            self._proc = Popen([exepath, '--shell'], stdin=PIPE,
-                stdout=PIPE)
+            if self.executable:
+                exepath = list(self.executable)
+            else:
+                exepath = ["".join(Popen(['which', 'gnokii'],
+                    stdout=PIPE).stdout.readlines()).strip()]
+            options = []
+            if self.config:
+                options += ['--config', self.config]
+            if self.phone:
+                options += ['--phone', self.phone]
+            # A dumb terminal keeps readline from echoing control sequences
+            env = dict(os.environ, TERM="dumb")
+            self._proc = Popen(exepath + options + ['--shell'], stdin=PIPE,
+                stdout=PIPE, env=env)
 
             for file in (self._proc.stdout, self._proc.stdout):
                 flags = fcntl.fcntl(file, fcntl.F_GETFL)
@@ -86,6 +177,28 @@ class Gnokii(object):
             return False
 
 
+    def adopt(self, proc):
+        """
+        Use a running gnokii shell, a Popen like object, see handover.
+        """
+
+        self._proc = proc
+        flags = fcntl.fcntl(proc.stdout, fcntl.F_GETFL)
+        fcntl.fcntl(proc.stdout, fcntl.F_SETFL, flags|os.O_NONBLOCK)
+        return self.is_alive()
+
+
+    def detach(self):
+        """
+        Forget the gnokii shell without stopping it, returns its Popen (keep
+        it referenced while its pipes are in use) for another process to
+        adopt.
+        """
+
+        proc, self._proc = self._proc, None
+        return proc
+
+
     def restart(self):
         """
         Start or restart the server, returns True if successful.
@@ -105,54 +218,117 @@ class Gnokii(object):
 
 
     @Verbose(1, 1)
-    def send(self, command, *args):
+    def send(self, command, *args, **kwargs):
         """
         Sends string to the server. This is a low level tool, try yo use the 
         specific method insteat.
+
+        :timeout: seconds allowed for the command, by default the one
+            configured for it. Raises GnokiiTimeout when exceeded.
         """
 
         if self.is_alive():
-            command = " ".join([command] + list(args))
-            debug(command)
-
-            self._proc.stdin.write(command)
-            return self.get_result()
+            timeout = kwargs.get("timeout") or self.timeouts.get(command,
+                READ_TIMEOUT)
+            if self._desync:
+                self.resync()
+
+            line = " ".join([command] + ["%s" % arg for arg in args])
+            if isinstance(line, unicode):
+                line = line.encode("utf-8")
+            debug(line)
+
+            self._proc.stdin.write(line)
+            self.recorder.record(COMMAND, line)
+            try:
+                return self.get_result(timeout)
+            except GnokiiTimeout, error:
+                self._desync = True
+                self.recorder.record(EVENT, "timeout after %ss" % timeout)
+                self.recorder.dump("timeout")
+                raise GnokiiTimeout(command, timeout, error.output)
+            except IOError, error:
+                self.recorder.record(EVENT, "%s" % error)
+                self.recorder.dump("crash")
+                raise
 
         else:
             raise IOError("Server is not alive")
 
 
     @Verbose(1, 1)
-    def get_result(self):
+    def get_result(self, timeout=READ_TIMEOUT):
         """
-        Read and parse the server output.
+        Read and parse the server output, waiting at most timeout seconds for
+        the prompt.
         """
 
-        lasttime = time.time()
+        deadline = monotonic() + timeout
+        fd = self._proc.stdout.fileno()
         result = None
         output = ""
-        while not result and self.is_alive():
-            if READ_TIMEOUT < (time.time() - lasttime):
+        while not result:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
                 debug("TIMEOUT")
-                break
+                raise GnokiiTimeout("read", timeout, output)
 
             try:
-                new = self._proc.stdout.read()
-            except IOError, e:
-                debug("Waiting stdout")
-                if e.errno != 11:
-                    raise
-                else:
-                    time.sleep(READ_PAUSE)
-            else:
-                debug("Added to output: %s" % new)
-                output += new
-                lasttime = time.time()
+                ready = select.select([fd], [], [], remaining)[0]
+            except select.error, error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
 
+            if not ready:
+                continue
+
+            try:
+                new = os.read(fd, READ_SIZE)
+            except OSError, error:
+                if error.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+
+            if not new:
+                raise IOError("Server closed its output")
+
+            self.recorder.record(OUTPUT, new)
+            sample(self.config, "Added to output: %r", new)
+            output += new
             result = re.match(RESULT_RE, output)
 
-        output = result.group(1) if result else output
-        return output
+        output = result.group(1)
+        return CONTROL_RE.sub("", output)
+
+
+    def resync(self):
+        """
+        Discards the output left by a timed out command, restarting the server
+        if it does not get back to the prompt.
+        """
+
+        try:
+            self.get_result(DRAIN_TIMEOUT)
+        except (GnokiiTimeout, IOError):
+            debug("Resync failed, restarting")
+            self.recorder.record(EVENT, "resync failed, restarting")
+            self.restart()
+        self._desync = False
+
+
+    def command(self, name, *args):
+        """
+        Run a command by name, as typed in the gnokii shell. Uses the
+        specific method when there is one, raw send otherwise.
+        """
+
+        name = name.lstrip("-")
+        method = getattr(self, name, None)
+        if name in COMMANDS and method:
+            return method(*args)
+        else:
+            return self.send("--%s" % name, *(args + (EOL,)))
 
 
     def help(self, section=""):
@@ -410,8 +586,8 @@ class Gnokii(object):
 
         delete = "--delete" if delete else ""
 
-        return self.send("--deletecalendarnote", memory_type, start, end, mode,
-            file, EOL)
+        return self.send("--getsms", memory_type, start, end, mode, file,
+            delete, EOL)
 
 
     def deletesms(self, memory_type, start, end=""):
@@ -549,6 +725,97 @@ class Gnokii(object):
         return self.send('--smsreader', EOL)
 
 
+    def stream(self, command, *args):
+        """
+        Runs a command that writes to a file, given as FIFO in args, and
+        yields what gnokii writes as it arrives. A named pipe stands for the
+        file so nothing is stored on disk, and it is always removed.
+
+        The pipe is read without blocking until the command returned, so a
+        command failing before gnokii opens it (or never opening it) can't
+        leave the reader waiting.
+        """
+
+        directory = mkdtemp(".smsd")
+        path = os.path.join(directory, "output")
+        os.mkfifo(path, 0600)
+        args = [path if arg is FIFO else arg for arg in args]
+        outcome = []
+        done = Event()
+
+        def run():
+            try:
+                outcome.append(self.send(command, *args))
+            except (IOError, OSError), error:
+                outcome.append(error)
+            done.set()
+
+        sender = Thread(target=run)
+        sender.daemon = True
+        sender.start()
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                while True:
+                    data = None
+                    if select.select([fd], [], [], STREAM_POLL)[0]:
+                        try:
+                            data = os.read(fd, READ_SIZE)
+                        except OSError, error:
+                            if error.errno not in (errno.EAGAIN, errno.EINTR):
+                                raise
+                    if data:
+                        yield data
+                    elif done.is_set():
+                        break
+                    elif data == "":
+                        # No writer yet, or gnokii closed it and is about to
+                        # answer
+                        done.wait(STREAM_POLL)
+            finally:
+                os.close(fd)
+
+            sender.join()
+            if outcome and isinstance(outcome[0], Exception):
+                raise outcome[0]
+            debug(outcome)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+    def iter_mms(self, memory_type, start, end='', format="pdu"):
+        """
+        Gets MMS messages like getmms but yields their parts, as
+        (content_type, name, data), while gnokii is still reading them. Only
+        the pdu format is split in parts, the others come as a single one.
+        """
+
+        if format == "pdu":
+            parser = MMSParser()
+            for chunk in self.stream('--getmms', memory_type, start, end,
+                '--pdu', FIFO, '--overwrite', EOL):
+                for part in parser.feed(chunk):
+                    yield part
+            for part in parser.close():
+                yield part
+        else:
+            content_type = "text/plain" if format == "human" else (
+                "application/octet-stream")
+            yield content_type, None, self.getmms(memory_type, start, end,
+                format)
+
+
+    def iter_mms_range(self, memory_type, start, end, format="pdu"):
+        """
+        Bulk retrieval of the slots start to end in this same session, yields
+        (location, part) tuples.
+        """
+
+        for location in xrange(int(start), int(end) + 1):
+            for part in self.iter_mms(memory_type, location, '', format):
+                yield location, part
+
+
     def getmms(self, memory_type, start, end='', format="human"):
         """
         Gets MMS messages from specified  memory  type  starting  at  entry
@@ -558,17 +825,14 @@ class Gnokii(object):
             (binary as received by the phone or "raw" (as read from the phone).
         """
 
-        file = mktemp(".smsd")
-
-        if format != "human":
+        if format == "human":
+            format = ""
+        else:
             assert format in ("pdu", "raw")
             format = "--%s" % format
 
-        result = self.send('--getmms', memory_type, start, end, format, file,
-            '--overwrite', EOL)
-        debug(result)
-
-        return open(file).read()
+        return "".join(self.stream('--getmms', memory_type, start, end, format,
+            FIFO, '--overwrite', EOL))
 
 
     @Verbose(1, 1)
@@ -619,18 +883,131 @@ class Gnokii(object):
 
 
 
-def main():
-    gnokii = Gnokii()
-    gnokii.start()
-    input = fileinput.input()
+class Pipeline(Thread):
+    def __init__(self, name, gnokii, output):
+        """
+        Runs the commands queued for one modem, in order, writing each result
+        as a JSON line to output.
+        """
+
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.gnokii = gnokii
+        self.output = output
+        self.queue = Queue()
+
 
-    line = True
-    while line:
-        line = input.readline()
-        if line:
-            words = line.split()
-#            print(gnokii.command(words[0], *words[1:]))
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            lineno, words = job
+            record = {"modem": self.name, "line": lineno, "command": words[0],
+                "args": words[1:]}
+            start = time.time()
+            try:
+                record["result"] = self.gnokii.command(*words)
+            except Exception, error:
+                # One bad line must not stop the commands after it
+                record["error"] = "%s: %s" % (type(error).__name__, error)
+            record["elapsed"] = round(time.time() - start, 3)
+            self.output(record)
+
+
+def get_options():
+    import optparse
+
+    # Instance the parser and define the usage message
+    optparser = optparse.OptionParser(usage="""
+    %prog [-c config]... [file]...
+
+    Reads commands, one per line, from the files or stdin and runs them
+    against every modem, or only against the ones named with a leading
+    @name[,name...]. Results are written as JSON lines.
+
+        @ttyUSB0 identify
+        deletesms SM 1 end
+    """, version="%prog .1")
+
+    # Define the options and the actions of each one
+    optparser.add_option("-c", "--config", action="append", dest="configs",
+        help="gnokii config file of a modem, can be repeated")
+
+    # Define the default options
+    optparser.set_defaults(configs=[])
+
+    # Process the options
+    return optparser.parse_args()
+
+
+def get_modem_name(config):
+    name = os.path.basename(config)
+    if name.startswith("gnokii.") and name.endswith(".conf"):
+        name = name[len("gnokii."):-len(".conf")].split(".")[-1]
+    return name
+
+
+def dispatch(lines, pipelines, output):
+    """
+    Queue the commands of lines to their pipelines, {name: Pipeline}.
+    Lines that can't be parsed or name unknown modems are answered with an
+    error record.
+    """
+
+    import shlex
+
+    for lineno, line in enumerate(lines, 1):
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError, error:
+            output({"modem": None, "line": lineno, "error": "%s: %s" % (
+                type(error).__name__, error)})
+            continue
+        if not words:
+            continue
+
+        names = pipelines.keys()
+        if words[0].startswith("@"):
+            names = words.pop(0)[1:].split(",")
+
+        for name in names:
+            if name not in pipelines:
+                output({"modem": name, "line": lineno, "error": "Unknown modem"})
+            elif words:
+                pipelines[name].queue.put((lineno, words))
+
+
+def main(options, args):
+    import fileinput
+    import json
+
+    lock = Lock()
+    def output(record):
+        line = json.dumps(record)
+        with lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    pipelines = {}
+    for config in options.configs or [None]:
+        name = get_modem_name(config) if config else "default"
+        gnokii = Gnokii(config)
+        gnokii.start()
+        pipelines[name] = Pipeline(name, gnokii, output)
+        pipelines[name].start()
+
+    dispatch(fileinput.input(args), pipelines, output)
+    for pipeline in pipelines.values():
+        pipeline.queue.put(None)
+    for pipeline in pipelines.values():
+        pipeline.join()
+        pipeline.gnokii.stop()
+
+    return 0
 
 
 if __name__ == "__main__":
-    exit(main())
+    options, args = get_options()
+    exit(main(options, args))
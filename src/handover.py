@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from debug import debug
+from threading import Thread
+import json
+import os
+import signal
+import socket
+import struct
+import time
+
+"""
+    Hand the running gnokii sessions over to a new metaserver.
+
+    The running master listens on HANDOVER. A new master started with
+    --takeover connects to it. The old master stops accepting submissions
+    and lets every worker finish the message in flight. It then closes the
+    spool and sends, per modem, a json header (device, profile, gnokii pid
+    and config) followed by the stdin and stdout pipes of its gnokii shell
+    (SCM_RIGHTS, see multiprocessing.reduction). Finally it exits without
+    stopping the shells. The new master adopts the pipes and recovers the
+    pending messages from the spool, so no modem has to be initialised
+    again and nothing queued is lost.
+"""
+
+HANDOVER = "/tmp/smsd.handover"
+REQUEST = "TAKEOVER\n"
+LENGTH = struct.Struct("!I")
+TIMEOUT = 60.
+POLL = .05
+
+
+class Adopted(object):
+    def __init__(self, pid, stdin, stdout):
+        """
+        Popen lookalike for a gnokii shell started by another process, so it
+        can't be waited for: liveness is checked with signal 0.
+        """
+
+        self.pid = pid
+        self.stdin = os.fdopen(stdin, "w", 0)
+        self.stdout = os.fdopen(stdout, "r", 0)
+        self.returncode = None
+
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except OSError:
+                self.returncode = -1
+        return self.returncode
+
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+    def wait(self, timeout=5.):
+        deadline = time.time() + timeout
+        while self.poll() is None and time.time() < deadline:
+            time.sleep(POLL)
+        return self.returncode
+
+
+def send_frame(connection, data):
+    connection.sendall(LENGTH.pack(len(data)) + data)
+
+
+def receive_exactly(connection, size):
+    data = ""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            raise IOError("Handover connection closed")
+        data += chunk
+    return data
+
+
+def receive_frame(connection):
+    size, = LENGTH.unpack(receive_exactly(connection, LENGTH.size))
+    return receive_exactly(connection, size)
+
+
+def send_modems(connection, modems):
+    """
+    Send (header, stdin fd, stdout fd) tuples, header being a dict.
+    """
+
+    from multiprocessing.reduction import send_handle
+    send_frame(connection, json.dumps({"modems": len(modems)}))
+    for header, stdin, stdout in modems:
+        send_frame(connection, json.dumps(header))
+        send_handle(connection, stdin, None)
+        send_handle(connection, stdout, None)
+
+
+def take_over(path=HANDOVER, timeout=TIMEOUT):
+    """
+    Ask the master listening on path for its modems, returns a list of
+    (header, Adopted).
+    """
+
+    from multiprocessing.reduction import recv_handle
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    connection.connect(path)
+    # Descriptors are received with a plain recvmsg, it needs blocking mode
+    connection.settimeout(None)
+    try:
+        connection.sendall(REQUEST)
+        count = json.loads(receive_frame(connection))["modems"]
+        modems = []
+        for index in xrange(count):
+            header = json.loads(receive_frame(connection))
+            stdin = recv_handle(connection)
+            stdout = recv_handle(connection)
+            modems.append((header, Adopted(header["pid"], stdin, stdout)))
+    finally:
+        connection.close()
+    debug("Handover: %d modems taken over" % len(modems))
+    return modems
+
+
+class Listener(Thread):
+    def __init__(self, hand_over, path=HANDOVER):
+        """
+        Waits for a new master on path and calls hand_over(connection) for
+        it. hand_over is expected to end this process.
+        """
+
+        Thread.__init__(self, name="handover")
+        self.daemon = True
+        self.hand_over = hand_over
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(1)
+
+
+    def run(self):
+        while True:
+            connection, address = self.socket.accept()
+            try:
+                if receive_exactly(connection, len(REQUEST)) == REQUEST:
+                    break
+            except (IOError, socket.error), error:
+                debug("Handover: bad request, %s" % error)
+            connection.close()
+
+        self.socket.close()
+        os.remove(self.path)
+        try:
+            self.hand_over(connection)
+        except (IOError, OSError, socket.error), error:
+            debug("Handover failed: %s" % error)
+        finally:
+            connection.close()
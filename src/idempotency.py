@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from collections import deque
+from debug import debug
+from threading import RLock
+import hashlib
+import os
+import time
+
+"""
+    Idempotency keys of the submissions.
+
+    A client may send a "key" with each message. The first submission with
+    a key is queued, later ones within TTL seconds get the id of the first
+    back, marked duplicate, and nothing is sent again.
+
+    Keys are kept as the first DIGEST bits of their sha1, a machine int,
+    mapped to the message id and creation time, in GENERATIONS dicts of TTL / GENERATIONS
+    seconds each. Lookups go through the generations and inserts go to the
+    newest one. Expiring drops the oldest dict whole, so memory is bounded
+    by the traffic of TTL seconds and every operation is O(1).
+
+    The index is an append only file of "digest id time" lines, fsynced
+    once per submitted chunk. It is rewritten with only the live entries on
+    load when most of it has expired.
+"""
+
+TTL = 2 * 86400.
+GENERATIONS = 48
+DIGEST = 60
+
+
+def digest(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return int(hashlib.sha1("%s" % key).hexdigest()[:DIGEST // 4], 16)
+
+
+class IdempotencyIndex(object):
+    def __init__(self, path=None, ttl=TTL, generations=GENERATIONS):
+        """
+        :path: file the index is persisted to, in memory only if None.
+        :ttl: seconds a key is remembered.
+        :generations: dicts the ttl is split in.
+        """
+
+        self.path = path
+        self.ttl = ttl
+        self.span = ttl / generations
+        self.generations = deque()
+        self.lock = RLock()
+        self.lines = 0
+        self.fd = None
+        if path:
+            self.load()
+            self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0644)
+
+
+    def __len__(self):
+        return sum(len(entries) for start, entries in self.generations)
+
+
+    def expire(self, now=None):
+        oldest = (now or time.time()) - self.ttl
+        while self.generations and (self.generations[0][0] + self.span <=
+            oldest):
+            self.generations.popleft()
+
+
+    def get(self, key):
+        """
+        Id of the message submitted with key, None if unknown or expired.
+        """
+
+        hashed = digest(key)
+        with self.lock:
+            for start, entries in reversed(self.generations):
+                if hashed in entries:
+                    return entries[hashed][0]
+        return None
+
+
+    def _add(self, hashed, id, created):
+        generations = self.generations
+        if not generations or created >= generations[-1][0] + self.span:
+            generations.append((created, {}))
+        elif created < generations[0][0]:
+            generations.appendleft((created, {}))
+        # The newest one but for restored entries
+        for start, entries in reversed(generations):
+            if start <= created:
+                entries[hashed] = id, created
+                return
+
+
+    def record(self, pairs):
+        """
+        Remember the (key, id) pairs and write them durably.
+        """
+
+        now = time.time()
+        self.restore((key, id, now) for key, id in pairs)
+
+
+    def restore(self, entries):
+        """
+        Remember the (key, id, created) entries, keys first submitted at
+        created, and write them durably. Those already expired are skipped.
+        """
+
+        now = time.time()
+        oldest = now - self.ttl
+        lines = []
+        with self.lock:
+            self.expire(now)
+            for key, id, created in entries:
+                if created <= oldest:
+                    continue
+                hashed = digest(key)
+                self._add(hashed, id, created)
+                if self.fd is not None:
+                    lines.append("%x %d %d\n" % (hashed, id, created))
+            if lines:
+                os.write(self.fd, "".join(lines))
+                os.fsync(self.fd)
+                self.lines += len(lines)
+
+
+    def load(self):
+        """
+        Read the live entries of the file, compacting it when mostly expired.
+        """
+
+        if not os.path.exists(self.path):
+            return
+
+        oldest = time.time() - self.ttl
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    hashed, id, created = line.split()
+                    hashed, id, created = int(hashed, 16), int(id), int(
+                        created)
+                except (ValueError, TypeError):
+                    debug("Idempotency: skipping truncated line")
+                    continue
+                self.lines += 1
+                if created > oldest:
+                    self._add(hashed, id, created)
+
+        debug("Idempotency: %d keys of %d lines" % (len(self), self.lines))
+        if self.lines > 2 * len(self):
+            self.compact()
+
+
+    def compact(self):
+        with self.lock:
+            tmp = "%s.tmp" % self.path
+            with open(tmp, "w") as file:
+                for start, entries in self.generations:
+                    file.writelines("%x %d %d\n" % (hashed, id, created)
+                        for hashed, (id, created) in entries.iteritems())
+                file.flush()
+                os.fsync(file.fileno())
+            os.rename(tmp, self.path)
+            self.lines = len(self)
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from Queue import Queue, Full
+from collections import OrderedDict, deque
+from debug import debug
+from routing import normalize
+from threading import Lock, Thread
+import csv
+import itertools
+import json
+import re
+import time
+import unicodedata
+import urllib2
+
+"""
+    Inbound messages: keyword routing and auto responses.
+
+    The keywords of every rule are compiled into one Aho-Corasick automaton,
+    so matching a message costs one pass over its text whatever the number
+    of rules. Rules are csv rows:
+
+        "keyword","action","argument"[,"anchored"]
+
+    with the actions:
+
+        suppress    add the sender to the suppression list, no more sends
+        reply       auto reply argument through the first free modem
+        webhook     POST the message as json to the url argument
+
+    A keyword only matches whole words, anchored ones only as the first word.
+    When several rules match, the first one in the file wins.
+
+    Long replies arrive in parts, each in its own SIM slot. A Reassembler
+    per modem buffers the parts by sender, reference and part count and
+    hands on whole messages. Sets still incomplete after REASSEMBLY_TIMEOUT
+    seconds, or the oldest ones when the buffered text exceeds
+    REASSEMBLY_BUDGET bytes, are handed on as they are, flagged incomplete.
+    The slots of the parts handed on are deleted in ranges afterwards, the
+    ones still buffered stay in the SIM so a restart loses nothing.
+"""
+
+RULES = "keywords.csv"
+SUPPRESSION = "suppression.txt"
+ACTIONS = ("suppress", "reply", "webhook")
+WEBHOOK_TIMEOUT = 5
+WEBHOOK_QUEUE = 1000
+REASSEMBLY_BUDGET = 64 * 1024
+REASSEMBLY_TIMEOUT = 900.
+HEADER_RE = re.compile(r"^(\d+)\. (.+?) Message \((.+?)\)\s*$", re.M)
+SENDER_RE = re.compile(r"^Sender:\s*(\S+)(?:\s+Msg Center:\s*(\S+))?", re.M)
+DATE_RE = re.compile(r"^Date/time:\s*(.+?)\s*$", re.M)
+LINKED_RE = re.compile(r"^Linked \((\d+)/(\d+)\)(?:, reference (\d+))?",
+    re.M)
+
+
+def parse_sms(output):
+    """
+    Messages printed by getsms as dicts with location, folder, status, date,
+    sender, smsc and text (and part, parts and reference, when printed, for
+    linked messages).
+    """
+
+    messages = []
+    headers = list(HEADER_RE.finditer(output))
+    for index, header in enumerate(headers):
+        end = headers[index + 1].start() if index + 1 < len(headers) else (
+            len(output))
+        body = output[header.end():end]
+        message = {"location": int(header.group(1)), "folder":
+            header.group(2), "status": header.group(3)}
+
+        sender = SENDER_RE.search(body)
+        if sender:
+            message["sender"], message["smsc"] = sender.groups()
+        date = DATE_RE.search(body)
+        if date:
+            message["date"] = date.group(1)
+        linked = LINKED_RE.search(body)
+        if linked:
+            part, parts, reference = linked.groups()
+            message["part"], message["parts"] = int(part), int(parts)
+            message["reference"] = reference and int(reference)
+
+        text = body.split("\nText:\n", 1)
+        message["text"] = text[1].rstrip("\n") if len(text) > 1 else ""
+        messages.append(message)
+    return messages
+
+
+def ranges(locations):
+    """
+    Sorted locations as (start, end) runs of consecutive numbers.
+    """
+
+    runs = []
+    for location in sorted(locations):
+        if runs and runs[-1][1] == location - 1:
+            runs[-1][1] = location
+        else:
+            runs.append([location, location])
+    return [tuple(run) for run in runs]
+
+
+class PartSet(object):
+    __slots__ = ("serial", "key", "parts", "size", "created")
+
+    def __init__(self, serial, key, created):
+        self.serial = serial
+        self.key = key
+        self.parts = {}
+        self.size = 0
+        self.created = created
+
+
+class Reassembler(object):
+    def __init__(self, budget=REASSEMBLY_BUDGET, timeout=REASSEMBLY_TIMEOUT):
+        """
+        Joins the linked parts read from one modem.
+
+        :budget: bytes of buffered text, the oldest sets go first beyond it.
+        :timeout: seconds an incomplete set is waited for.
+        """
+
+        self.budget = budget
+        self.timeout = timeout
+        self.sets = OrderedDict()
+        self.open = {}
+        self.size = 0
+        self.seen = set()
+        self.consumed = set()
+        self._serials = itertools.count()
+
+
+    def __len__(self):
+        return len(self.sets)
+
+
+    def feed(self, messages, now=None):
+        """
+        Take parse_sms messages, returns the whole (or given up) ones. The
+        slots read before are skipped, their locations wait in consumed
+        until deleted.
+        """
+
+        now = now or time.time()
+        ready = []
+        for message in messages:
+            location = message["location"]
+            if location in self.seen:
+                continue
+            self.seen.add(location)
+            if message.get("parts", 1) <= 1:
+                self.consumed.add(location)
+                ready.append(message)
+                continue
+
+            partset = self.place(message, now)
+            partset.parts[message["part"]] = message
+            partset.size += len(message["text"])
+            self.size += len(message["text"])
+            if len(partset.parts) == message["parts"]:
+                ready.append(self.join(partset))
+
+        for partset in self.sets.values():
+            if now - partset.created < self.timeout and (self.size <=
+                self.budget):
+                break
+            debug("Reassembler: giving up %s, %d of %d parts" % (
+                partset.key[0], len(partset.parts), partset.key[2]))
+            ready.append(self.join(partset))
+        return ready
+
+
+    def place(self, message, now):
+        """
+        The set missing this part among the open ones of its sender,
+        reference and part count, a new one if none is.
+        """
+
+        key = (message.get("sender"), message.get("reference"),
+            message["parts"])
+        serials = self.open.setdefault(key, [])
+        for serial in serials:
+            if message["part"] not in self.sets[serial].parts:
+                return self.sets[serial]
+        serial = self._serials.next()
+        serials.append(serial)
+        partset = self.sets[serial] = PartSet(serial, key, now)
+        return partset
+
+
+    def join(self, partset):
+        """
+        Close partset, returns its parts as one message.
+        """
+
+        del self.sets[partset.serial]
+        serials = self.open[partset.key]
+        serials.remove(partset.serial)
+        if not serials:
+            del self.open[partset.key]
+        self.size -= partset.size
+
+        parts = [partset.parts[number] for number in sorted(partset.parts)]
+        message = dict(parts[0], text="".join(part["text"] for part in parts),
+            locations=[part["location"] for part in parts])
+        message.pop("part", None)
+        if len(parts) < partset.key[2]:
+            message["incomplete"] = True
+        self.consumed.update(message["locations"])
+        return message
+
+
+    def deleted(self, locations):
+        """
+        Forget the slots deleted from the modem, they can be reused.
+        """
+
+        self.consumed.difference_update(locations)
+        self.seen.difference_update(locations)
+
+
+def fold(text):
+    """
+    Upper case without accents, keywords and texts are compared folded.
+    """
+
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    text = unicodedata.normalize("NFKD", text)
+    return u"".join(char for char in text
+        if not unicodedata.combining(char)).upper()
+
+
+class Automaton(object):
+    def __init__(self, keywords=()):
+        """
+        Aho-Corasick automaton over keywords, an iterable of (keyword, value).
+        """
+
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for keyword, value in keywords:
+            self.add(keyword, value)
+        self.build()
+
+
+    def add(self, keyword, value):
+        node = 0
+        for char in keyword:
+            following = self.goto[node].get(char)
+            if following is None:
+                following = self.goto[node][char] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            node = following
+        self.outputs[node].append((len(keyword), value))
+
+
+    def build(self):
+        """
+        Breadth first pass setting the failure links.
+        """
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, following in self.goto[node].iteritems():
+                queue.append(following)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[following] = fail if fail != following else 0
+                self.outputs[following] = (self.outputs[following] +
+                    self.outputs[self.fail[following]])
+
+
+    def search(self, text):
+        """
+        Yields (start, end, value) for every keyword occurrence in text.
+        """
+
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, value in outputs[node]:
+                yield position + 1 - length, position + 1, value
+
+
+class Rule(object):
+    __slots__ = ("priority", "keyword", "action", "argument", "anchored")
+
+    def __init__(self, priority, keyword, action, argument="", anchored=False):
+        self.priority = priority
+        self.keyword = fold(keyword).strip()
+        self.action = action
+        self.argument = argument
+        self.anchored = anchored
+
+
+    def __repr__(self):
+        return "<Rule %s %s>" % (self.keyword, self.action)
+
+
+def load_rules(path=RULES):
+    with open(path) as file:
+        return [Rule(priority, row[0], row[1], (row + [""])[2],
+            (row + ["", ""])[3].strip().lower() in ("1", "yes", "true"))
+            for priority, row in enumerate(csv.reader(file)) if row and
+            row[0].strip()]
+
+
+class KeywordRouter(object):
+    def __init__(self, rules):
+        """
+        Raises ValueError for a rule with an unknown action, so a bad rules
+        file is refused whole on startup and on reload alike.
+        """
+
+        for rule in rules:
+            if rule.action not in ACTIONS:
+                raise ValueError("Unknown action %s for %s" % (rule.action,
+                    rule.keyword))
+        self.rules = rules
+        self.automaton = Automaton((rule.keyword, rule) for rule in rules)
+
+
+    def match(self, text):
+        """
+        The first rule (in file order) whose keyword is a word of text, None
+        if none is.
+        """
+
+        text = fold(text)
+        first = len(text) - len(text.lstrip())
+        best = None
+        for start, end, rule in self.automaton.search(text):
+            if best is not None and rule.priority >= best.priority:
+                continue
+            if start and text[start - 1].isalnum():
+                continue
+            if end < len(text) and text[end].isalnum():
+                continue
+            if rule.anchored and start != first:
+                continue
+            best = rule
+        return best
+
+
+class Suppression(object):
+    def __init__(self, path=SUPPRESSION):
+        """
+        Numbers that opted out, one per line in path, appended as they come.
+        """
+
+        self.path = path
+        self.lock = Lock()
+        self.numbers = set()
+        try:
+            with open(path) as file:
+                self.numbers.update(line.strip() for line in file
+                    if line.strip())
+        except IOError:
+            pass
+
+
+    def __contains__(self, number):
+        return normalize(number) in self.numbers
+
+
+    def add(self, number):
+        number = normalize(number)
+        with self.lock:
+            if number in self.numbers:
+                return
+            self.numbers.add(number)
+            with open(self.path, "a") as file:
+                file.write(number + "\n")
+        debug("Suppression: %s added" % number)
+
+
+class Webhook(Thread):
+    def __init__(self, size=WEBHOOK_QUEUE, timeout=WEBHOOK_TIMEOUT):
+        """
+        Posts in the background so a slow endpoint never holds a modem,
+        dropping (and counting) posts when the queue is full.
+        """
+
+        Thread.__init__(self, name="webhook")
+        self.daemon = True
+        self.queue = Queue(size)
+        self.timeout = timeout
+        self.dropped = 0
+        self.errors = 0
+
+
+    def post(self, url, payload):
+        try:
+            self.queue.put_nowait((url, payload))
+        except Full:
+            self.dropped += 1
+
+
+    def run(self):
+        while True:
+            url, payload = self.queue.get()
+            request = urllib2.Request(url, json.dumps(payload),
+                {"Content-Type": "application/json"})
+            try:
+                urllib2.urlopen(request, timeout=self.timeout).read()
+            except (IOError, ValueError), error:
+                self.errors += 1
+                debug("Webhook: %s %s" % (url, error))
+
+
+class Inbound(object):
+    def __init__(self, rules=(), suppression=None, send=None, webhook=None):
+        """
+        :rules: list of Rule.
+        :suppression: Suppression list updated by the suppress action.
+        :send: called as send(text, destination) by the reply action.
+        :webhook: Webhook poster, started on first use if not given.
+        """
+
+        self.router = KeywordRouter(rules)
+        self.suppression = suppression if suppression is not None else (
+            Suppression())
+        self.send = send
+        self.webhook = webhook
+        self.actions = {
+            "suppress": self.do_suppress,
+            "reply": self.do_reply,
+            "webhook": self.do_webhook,
+        }
+        self.handled = {}
+
+
+    def handle(self, message, modem=None):
+        """
+        Route one parsed message (see parse_sms), returns the matched rule.
+        """
+
+        rule = self.router.match(message.get("text", ""))
+        if rule is None:
+            debug("Inbound: no rule for %s from %s" % (message.get("text"),
+                message.get("sender")))
+            return None
+
+        self.handled[rule.action] = self.handled.get(rule.action, 0) + 1
+        self.actions[rule.action](rule, message, modem)
+        return rule
+
+
+    def do_suppress(self, rule, message, modem):
+        if not message.get("sender"):
+            debug("Inbound: no sender to suppress in %r" % message)
+            return
+        self.suppression.add(message["sender"])
+
+
+    def do_reply(self, rule, message, modem):
+        if self.send and message.get("sender"):
+            self.send(rule.argument, message["sender"])
+
+
+    def do_webhook(self, rule, message, modem):
+        if self.webhook is None:
+            self.webhook = Webhook()
+            self.webhook.start()
+        self.webhook.post(rule.argument, dict(message, keyword=rule.keyword,
+            modem=modem))
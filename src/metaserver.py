@@ -1,58 +1,402 @@
 #!/usr/bin/env python
 #-*- coding: UTF-8 -*-
 
-from decoradores import Verbose, Farm, Auto_verbose
-from devicemonitor import Monitor
-from server import Server
+import time
+START = time.time()
+
+from debug import get_writer, log, mark, report_timings, set_level
+from debug import DEBUG, INFO, WARNING, ERROR
+from decoradores import Async, Verbose
+from functools import partial
+from devicemonitor import Monitor, make_config_file, get_conf_name
+from fairqueue import CAMPAIGNS, load_shares
+from gnokii import Gnokii, parse_fields, parse_smsc
+from handover import HANDOVER, Listener, send_modems, take_over
+from idempotency import IdempotencyIndex
+from inbound import Inbound, KeywordRouter, Suppression, load_rules
+from inbound import SUPPRESSION
+from profiler import install as install_profiler
+from quota import Quota
+from routing import Router, load_plan
+from scheduler import Scheduler
+from sender import Gammu
+from spool import Spool, FAILED
+from statusboard import STATUS, StatusBoard, Publisher
+from threading import Lock, Thread
+from timerwheel import release_time
+import csv
 import optparse
 import os
+import re
+import signal
+
+mark("imports", START)
+
+JOIN_TIMEOUT = 60.
+LOCKED_RE = re.compile(r"(?i)\b(PIN2?|PUK2?)\b")
+
+
+def sim_ready(status):
+    """
+    Whether getsecuritycodestatus says no code is pending.
+    """
+
+    return "nothing" in status.lower() or not LOCKED_RE.search(status)
 
-DEBUG = 2
 
 class Metaserver(object):
-    def __init__(self, pathbase="."):
+    def __init__(self, pathbase=".", reserved=0, socket=None,
+        spool="spool.ndjson", plan=None, sims=None, quota=None,
+        timing=False, board=None, keywords=None, suppression=SUPPRESSION,
+        takeover=None, handover=HANDOVER, gammu=(),
+        index="idempotency.idx", campaigns=CAMPAIGNS):
         """
         * Crea la estructura de directorios del metaservidor
             * Esto incluye el fichero de configuracion necesario para hacer
               funcionar al bugoso smsd
         * Inicia el monitor de dispositivos
             Maneja los eventos de conexion/desconexion
-                Pide a farm que instancie y elimine servidores
+                Pide al scheduler que agregue y elimine workers
             Desencadena eventos
+
+        :reserved: workers dedicados al carril de mayor prioridad (otp)
+        :socket: socket unix donde atender envios (ver submission)
+        :spool: diario donde se persisten los mensajes encolados
+        :index: indice de claves de idempotencia de los envios (ver
+            idempotency)
+        :plan: csv "prefijo","operadora" del plan de numeracion
+        :sims: csv "sim","operadora" con la operadora de cada SIM, sim es
+            el IMSI o, si la SIM no lo informa, el IMEI del modem
+        :quota: quota.Quota con los cupos de cada SIM
+        :timing: informa los tiempos de importacion e inicio por stderr
+        :board: fichero del tablero de estado en memoria compartida (ver
+            statusboard y `smsd top`)
+        :keywords: csv de reglas para los mensajes entrantes (ver inbound)
+        :suppression: lista de numeros que pidieron no recibir mas mensajes
+
+        :takeover: socket de un metaservidor en marcha del que tomar los
+            modems (ver handover)
+        :handover: socket donde esperar a un metaservidor nuevo
+        :gammu: modelos que se manejan con python-gammu en lugar del shell
+            de gnokii (ver sender)
+        :campaigns: directorio de campañas, el peso de cada una en su
+            config.ini reparte los modems entre las que corren juntas (ver
+            fairqueue)
+
+        SIGUSR2 (o `smsd profile`) muestrea todos los hilos, ver profiler.
+        SIGHUP relee la configuracion sin detener los envios, ver reload.
         """
 
         self.servers = {}
-        self.sheeps = {}
-        self.farm = Farm() 
+        self.profiles = {}
+        self.pending = set()
+        self.lock = Lock()
+        self.mtimes = {}
+        self.submission = None
+        self.gammu = set(gammu)
         self.pathbase = os.path.abspath(pathbase)
+        self.paths = {"sims": sims, "plan": plan, "keywords": keywords,
+            "campaigns": campaigns}
+        self.quota = quota
+        self.sims = dict(csv.reader(open(sims))) if sims else {}
+        router = Router(load_plan(plan)) if plan else None
+        shares = load_shares(campaigns) if campaigns and os.path.isdir(
+            campaigns) else {}
+        # Before the spool, the old master closes it on the way out
+        adopted = take_over(takeover) if takeover else []
+        self.spool = Spool(os.path.join(self.pathbase, spool))
+        self.board = StatusBoard(board, create=True) if board else None
+        inbound = Inbound(load_rules(keywords) if keywords else [],
+            Suppression(suppression), self.reply)
+        self.scheduler = Scheduler(reserved=reserved, on_done=self.spool.done,
+            router=router, quota=quota, board=self.board, inbound=inbound,
+            on_dispatch=self.spool.dispatched, on_retry=self.spool.retrying,
+            shares=shares)
+        for header, proc in adopted:
+            self.adopt_device(header, proc)
+        for message in self.spool.recover():
+            try:
+                self.scheduler.put(message)
+            except (ValueError, TypeError), error:
+                # A record no scheduler can take must not stop the others
+                debug("Spool: dropping %s: %s" % (message, error))
+                self.spool.update(message.id, FAILED)
+
+        if self.board:
+            Publisher(self.board, self.scheduler).start()
 
+        if socket:
+            from submission import Submission
+            self.submission = Submission(self.spool, self.scheduler, socket,
+                IdempotencyIndex(os.path.join(self.pathbase, index)))
+            thread = Thread(target=self.submission.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+        install_profiler()
+        signal.signal(signal.SIGHUP, lambda *args: Async(self.reload)())
+        if handover:
+            Listener(self.hand_over, handover).start()
         self.device_monitor = Monitor(self.configure_device,
-            self.remove_device)
-        self.device_monitor.loop.run()
-
-
-    @Auto_verbose(1, 1)
-    def configure_device(self, device_path, protocol, model=None):
-        info("Metaserver:configured:%s, %s, %s" % (device_path, protocol,
-            model))
-        server = Server(self, device_path, protocol, model)
-        sheep = self.farm.get_sheep(server.send_sms)
-        self.servers[device_path] = server
-        self.sheeps[device_path] = server
-        self.farm.put_sheep(sheep)
-        server.start_smsd()
-        sheep.start()
+            self.remove_device, self.configure_devices)
+        mark("init", START)
+        if timing:
+            report_timings()
+        signal.signal(signal.SIGTERM,
+            lambda *args: self.device_monitor.loop.quit())
+        try:
+            self.device_monitor.loop.run()
+        finally:
+            # Counters are otherwise only written every quota.BATCH messages
+            if self.quota:
+                self.quota.flush()
+
+
+    @Verbose(1, 1)
+    def configure_device(self, device_path, model, connection="serial"):
+        prepared = self.prepare_device(device_path, model, connection)
+        if prepared:
+            self.activate_device(device_path, *prepared)
         return
 
 
+    def configure_devices(self, devices):
+        """
+        Brings up a batch of (device_path, model) in the background, see
+        bring_up.
+        """
+
+        return Async(self.bring_up)(devices)
+
+
+    def bring_up(self, devices):
+        """
+        Prepares all the devices in parallel and only then puts the ready ones
+        in rotation, the batch takes as long as its slowest modem.
+        """
+
+        jobs = [(device_path, Async(self.prepare_device)(device_path, model))
+            for device_path, model in devices]
+        prepared = [(device_path, job.get_result()) for device_path, job
+            in jobs]
+
+        for device_path, result in prepared:
+            if result:
+                self.activate_device(device_path, *result)
+        info("Metaserver:ready:%d of %d" % (len([result for path, result
+            in prepared if result]), len(devices)))
+
+
+    def prepare_device(self, device_path, model, connection="serial"):
+        """
+        Config file, gnokii process (or gammu connection for the models in
+        self.gammu), identify and SIM check. Returns (server, profile) or
+        None if the modem is not usable, or already in rotation or being
+        prepared.
+        """
+
+        with self.lock:
+            if device_path in self.servers or device_path in self.pending:
+                # Like the modems taken over at startup, or a repeated event
+                return None
+            self.pending.add(device_path)
+
+        prepared = None
+        try:
+            prepared = self._prepare_device(device_path, model, connection)
+            return prepared
+        finally:
+            if prepared is None:
+                with self.lock:
+                    self.pending.discard(device_path)
+
+
+    def _prepare_device(self, device_path, model, connection):
+        info("Metaserver:configured:%s, %s, %s" % (device_path, model,
+            connection))
+        make_config_file(device_path, model, connection)
+        server = None
+        if model in self.gammu:
+            try:
+                server = Gammu(get_conf_name(device_path))
+            except ImportError, error:
+                warning("Metaserver:gnokii:%s, %s" % (device_path, error))
+        server = server or Gnokii(get_conf_name(device_path))
+        try:
+            server.start()
+            profile = parse_fields(server.identify())
+            status = server.getsecuritycodestatus()
+        except (IOError, OSError), error:
+            warning("Metaserver:failed:%s, %s" % (device_path, error))
+            server.stop()
+            return None
+
+        if not sim_ready(status):
+            warning("Metaserver:locked:%s, %s" % (device_path, status.strip()))
+            server.stop()
+            return None
+
+        try:
+            profile["SMSC"] = parse_smsc(server.getsmsc(raw=True))
+        except (IOError, OSError), error:
+            # Not fatal, the phone default center is used
+            warning("Metaserver:nosmsc:%s, %s" % (device_path, error))
+            profile["SMSC"] = []
+        info("Metaserver:smsc:%s, %s" % (device_path, ", ".join(
+            center["number"] for center in profile["SMSC"]) or "default"))
+        return server, profile
+
+
+    def activate_device(self, device_path, server, profile):
+        with self.lock:
+            # Pending since prepare_device
+            self.servers[device_path] = server
+            self.pending.discard(device_path)
+        self.mtimes[device_path] = os.path.getmtime(server.config)
+        self.profiles[device_path] = profile
+        sim = profile.get("IMSI") or profile.get("IMEI")
+        carrier = self.sims.get(sim)
+        smscs = [center["number"] for center in profile.get("SMSC", ())]
+        self.scheduler.add_worker(device_path, server, carrier=carrier,
+            sim=sim, smscs=smscs)
+
+
     def remove_device(self, device_path):
         info("Metaserver:removed:%s" % device_path)
-        server = self.servers[device_path]
-        server.close()
-        del(self.servers[device_path])
+        self.scheduler.remove_worker(device_path)
+        server = self.servers.pop(device_path, None)
+        if server:
+            server.stop()
+        self.profiles.pop(device_path, None)
         return
 
 
+    def adopt_device(self, header, proc):
+        """
+        Put in rotation a modem handed over by the previous master.
+        """
+
+        server = Gnokii(header["config"])
+        server.adopt(proc)
+        info("Metaserver:adopted:%s, pid %s" % (header["device"], proc.pid))
+        self.activate_device(header["device"], server, header["profile"])
+
+
+    def restart_device(self, device_path):
+        """
+        Restart the gnokii shell of a modem once its worker finished the
+        message in flight.
+        """
+
+        worker = self.scheduler.remove_worker(device_path)
+        if worker:
+            worker.join(JOIN_TIMEOUT)
+        server = self.servers[device_path]
+        try:
+            server.restart()
+            profile = parse_fields(server.identify())
+        except (IOError, OSError), error:
+            warning("Metaserver:failed:%s, %s" % (device_path, error))
+            self.remove_device(device_path)
+            return
+        # Same SIM, the message centers read at bring up still hold
+        previous = self.profiles.get(device_path, {})
+        profile["SMSC"] = previous.get("SMSC", [])
+        self.activate_device(device_path, server, profile)
+
+
+    def reload(self):
+        """
+        Re-read the SIM carriers, numbering plan, inbound rules, quota limits
+        and campaign weights in place, then restart one at a time the modems
+        whose gnokii config changed. A file that fails to load keeps its old
+        settings.
+        """
+
+        info("Metaserver:reload")
+        try:
+            if self.paths["sims"]:
+                self.sims = dict(csv.reader(open(self.paths["sims"])))
+                for worker in self.scheduler.workers.values():
+                    worker.carrier = self.sims.get(worker.sim)
+            if self.paths["plan"]:
+                self.scheduler.router = Router(load_plan(self.paths["plan"]))
+            if self.paths["keywords"]:
+                self.scheduler.inbound.router = KeywordRouter(load_rules(
+                    self.paths["keywords"]))
+            if self.quota and self.quota.limits_path:
+                self.quota.load_limits()
+            if self.paths["campaigns"]:
+                self.scheduler.set_shares(load_shares(self.paths["campaigns"]))
+        except (IOError, OSError, ValueError), error:
+            warning("Metaserver:reload failed, %s" % error)
+
+        for device_path, server in self.servers.items():
+            if os.path.getmtime(server.config) != self.mtimes.get(device_path):
+                info("Metaserver:restart:%s, config changed" % device_path)
+                self.restart_device(device_path)
+
+
+    def hand_over(self, connection):
+        """
+        Give the modems to a new master (see handover) and exit. Submissions
+        stop first and every worker finishes its message in flight, the rest
+        stays queued in the spool for the new master.
+        """
+
+        info("Metaserver:handover")
+        if self.submission:
+            self.submission.shutdown()
+            self.submission.server_close()
+        workers = [self.scheduler.remove_worker(device_path)
+            for device_path in self.servers.keys()]
+        for worker in workers:
+            if worker:
+                worker.join(JOIN_TIMEOUT)
+        if self.quota:
+            self.quota.flush()
+        self.spool.close()
+        if self.submission:
+            self.submission.index.close()
+
+        procs = [(device_path, server.config, server.detach())
+            for device_path, server in self.servers.items()
+            if server.is_alive()]
+        # gammu sessions are closed by detach, the new master opens them
+        procs = [(device_path, config, proc) for device_path, config, proc
+            in procs if proc is not None]
+        send_modems(connection, [({"device": device_path, "profile":
+            self.profiles[device_path], "pid": proc.pid, "config": config},
+            proc.stdin.fileno(), proc.stdout.fileno())
+            for device_path, config, proc in procs])
+        info("Metaserver:handed over %d modems" % len(procs))
+        get_writer().flush()
+        os._exit(0)
+
+
+    def reply(self, message, destination):
+        """
+        Auto response of an inbound rule, on the top lane so the first modem
+        to get free sends it.
+        """
+
+        return self.sendsms(message, destination, self.scheduler.lanes[0])
+
+
+    def sendsms(self, message, destination, lane=None, campaign=None,
+        at=None, window=None, **kwargs):
+        """
+        Queue a message on the given lane (bulk by default), to be sent at
+        the given time and within window ("HH:MM-HH:MM") if any.
+        """
+
+        message, = self.spool.append([{"destination": destination, "text":
+            message, "lane": lane, "options": kwargs, "campaign": campaign,
+            "at": release_time(at, window)}])
+        self.scheduler.put(message)
+        return message
+
+
 def get_options():
     # Instance the parser and define the usage message
     optparser = optparse.OptionParser(usage="""
@@ -64,39 +408,74 @@ def get_options():
         help="Increment verbosity")
     optparser.add_option("-q", "--quiet", action="count", dest="quiet",
         help="Decrement verbosity")
+    optparser.add_option("-r", "--reserved", type="int", dest="reserved",
+        help="Workers reserved for the otp lane, none by default: without"
+        " them an otp message can wait behind a bulk sendsms on every modem")
+    optparser.add_option("-s", "--socket", dest="socket",
+        help="Unix socket for the submission service")
+    optparser.add_option("-p", "--plan", dest="plan",
+        help="Numbering plan csv, \"prefix\",\"carrier\" rows")
+    optparser.add_option("--sims", dest="sims",
+        help="SIM carriers csv, \"sim\",\"carrier\" rows, sim is the IMSI, "
+        "or the modem IMEI for SIMs that don't report it")
+    optparser.add_option("-t", "--timing", action="store_true", dest="timing",
+        help="Report import and init times on stderr")
+    optparser.add_option("--daily", type="int", dest="daily",
+        help="Default daily SMS limit per SIM")
+    optparser.add_option("--monthly", type="int", dest="monthly",
+        help="Default monthly SMS limit per SIM")
+    optparser.add_option("--limits", dest="limits",
+        help="Per SIM limits csv, \"sim\",\"daily\",\"monthly\" rows, sim as "
+        "in --sims")
+    optparser.add_option("-b", "--board", dest="board",
+        help="Shared memory status board, read by smsd top")
+    optparser.add_option("-k", "--keywords", dest="keywords",
+        help="Inbound rules csv, \"keyword\",\"action\",\"argument\" rows")
+    optparser.add_option("--suppression", dest="suppression",
+        help="Opted out numbers, one per line")
+    optparser.add_option("--takeover", action="store_true", dest="takeover",
+        help="Take the modems over from the running metaserver")
+    optparser.add_option("--handover", dest="handover",
+        help="Socket where a new metaserver can take the modems over")
+    optparser.add_option("--gammu", action="append", dest="gammu",
+        help="Model driven through python-gammu, can be repeated")
+    optparser.add_option("--campaigns", dest="campaigns",
+        help="Campaigns directory, weights in <name>/config.ini")
 
     # Define the default options
-    optparser.set_defaults(verbose=0, quiet=0)
+    optparser.set_defaults(verbose=0, quiet=0, reserved=0, timing=False,
+        board=STATUS, suppression=SUPPRESSION, takeover=False,
+        handover=HANDOVER, gammu=[], campaigns=CAMPAIGNS)
 
     # Process the options
     return optparser.parse_args()
 
 
 def main(options, args):
-    debug(options, args)
-    metaserver = Metaserver()
+    quota = Quota("quota.json", options.daily, options.monthly, options.limits)
+    metaserver = Metaserver(reserved=options.reserved, socket=options.socket,
+        plan=options.plan, sims=options.sims, quota=quota,
+        timing=options.timing, board=options.board,
+        keywords=options.keywords, suppression=options.suppression,
+        takeover=options.handover if options.takeover else None,
+        handover=options.handover, gammu=options.gammu,
+        campaigns=options.campaigns)
 
     return 0
 
 
+error = partial(log, ERROR)
+warning = partial(log, WARNING)
+info = partial(log, INFO)
+moreinfo = partial(log, DEBUG + 5)
+debug = partial(log, DEBUG)
+
+
 if __name__ == "__main__":
     # == Reading the options of the execution ==
     options, args = get_options()
-
-    error = Verbose(options.verbose - options.quiet + 2, "E: ")
-    warning = Verbose(options.verbose - options.quiet + 1, "W: ")
-    info = Verbose(options.verbose - options.quiet + 0)
-    moreinfo = Verbose(options.verbose - options.quiet -1)
-    debug = Verbose(options.verbose - options.quiet - 2, "D: ")
+    set_level(INFO - 10 * (options.verbose - options.quiet))
 
     debug("""Options: '%s', args: '%s'""" % (options, args))
 
     exit(main(options, args))
-
-else:
-
-    error = Verbose(2 - DEBUG, "E: ")
-    warning = Verbose(1 - DEBUG, "W: ")
-    info = Verbose(0 - DEBUG)
-    moreinfo = Verbose(1 - DEBUG)
-    debug = Verbose(2 - DEBUG, "D: ")
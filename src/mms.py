@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+"""
+    Incremental MMS PDU parser (OMA MMS encapsulation over WSP).
+
+    feed() takes the PDU in chunks as gnokii writes it and returns the parts
+    completed so far as (content_type, name, data) tuples. Only the unparsed
+    tail is buffered, so memory is bounded by the biggest part instead of the
+    whole message.
+"""
+
+CONTENT_TYPE = 0x84
+CONTENT_LOCATION = 0x8E
+CONTENT_TYPES = {
+    0x00: "*/*",
+    0x01: "text/*",
+    0x02: "text/html",
+    0x03: "text/plain",
+    0x06: "text/vnd.wap.wml",
+    0x08: "text/x-vCard",
+    0x1C: "image/*",
+    0x1D: "image/gif",
+    0x1E: "image/jpeg",
+    0x1F: "image/tiff",
+    0x20: "image/png",
+    0x21: "image/vnd.wap.wbmp",
+    0x22: "application/vnd.wap.multipart.*",
+    0x23: "application/vnd.wap.multipart.mixed",
+    0x33: "application/vnd.wap.multipart.related",
+    0x3E: "application/vnd.wap.mms-message",
+}
+
+
+class NeedMore(Exception):
+    """
+    The buffer ends too soon, needed is the length it must reach when known.
+    """
+
+    def __init__(self, needed=None):
+        Exception.__init__(self)
+        self.needed = needed
+
+
+class Reader(object):
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+
+    def byte(self):
+        if self.pos >= len(self.data):
+            raise NeedMore(self.pos + 1)
+        self.pos += 1
+        return ord(self.data[self.pos - 1])
+
+
+    def peek(self):
+        if self.pos >= len(self.data):
+            raise NeedMore(self.pos + 1)
+        return ord(self.data[self.pos])
+
+
+    def take(self, length):
+        if self.pos + length > len(self.data):
+            raise NeedMore(self.pos + length)
+        self.pos += length
+        return self.data[self.pos - length:self.pos]
+
+
+    def uintvar(self):
+        value = 0
+        while True:
+            byte = self.byte()
+            value = (value << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return value
+
+
+    def text(self):
+        end = self.data.find("\0", self.pos)
+        if end < 0:
+            raise NeedMore()
+        text = self.data[self.pos:end]
+        self.pos = end + 1
+        return text.lstrip('"\x7f')
+
+
+    def length(self):
+        """
+        Value-length, returns None when the value is not length prefixed.
+        """
+
+        first = self.peek()
+        if first < 31:
+            self.pos += 1
+            return first
+        elif first == 31:
+            self.pos += 1
+            return self.uintvar()
+        return None
+
+
+    def skip_value(self):
+        length = self.length()
+        if length is not None:
+            self.take(length)
+        elif self.peek() < 128:
+            self.text()
+        else:
+            self.pos += 1
+
+
+    def content_type(self):
+        length = self.length()
+        end = None if length is None else self.pos + length
+        if end is not None and end > len(self.data):
+            raise NeedMore(end)
+
+        if self.peek() >= 128:
+            value = self.byte() & 0x7F
+            media = CONTENT_TYPES.get(value, "application/x-wsp-%02x" % value)
+        else:
+            media = self.text()
+
+        if end is not None:
+            self.pos = end
+        return media
+
+
+class MMSParser(object):
+    def __init__(self):
+        # Chunks are only joined once there is enough to parse something
+        self.chunks = []
+        self.size = 0
+        self.wanted = 0
+        self.state = "headers"
+        self.content_type = None
+        self.entries = None
+
+
+    def feed(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        parts = []
+        if self.size < self.wanted:
+            return parts
+
+        buffer = "".join(self.chunks)
+        pos = 0
+        while self.state != "done":
+            reader = Reader(buffer, pos)
+            try:
+                part = getattr(self, "parse_%s" % self.state)(reader)
+            except NeedMore, error:
+                needed = error.needed
+                self.wanted = (len(buffer) + 1 if needed is None else
+                    needed) - pos
+                break
+            pos = reader.pos
+            if part is not None:
+                parts.append(part)
+        buffer = buffer[pos:]
+        self.chunks = [buffer]
+        self.size = len(buffer)
+        return parts
+
+
+    def parse_headers(self, reader):
+        field = reader.byte()
+        if field < 128:
+            # Application header, text name and text value
+            reader.pos -= 1
+            reader.text()
+            reader.text()
+        elif field == CONTENT_TYPE:
+            self.content_type = reader.content_type()
+            if "multipart" in self.content_type:
+                self.state = "count"
+            else:
+                self.state = "single"
+        else:
+            reader.skip_value()
+
+
+    def parse_count(self, reader):
+        self.entries = reader.uintvar()
+        self.state = "entry" if self.entries else "done"
+
+
+    def parse_entry(self, reader):
+        headers_length = reader.uintvar()
+        data_length = reader.uintvar()
+        headers = Reader(reader.take(headers_length))
+        data = reader.take(data_length)
+
+        content_type = name = None
+        try:
+            content_type = headers.content_type()
+            while headers.pos < len(headers.data):
+                field = headers.byte()
+                if field == CONTENT_LOCATION:
+                    name = headers.text()
+                elif field < 128:
+                    headers.pos -= 1
+                    headers.text()
+                    headers.text()
+                else:
+                    headers.skip_value()
+        except NeedMore:
+            content_type = content_type or "application/octet-stream"
+
+        self.entries -= 1
+        if not self.entries:
+            self.state = "done"
+        return content_type, name, data
+
+
+    def parse_single(self, reader):
+        # The body goes whole to close
+        raise NeedMore(float("inf"))
+
+
+    def close(self):
+        """
+        Returns the body of a non multipart message, left in the buffer.
+        """
+
+        parts = []
+        body = "".join(self.chunks)
+        if self.state == "single" and body:
+            parts.append((self.content_type, None, body))
+        self.chunks = []
+        self.size = 0
+        self.state = "done"
+        return parts
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from debug import debug
+from threading import Lock, Thread, current_thread, enumerate as threads
+import os
+import sys
+import time
+
+"""
+    Statistical profiler that can be switched on in a running process.
+
+    A Sampler thread walks sys._current_frames() every INTERVAL seconds for
+    a window of seconds and counts the stacks of every other thread. The
+    result is written in the collapsed format of flamegraph.pl, rooted at
+    the thread name (the device path for modem workers), so a single modem
+    can be grepped out:
+
+        /dev/ttyUSB0;scheduler.run;gnokii.sendsms;gnokii.get_result 812
+
+    Started by signal (install) or by the "profile" operation of the
+    submission socket (smsd profile). Threads are only read while sampling,
+    nothing is traced, so the cost is zero when off and a few percent when
+    on.
+"""
+
+INTERVAL = .005
+WINDOW = 30.
+DIRECTORY = "/tmp"
+DEPTH = 64
+
+_sampler = None
+_lock = Lock()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return "%s.%s" % (module, code.co_name)
+
+
+def collapse(frame, depth=DEPTH):
+    """
+    Stack of frame, outermost first, as ";" separated names.
+    """
+
+    names = []
+    while frame is not None and len(names) < depth:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler(Thread):
+    def __init__(self, window=WINDOW, interval=INTERVAL, path=None):
+        Thread.__init__(self, name="profiler")
+        self.daemon = True
+        self.window = window
+        self.interval = interval
+        self.path = path or os.path.join(DIRECTORY, "smsd-%d-%d.folded" % (
+            os.getpid(), time.time()))
+        self.counts = {}
+        self.samples = 0
+        self.running = False
+
+
+    def run(self):
+        self.running = True
+        me = current_thread().ident
+        names = {}
+        deadline = time.time() + self.window
+        counts = self.counts
+        while self.running and time.time() < deadline:
+            frames = sys._current_frames()
+            if len(names) != len(frames):
+                names = dict((thread.ident, thread.name) for thread
+                    in threads())
+            for ident, frame in frames.iteritems():
+                if ident == me:
+                    continue
+                stack = "%s;%s" % (names.get(ident, ident), collapse(frame))
+                counts[stack] = counts.get(stack, 0) + 1
+            self.samples += 1
+            frames = frame = None
+            time.sleep(self.interval)
+
+        self.running = False
+        self.write()
+
+
+    def write(self):
+        with open(self.path, "w") as file:
+            for stack, count in sorted(self.counts.iteritems()):
+                file.write("%s %d\n" % (stack, count))
+        debug("Profiler: %d samples, %d stacks in %s" % (self.samples,
+            len(self.counts), self.path))
+
+
+    def stop(self):
+        self.running = False
+
+
+def start(window=WINDOW, interval=INTERVAL, path=None):
+    """
+    Start sampling unless already running, returns the Sampler.
+    """
+
+    global _sampler
+    with _lock:
+        if _sampler is None or not _sampler.is_alive():
+            _sampler = Sampler(window, interval, path)
+            _sampler.start()
+        return _sampler
+
+
+def stop():
+    """
+    Stop the running Sampler early, it still writes its output.
+    """
+
+    with _lock:
+        if _sampler is not None and _sampler.is_alive():
+            _sampler.stop()
+        return _sampler
+
+
+def toggle(*args):
+    """
+    Signal handler: starts a window of sampling, or ends the current one.
+    """
+
+    if _sampler is not None and _sampler.is_alive():
+        stop()
+    else:
+        start()
+
+
+def install(signum=None):
+    """
+    Toggle the profiler on signum, SIGUSR2 by default.
+    """
+
+    import signal
+    signal.signal(signal.SIGUSR2 if signum is None else signum, toggle)
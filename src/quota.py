@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from debug import debug
+from threading import Lock
+import csv
+import json
+import os
+import time
+
+"""
+    Per SIM sending quotas.
+
+    Every SIM is only ever counted by the worker thread owning its modem, so
+    increments need no lock. Counters roll over by themselves when the day or
+    month changes and are written to disk in batches, every BATCH messages or
+    INTERVAL seconds, with an atomic rename.
+"""
+
+BATCH = 100
+INTERVAL = 60.
+GSM_SINGLE, GSM_PART = 160, 153
+UCS2_SINGLE, UCS2_PART = 70, 67
+GSM_CHARS = set(u"@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;"
+    u"<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+    u"^{}\\[~]|€")
+# Sent as escape + char, two septets each
+GSM_EXTENSION = set(u"^{}\\[~]|€")
+
+
+def segments(text):
+    """
+    Number of SMS a text is split into.
+    """
+
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    if set(text) <= GSM_CHARS:
+        single, part = GSM_SINGLE, GSM_PART
+        length = len(text) + sum(1 for char in text if char in GSM_EXTENSION)
+    else:
+        single, part = UCS2_SINGLE, UCS2_PART
+        length = len(text)
+    if length <= single:
+        return 1
+    return (length + part - 1) // part
+
+
+class Counter(object):
+    __slots__ = ("day", "month", "daily", "monthly")
+
+    def __init__(self, day=None, month=None, daily=0, monthly=0):
+        self.day = day
+        self.month = month
+        self.daily = daily
+        self.monthly = monthly
+
+
+    def roll(self, day, month):
+        if self.day != day:
+            self.day, self.daily = day, 0
+        if self.month != month:
+            self.month, self.monthly = month, 0
+
+
+class Quota(object):
+    def __init__(self, path=None, daily=None, monthly=None, limits=None,
+        batch=BATCH, interval=INTERVAL):
+        """
+        :path: json file where counters are kept between runs.
+        :daily: default daily limit per SIM, None for no limit.
+        :monthly: default monthly limit per SIM, None for no limit.
+        :limits: csv of "sim","daily","monthly" rows overriding the defaults,
+            empty cells mean no limit.
+        """
+
+        self.path = path
+        self.default = daily, monthly
+        self.limits = {}
+        self.counters = {}
+        self.batch = batch
+        self.interval = interval
+        self.dirty = 0
+        self.flushed = time.time()
+        self.lock = Lock()
+        self._day = self._month = None
+        self._rollover = 0
+
+        self.limits_path = limits
+        if limits:
+            self.load_limits()
+        if path and os.path.exists(path):
+            self.load()
+
+
+    def load_limits(self):
+        """
+        (Re)read the per SIM limits csv.
+        """
+
+        limits = {}
+        for row in csv.reader(open(self.limits_path)):
+            sim, daily, monthly = (row + ["", ""])[:3]
+            limits[sim] = (int(daily) if daily.strip() else None,
+                int(monthly) if monthly.strip() else None)
+        self.limits = limits
+
+
+    def periods(self):
+        now = time.time()
+        if now >= self._rollover:
+            local = time.localtime(now)
+            self._day = time.strftime("%Y-%m-%d", local)
+            self._month = time.strftime("%Y-%m", local)
+            midnight = time.mktime(local[:3] + (0, 0, 0) + local[6:8] + (-1,))
+            self._rollover = midnight + 86400
+        return self._day, self._month
+
+
+    def counter(self, sim):
+        counter = self.counters.get(sim)
+        if counter is None:
+            counter = self.counters.setdefault(sim, Counter())
+        counter.roll(*self.periods())
+        return counter
+
+
+    def available(self, sim):
+        """
+        Whether sim still has room in its daily and monthly bundles.
+        """
+
+        daily, monthly = self.limits.get(sim, self.default)
+        counter = self.counter(sim)
+        return ((daily is None or counter.daily < daily) and
+            (monthly is None or counter.monthly < monthly))
+
+
+    def add(self, sim, count=1):
+        counter = self.counter(sim)
+        counter.daily += count
+        counter.monthly += count
+
+        self.dirty += count
+        if self.dirty >= self.batch or (time.time() - self.flushed >
+            self.interval):
+            self.flush()
+
+
+    def load(self):
+        with open(self.path) as file:
+            for sim, values in json.load(file).items():
+                self.counters[sim] = Counter(*values)
+        debug("Quota: %d SIMs loaded" % len(self.counters))
+
+
+    def flush(self):
+        if not self.path or not self.lock.acquire(False):
+            return
+
+        try:
+            self.dirty = 0
+            self.flushed = time.time()
+            snapshot = dict((sim, (counter.day, counter.month, counter.daily,
+                counter.monthly)) for sim, counter in self.counters.items())
+            tmp = "%s.tmp" % self.path
+            with open(tmp, "w") as file:
+                json.dump(snapshot, file)
+            os.rename(tmp, self.path)
+        finally:
+            self.lock.release()
+
+
+    def report(self):
+        report = {}
+        for sim in self.counters.keys():
+            counter = self.counter(sim)
+            daily, monthly = self.limits.get(sim, self.default)
+            report[sim] = {"daily": counter.daily, "monthly": counter.monthly,
+                "daily_limit": daily, "monthly_limit": monthly}
+        return report
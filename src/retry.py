@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from debug import debug
+import random
+import re
+import time
+
+"""
+    Failure handling for the send workers.
+
+    RetryPolicy tells transient gnokii failures (timeouts, busy network, phone
+    not ready) from permanent ones (invalid number, unsupported option) and
+    computes jittered exponential backoff delays. Failed messages are not
+    slept on, the scheduler holds them until the delay expires and hands them
+    to another modem.
+
+    CircuitBreaker takes a modem out of rotation after consecutive transient
+    failures and only puts it back once a health probe passes.
+"""
+
+OK = "ok"
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+SUCCESS_RE = re.compile(r"(?i)send succeeded")
+PERMANENT_RE = re.compile(r"(?i)invalid|wrong|not supported|not implemented|"
+    r"unknown option|usage:|too long|not allowed|unknown model")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class SendError(IOError):
+    def __init__(self, message, kind=TRANSIENT):
+        IOError.__init__(self, message)
+        self.kind = kind
+
+
+class RetryPolicy(object):
+    def __init__(self, attempts=5, base=1., cap=120.):
+        """
+        :attempts: sends tried before giving a message up.
+        :base: first backoff delay in seconds.
+        :cap: maximum backoff delay in seconds.
+        """
+
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+
+    def classify(self, result=None, error=None):
+        """
+        Returns OK, TRANSIENT or PERMANENT for a sendsms result or error.
+        """
+
+        if error is not None:
+            if isinstance(error, SendError):
+                return error.kind
+            elif isinstance(error, (IOError, OSError)):
+                return TRANSIENT
+            else:
+                return PERMANENT
+
+        result = result or ""
+        if SUCCESS_RE.search(result):
+            return OK
+        elif PERMANENT_RE.search(result):
+            return PERMANENT
+        else:
+            # Timeouts, busy network, phone not ready or no answer at all
+            return TRANSIENT
+
+
+    def delay(self, attempt):
+        """
+        Full jitter exponential backoff for the attempt number (1 based).
+        """
+
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+    def should_retry(self, message, kind):
+        return kind == TRANSIENT and message.attempts < self.attempts
+
+
+class CircuitBreaker(object):
+    def __init__(self, name, threshold=3, cooldown=30., max_cooldown=600.,
+        on_trip=None):
+        """
+        :threshold: consecutive transient failures that open the breaker.
+        :cooldown: seconds the breaker stays open before a probe is allowed,
+            doubled on every failed probe up to max_cooldown.
+        :on_trip: called with no arguments every time the breaker opens.
+        """
+
+        self.name = name
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+        self.on_trip = on_trip
+
+
+    def allow(self):
+        """
+        Whether the modem may take work. Moves an expired open breaker to
+        half-open, where only a probe is allowed.
+        """
+
+        if self.state == OPEN and time.time() - self.opened >= self.cooldown:
+            self.state = HALF_OPEN
+        return self.state == CLOSED
+
+
+    def remaining(self):
+        if self.state != OPEN:
+            return 0.
+        return max(0., self.cooldown - (time.time() - self.opened))
+
+
+    def success(self):
+        self.failures = 0
+        if self.state != CLOSED:
+            debug("Breaker %s closed" % self.name)
+        self.state = CLOSED
+        self.cooldown = self.base_cooldown
+
+
+    def failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+            self.trip()
+        elif self.state == CLOSED and self.failures >= self.threshold:
+            self.trip()
+
+
+    def trip(self):
+        debug("Breaker %s open for %.0fs" % (self.name, self.cooldown))
+        self.state = OPEN
+        self.opened = time.time()
+        if self.on_trip:
+            self.on_trip()
+
+
+    def probe(self, gnokii):
+        """
+        Health check run in half-open state, the modem must answer identify.
+        """
+
+        try:
+            healthy = "IMEI" in gnokii.identify()
+        except (IOError, OSError):
+            healthy = False
+
+        if healthy:
+            self.success()
+        else:
+            self.failure()
+        return healthy
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from array import array
+from debug import debug
+import csv
+import re
+
+"""
+    Carrier routing.
+
+    The numbering plan is a csv of "prefix","carrier" rows (same layout as
+    data/models.csv). It is compiled into a flat trie: node n has its ten
+    children at children[n * 10 + digit] and its carrier id, if a prefix ends
+    there, at values[n]. A lookup walks at most one node per digit and keeps
+    the longest matching prefix.
+"""
+
+PLAN = "data/numbering.csv"
+NOT_DIGITS = re.compile(r"\D")
+
+
+def normalize(number):
+    """
+    Digits only, without the international call prefix.
+    """
+
+    number = NOT_DIGITS.sub("", "%s" % number)
+    if number.startswith("00"):
+        number = number[2:]
+    return number
+
+
+class PrefixTrie(object):
+    def __init__(self, prefixes=()):
+        """
+        :prefixes: iterable of (prefix, carrier).
+        """
+
+        self.carriers = [None]
+        self.ids = {}
+        self.children = array("i", [0] * 10)
+        self.values = array("h", [0])
+        for prefix, carrier in prefixes:
+            self.add(prefix, carrier)
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def add(self, prefix, carrier):
+        if carrier not in self.ids:
+            self.ids[carrier] = len(self.carriers)
+            self.carriers.append(carrier)
+
+        node = 0
+        for digit in normalize(prefix):
+            index = node * 10 + ord(digit) - 48
+            if not self.children[index]:
+                self.children[index] = len(self.values)
+                self.children.extend([0] * 10)
+                self.values.append(0)
+            node = self.children[index]
+        self.values[node] = self.ids[carrier]
+
+
+    def lookup(self, number):
+        """
+        Carrier of the longest prefix of number, None if none matches.
+        """
+
+        children = self.children
+        values = self.values
+        node = 0
+        found = 0
+        for digit in normalize(number):
+            node = children[node * 10 + ord(digit) - 48]
+            if not node:
+                break
+            found = values[node] or found
+        return self.carriers[found]
+
+
+def load_plan(path=PLAN):
+    with open(path) as file:
+        trie = PrefixTrie((prefix, carrier) for prefix, carrier
+            in csv.reader(file) if prefix.strip())
+    debug("Numbering plan: %d nodes, %d carriers" % (len(trie),
+        len(trie.carriers) - 1))
+    return trie
+
+
+class Router(object):
+    def __init__(self, trie=None):
+        """
+        Tags messages with the carrier of their destination so the scheduler
+        can prefer an idle modem on the same network.
+        """
+
+        self.trie = trie or PrefixTrie()
+        self.routed = {}
+
+
+    def route(self, message):
+        if message.carrier is None:
+            message.carrier = self.trie.lookup(message.destination)
+        self.routed[message.carrier] = self.routed.get(message.carrier, 0) + 1
+        return message.carrier
@@ -0,0 +1,685 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from debug import debug
+from fairqueue import FairQueue
+from inbound import Reassembler, parse_sms, ranges
+from quota import segments
+from retry import RetryPolicy, CircuitBreaker, SendError
+from retry import OK, PERMANENT, HALF_OPEN
+from smsc import SmscBalancer
+from statusboard import IDLE, SENDING, ERROR, OPEN, QUOTA, STOPPED
+from telemetry import Telemetry
+from threading import Condition, Thread
+from timerwheel import TimerWheel, Releaser
+import heapq
+import itertools
+import time
+
+"""
+    Send scheduler sitting in front of the Gnokii.sendsms workers.
+
+    Messages are queued in priority lanes (LANES, highest first). Workers pull
+    from the highest non empty lane, but every BULK_EVERY consecutive
+    dispatches from a higher lane while a lower one is waiting the lower lane
+    gets a turn, so bulk traffic never starves.
+
+    Messages that failed transiently are held in a delay heap until their
+    backoff expires and are not handed again to the modems they failed on.
+
+    Messages with a future send time (at) wait in a timer wheel and are
+    queued when it comes, see timerwheel.
+
+    Inside a lane messages are bucketed by the carrier of their destination
+    (see routing). A worker takes from its own carrier's bucket first and
+    from another bucket only if no modem of that carrier is idle. Inside a
+    bucket campaigns share the modems by weight, see fairqueue.
+
+    Workers are weighted by the radio telemetry of their modem (see
+    telemetry). A worker leaves the queued messages to idle workers at
+    least YIELD_RATIO times stronger when those can take them all, for
+    YIELD_MAX seconds at most, so weak links only get the overflow.
+"""
+
+LANES = ("otp", "bulk")
+SLO = {"otp": 1., "bulk": 600.}
+BULK_EVERY = 8
+SAMPLES = 1024
+QUOTA_PAUSE = 5.
+INBOX = "SM"
+INBOX_EVERY = 30.
+INBOX_MAX = 300.
+YIELD_RATIO = 1.5
+YIELD_MAX = 2.
+YIELD_POLL = .05
+
+
+class Message(object):
+    __slots__ = ("id", "destination", "text", "lane", "options", "enqueued",
+        "dispatched", "attempts", "excluded", "carrier", "campaign", "batch",
+        "row", "at", "key")
+
+    def __init__(self, id, destination, text, lane, options=None,
+        campaign=None, at=None, key=None):
+        self.id = id
+        self.destination = destination
+        self.text = text
+        self.lane = lane
+        self.options = options or {}
+        self.enqueued = time.time()
+        self.dispatched = None
+        self.attempts = 0
+        self.excluded = None
+        self.carrier = None
+        self.campaign = campaign
+        self.batch = None
+        self.row = None
+        self.at = at
+        self.key = key
+
+
+    def __repr__(self):
+        return "<Message %s %s %s>" % (self.id, self.lane, self.destination)
+
+
+class Lane(object):
+    def __init__(self, shares=None):
+        """
+        Queues of one lane, one FairQueue of the campaigns with shares per
+        destination carrier.
+        """
+
+        self.buckets = {}
+        self.shares = shares
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    def _bucket(self, message):
+        bucket = self.buckets.get(message.carrier)
+        if bucket is None:
+            bucket = self.buckets[message.carrier] = FairQueue(self.shares)
+        return bucket
+
+
+    def append(self, message):
+        self._bucket(message).append(message)
+        self.size += 1
+
+
+    def appendleft(self, message):
+        self._bucket(message).appendleft(message)
+        self.size += 1
+
+
+    def pop(self, worker=None, carrier=None, idle=None):
+        """
+        Next message for worker, on net first. Off net buckets are served
+        oldest head first, skipping carriers with an idle modem of their own.
+        """
+
+        buckets = []
+        own = self.buckets.get(carrier)
+        if own:
+            buckets.append(own)
+
+        idle = idle or {}
+        others = [(bucket.head().enqueued, key) for key, bucket
+            in self.buckets.iteritems() if bucket and key != carrier and
+            (key is None or not idle.get(key) or bucket.head().excluded)]
+        buckets.extend(self.buckets[key] for enqueued, key in sorted(others))
+
+        for bucket in buckets:
+            message = bucket.take(worker)
+            if message is not None:
+                self.size -= 1
+                return message
+
+
+class LaneStats(object):
+    def __init__(self, slo, samples=SAMPLES):
+        """
+        Queueing latency metrics of one lane.
+
+        :slo: seconds a message may wait before being dispatched.
+        :samples: size of the ring of recent latencies used for percentiles.
+        """
+
+        self.slo = slo
+        self.samples = [0.] * samples
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.violations = 0
+        self.sent = 0
+        self.failed = 0
+
+
+    def add(self, latency):
+        self.samples[self.count % len(self.samples)] = latency
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        if latency > self.slo:
+            self.violations += 1
+
+
+    def percentile(self, percent):
+        recent = sorted(self.samples[:min(self.count, len(self.samples))])
+        if not recent:
+            return 0.
+        return recent[min(len(recent) - 1, int(len(recent) * percent / 100.))]
+
+
+    def report(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "slo": self.slo,
+            "violations": self.violations,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
+
+
+class Scheduler(object):
+    def __init__(self, lanes=LANES, slo=SLO, bulk_every=BULK_EVERY,
+        reserved=0, on_done=None, policy=None, router=None, quota=None,
+        board=None, inbound=None, on_dispatch=None, on_retry=None,
+        shares=None):
+        """
+        :lanes: lane names, highest priority first.
+        :slo: maximum queueing seconds per lane, used for the metrics.
+        :bulk_every: consecutive higher lane dispatches before a waiting lower
+            lane is served.
+        :reserved: number of workers kept for the highest lane only. With
+            reserved workers the top lane is never stuck behind a sendsms in
+            progress.
+        :on_done: called as on_done(message, result, error) once a message
+            was sent or given up. Messages of a batch.MessageBatch report to
+            their batch instead.
+        :on_dispatch: called as on_dispatch(message) right before a message
+            submitted with an idempotency key is handed to the modem.
+        :on_retry: called as on_retry(message) when such a message failed
+            and waits for a retry.
+        :shares: {campaign: weight} of the modems each campaign gets when
+            several are queued, see fairqueue.
+        :policy: RetryPolicy for failed sends.
+        :router: routing.Router tagging messages with their carrier.
+        :quota: quota.Quota, workers whose SIM is over quota stop taking work.
+        :board: statusboard.StatusBoard where workers publish their state.
+        :inbound: inbound.Inbound handling the messages workers read from
+            their modems. Its suppression list is checked on every put.
+        """
+
+        self.lanes = list(lanes)
+        self.shares = dict(shares or {})
+        self.queues = dict((lane, Lane(self.shares)) for lane in self.lanes)
+        self.stats = dict((lane, LaneStats(slo.get(lane, SLO["bulk"])))
+            for lane in self.lanes)
+        self.bulk_every = bulk_every
+        self.reserved = reserved
+        self.on_done = on_done
+        self.on_dispatch = on_dispatch
+        self.on_retry = on_retry
+        self.policy = policy or RetryPolicy()
+        self.router = router
+        self.quota = quota
+        self.board = board
+        self.inbound = inbound
+        self.campaigns = {}
+        self.idle = {}
+        self.weights = {}
+        self.waiting = {}
+        self.deferred = {}
+        self.timers = TimerWheel()
+        self.releaser = None
+        self.delayed = []
+        self.condition = Condition()
+        self.streak = 0
+        self.workers = {}
+        self._ids = itertools.count(1)
+
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values()) + len(
+            self.delayed) + len(self.timers) + (len(self.releaser.backlog)
+            if self.releaser else 0)
+
+
+    def submit(self, destination, text, lane=None, **options):
+        """
+        Queue a new message, returns the Message.
+        """
+
+        lane = lane or self.lanes[-1]
+        message = Message(self._ids.next(), destination, text, lane, options)
+        self.put(message)
+        return message
+
+
+    def put(self, message):
+        """
+        Queue message, or hold it in the timer wheel until message.at.
+        """
+
+        message.lane = message.lane or self.lanes[-1]
+        if message.lane not in self.queues:
+            raise ValueError("Unknown lane: %s" % message.lane)
+        if message.campaign is not None:
+            with self.condition:
+                counts = self.campaigns.setdefault(message.campaign, [0, 0, 0])
+                counts[0] += 1
+        if self.inbound and message.destination in self.inbound.suppression:
+            self.finish(message, error=SendError("suppressed", PERMANENT))
+            return
+
+        if message.at is not None and message.at > time.time():
+            if self.releaser is None:
+                with self.condition:
+                    if self.releaser is None:
+                        self.releaser = Releaser(self.timers, self.release)
+                        self.releaser.start()
+            self.timers.add(message.at, message)
+        else:
+            self.release(message)
+
+
+    def release(self, message):
+        if self.router:
+            self.router.route(message)
+
+        with self.condition:
+            self.queues[message.lane].append(message)
+            self.condition.notify_all()
+
+
+    def retry(self, message, delay, worker=None):
+        """
+        Hold message for delay seconds, then queue it again at the head of its
+        lane, avoiding the worker it failed on.
+        """
+
+        if worker is not None:
+            message.excluded = (message.excluded or set()) | set([worker])
+            if len(message.excluded) >= len(self.workers):
+                message.excluded = None
+
+        with self.condition:
+            heapq.heappush(self.delayed, (time.time() + delay, message.id,
+                message))
+            self.condition.notify_all()
+
+
+    def get(self, lanes=None, timeout=None, worker=None, carrier=None):
+        """
+        Wait for the next message for a worker serving lanes (all by default).
+        Returns None on timeout.
+        """
+
+        # Only workers serving every lane can take any message of carrier
+        idle = 0 if lanes else 1
+        lanes = [lane for lane in self.lanes if not lanes or lane in lanes]
+        deadline = None if timeout is None else time.time() + timeout
+        weight = self.weights.get(worker, 1.)
+
+        with self.condition:
+            deferred = self._defer(lanes, worker, weight)
+            message = None if deferred else self._pop(lanes, worker, carrier)
+            self.idle[carrier] = self.idle.get(carrier, 0) + idle
+            if worker is not None:
+                self.waiting[worker] = weight
+            try:
+                while message is None:
+                    now = time.time()
+                    remaining = None if deadline is None else deadline - now
+                    if remaining is not None and remaining <= 0:
+                        return None
+                    if self.delayed:
+                        due = self.delayed[0][0] - now
+                        remaining = due if remaining is None else min(due,
+                            remaining)
+                    if deferred:
+                        remaining = YIELD_POLL if remaining is None else min(
+                            YIELD_POLL, remaining)
+                    self.condition.wait(max(remaining, 0.001)
+                        if remaining is not None else None)
+                    deferred = self._defer(lanes, worker, weight)
+                    if not deferred:
+                        message = self._pop(lanes, worker, carrier)
+            finally:
+                self.idle[carrier] -= idle
+                self.waiting.pop(worker, None)
+            if worker is not None:
+                self.deferred.pop(worker, None)
+
+        message.dispatched = time.time()
+        message.attempts += 1
+        self.stats[message.lane].add(message.dispatched - message.enqueued)
+        return message
+
+
+    def _defer(self, lanes, worker, weight):
+        """
+        Whether a worker of weight should leave the queued messages to the
+        stronger idle ones. Called with the condition held.
+        """
+
+        if weight >= 1. or worker is None:
+            return False
+        queued = sum(len(self.queues[lane]) for lane in lanes)
+        stronger = sum(1 for other in self.waiting.itervalues()
+            if other >= weight * YIELD_RATIO)
+        if not queued or stronger < queued:
+            self.deferred.pop(worker, None)
+            return False
+        since = self.deferred.setdefault(worker, time.time())
+        return time.time() - since < YIELD_MAX
+
+
+    def weigh(self, worker, weight):
+        """
+        Set the dispatch weight of worker, 1 for a modem in good shape.
+        """
+
+        with self.condition:
+            self.weights[worker] = weight
+
+
+    def _pop(self, lanes, worker=None, carrier=None):
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            message = heapq.heappop(self.delayed)[2]
+            self.queues[message.lane].appendleft(message)
+
+        waiting = [lane for lane in lanes if self.queues[lane]]
+        if not waiting:
+            return None
+
+        if len(waiting) > 1:
+            self.streak += 1
+            if self.streak > self.bulk_every:
+                waiting.insert(0, waiting.pop(1))
+                self.streak = 0
+        elif len(lanes) == len(self.lanes):
+            # Workers of some lanes only, like the reserved ones, can't tell
+            # whether a lower lane is waiting
+            self.streak = 0
+
+        for lane in waiting:
+            message = self.queues[lane].pop(worker, carrier, self.idle)
+            if message is not None:
+                return message
+
+
+    def done(self, message, result=None, error=None, worker=None):
+        """
+        Report the outcome of a dispatched message. Transient failures are
+        rescheduled according to the retry policy.
+        """
+
+        kind = self.policy.classify(result, error)
+        if kind != OK:
+            error = error or SendError(result, kind)
+            if self.policy.should_retry(message, kind):
+                delay = self.policy.delay(message.attempts)
+                debug("Retry %s in %.1fs: %s" % (message, delay, error))
+                if message.key is not None and self.on_retry:
+                    self.on_retry(message)
+                self.retry(message, delay, worker)
+                return kind
+
+        self.finish(message, result, error)
+        return kind
+
+
+    def finish(self, message, result=None, error=None):
+        """
+        Account a message as sent (error is None) or given up.
+        """
+
+        stats = self.stats[message.lane]
+        if error is None:
+            stats.sent += 1
+        else:
+            stats.failed += 1
+            debug("Send failed: %s %s" % (message, error))
+        if message.campaign is not None:
+            with self.condition:
+                counts = self.campaigns.get(message.campaign)
+                if counts:
+                    counts[1 if error is None else 2] += 1
+                    # Forgotten with its last message
+                    if counts[1] + counts[2] >= counts[0]:
+                        del self.campaigns[message.campaign]
+
+        if message.batch is not None:
+            message.batch.done(message, result, error)
+        elif self.on_done:
+            self.on_done(message, result, error)
+
+
+    def set_shares(self, shares):
+        """
+        Replace the campaign weights, queued messages included.
+        """
+
+        with self.condition:
+            self.shares.clear()
+            self.shares.update(shares)
+
+
+    def add_worker(self, name, gnokii, lanes=None, carrier=None, sim=None,
+        smscs=()):
+        """
+        Start a Worker thread sending through gnokii, a SIM of carrier
+        accounted in the quota as sim, balancing across its smscs numbers.
+        """
+
+        reserved = [worker for worker in self.workers.values()
+            if worker.lanes == self.lanes[:1]]
+        if lanes is None and len(reserved) < self.reserved:
+            lanes = self.lanes[:1]
+
+        worker = Worker(self, name, gnokii, lanes, carrier, sim, smscs)
+        self.workers[name] = worker
+        worker.start()
+        return worker
+
+
+    def remove_worker(self, name):
+        worker = self.workers.pop(name, None)
+        self.weights.pop(name, None)
+        if worker:
+            worker.stop()
+        return worker
+
+
+    def report(self):
+        """
+        Per lane queue depth and latency metrics.
+        """
+
+        report = {}
+        for lane in self.lanes:
+            report[lane] = self.stats[lane].report()
+            report[lane]["queued"] = len(self.queues[lane])
+        return report
+
+
+class Worker(Thread):
+    def __init__(self, scheduler, name, gnokii, lanes=None, carrier=None,
+        sim=None, smscs=()):
+        """
+        Pull messages from scheduler and send them through gnokii.
+        """
+
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self.scheduler = scheduler
+        self.gnokii = gnokii
+        self.lanes = lanes
+        self.carrier = carrier
+        self.sim = sim
+        self.breaker = CircuitBreaker(name, on_trip=self.dump)
+        self.smsc = SmscBalancer(name, smscs)
+        self.running = False
+        self.current = None
+        self.slot = scheduler.board.modem(name) if scheduler.board else None
+        self.polled = 0
+        self.idle = False
+        self.telemetry = Telemetry(name)
+        self.reassembler = Reassembler()
+
+
+    def run(self):
+        try:
+            self.loop()
+        except Exception:
+            self.dump("crash")
+            raise
+
+
+    def loop(self):
+        self.running = True
+        self.publish(IDLE)
+        while self.running:
+            if not self.breaker.allow():
+                self.publish(OPEN)
+                # Out of rotation, the queued work goes to the other modems
+                time.sleep(min(1., self.breaker.remaining()) or .1)
+                if self.breaker.state == HALF_OPEN:
+                    self.breaker.probe(self.gnokii)
+                continue
+
+            quota = self.scheduler.quota
+            if quota and self.sim and not quota.available(self.sim):
+                self.publish(QUOTA)
+                # Bundle exhausted, leave the rotation until it rolls over
+                time.sleep(QUOTA_PAUSE)
+                continue
+
+            self.poll_inbox()
+            self.sample_telemetry()
+            message = self.scheduler.get(self.lanes, timeout=1,
+                worker=self.name, carrier=self.carrier)
+            self.idle = message is None
+            if message is None:
+                continue
+
+            self.current = message
+            self.publish(SENDING, message.campaign)
+            if message.key is not None and self.scheduler.on_dispatch:
+                self.scheduler.on_dispatch(message)
+            options = message.options
+            smsc = None
+            if not (options.get("smsc") or options.get("smscno")):
+                smsc = self.smsc.choose()
+                if smsc:
+                    options = dict(options, smsc=smsc)
+            try:
+                result = self.gnokii.sendsms(message.text, message.destination,
+                    **options)
+            except Exception, error:
+                # Given up as permanent, a bad message must not end the worker
+                kind = self.scheduler.done(message, error=error,
+                    worker=self.name)
+            else:
+                kind = self.scheduler.done(message, result, worker=self.name)
+            self.current = None
+
+            if kind == OK:
+                self.smsc.success(smsc)
+                self.breaker.success()
+                if quota and self.sim:
+                    quota.add(self.sim, segments(message.text))
+            elif kind != PERMANENT:
+                self.smsc.failure(smsc)
+                self.breaker.failure()
+            self.publish(IDLE if kind == OK else ERROR, sent=kind == OK)
+        self.publish(STOPPED)
+
+
+    def dump(self, reason="trip"):
+        """
+        Write the flight recorder of the modem, returns the path.
+        """
+
+        recorder = getattr(self.gnokii, "recorder", None)
+        if recorder is not None:
+            path = recorder.dump(reason)
+            debug("Flight recorder of %s: %s" % (self.name, path))
+            return path
+
+
+    def poll_inbox(self):
+        """
+        Read the received messages every INBOX_EVERY seconds while idle, or
+        INBOX_MAX seconds at most when busy, and hand them to the inbound
+        handler once whole. The slots handed on are then deleted in ranges.
+        """
+
+        inbound = self.scheduler.inbound
+        elapsed = time.time() - self.polled
+        # Drained even without keyword rules, a full SIM stops receiving
+        if not inbound or elapsed < INBOX_EVERY:
+            return
+        if not self.idle and elapsed < INBOX_MAX:
+            return
+
+        self.polled = time.time()
+        try:
+            output = self.gnokii.getsms(INBOX, 1, "end")
+        except (IOError, OSError), error:
+            debug("Inbox of %s: %s" % (self.name, error))
+            return
+        for message in self.reassembler.feed(parse_sms(output)):
+            inbound.handle(message, self.name)
+
+        for start, end in ranges(self.reassembler.consumed):
+            try:
+                self.gnokii.deletesms(INBOX, start, end)
+            except (IOError, OSError), error:
+                # Still consumed, retried on the next poll
+                debug("Inbox of %s: %s" % (self.name, error))
+                continue
+            self.reassembler.deleted(xrange(start, end + 1))
+
+
+    def sample_telemetry(self):
+        """
+        Refresh the radio readings of the modem when due and pass the
+        resulting weight to the scheduler.
+        """
+
+        if self.telemetry.due(self.idle):
+            weight = self.telemetry.sample(self.gnokii)
+            if weight != self.scheduler.weights.get(self.name, 1.):
+                debug("Weight of %s: %.2f" % (self.name, weight))
+            self.scheduler.weigh(self.name, weight)
+
+
+    def publish(self, state, campaign=None, sent=None):
+        """
+        Update the status board slot of this worker, sent tells whether a
+        send just finished well (True) or badly (False).
+        """
+
+        if self.slot is None:
+            return
+        if sent is not None:
+            if sent:
+                self.slot.sent += 1
+            else:
+                self.slot.failed += 1
+        self.slot.publish(state, campaign)
+
+
+    def stop(self):
+        self.running = False
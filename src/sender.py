@@ -1,9 +1,512 @@
 #!/usr/bin/env python
 #-*- coding: UTF-8 -*-
-import gammu
 
-def main():
-    pass
+from debug import debug
+from flightrecorder import FlightRecorder, COMMAND, OUTPUT, EVENT
+from retry import SendError, TRANSIENT, PERMANENT
+from threading import Lock
+import json
+import optparse
+import re
+import sys
+import time
+
+"""
+    python-gammu backend, a drop in for gnokii.Gnokii on modems where the
+    gnokii shell is unstable.
+
+    Every device keeps one connected gammu.StateMachine in a pool (POOL)
+    that survives restarts of the Gammu objects using it. Messages are split
+    with gammu.EncodeSMS and sent part by part with SendSMS, nothing is
+    parsed from a text shell. The operations smsd drives (identify,
+    getsecuritycodestatus, getsmsc, monitor, sendsms, getsms, deletesms)
+    return the same text gnokii prints, so parse_fields, parse_smsc,
+    parse_monitor, parse_sms and the retry policy work unchanged. Other
+    commands raise NotImplementedError.
+
+    Gammu calls block in process: timeouts are the ones of gammu itself, a
+    timed out connection is dropped from the pool and opened again on the
+    next call. The sessions can't be handed over (see handover), the new
+    master opens them again.
+
+    Run as a script it benchmarks both backends on a modem:
+
+        python sender.py -d /dev/ttyUSB0 -n 50 -o identify > bench.jsonl
+"""
+
+CONNECTIONS = {"serial": "at19200"}
+SETTING_RE = re.compile(r"^\s*(\w+)\s*=\s*(.*?)\s*$", re.M)
+MAX_SMSC = 5
+# Errors of the message itself, retrying it elsewhere won't help
+PERMANENT_ERRORS = ("ERR_NOTSUPPORTED", "ERR_NOTIMPLEMENTED",
+    "ERR_INVALIDDATA", "ERR_INVALIDLOCATION")
+# Errors of the link, the connection is opened again
+LINK_ERRORS = ("ERR_TIMEOUT", "ERR_NOTCONNECTED", "ERR_DEVICEOPENERROR",
+    "ERR_DEVICEWRITEERROR", "ERR_DEVICEREADERROR", "ERR_DEVICENOTEXIST",
+    "ERR_DEVICEBUSY", "ERR_DEVICENOPERMISSION")
+EMPTY_ERRORS = ("ERR_EMPTY", "ERR_INVALIDLOCATION")
+STATUS = {"UnRead": "Unread", "Read": "Read", "Sent": "Sent",
+    "UnSent": "Not sent"}
+
+gammu = None
+
+
+def import_gammu():
+    """
+    python-gammu is optional and only imported when a Gammu backend is
+    created, so it costs nothing to the modems on gnokii. Raises ImportError
+    if it is not installed.
+    """
+
+    global gammu
+    if gammu is None:
+        import gammu
+    return gammu
+
+
+def read_config(path):
+    """
+    port and connection of a gnokii config file, see devicemonitor.
+    """
+
+    with open(path) as file:
+        return dict(SETTING_RE.findall(file.read()))
+
+
+def error_name(error):
+    return type(error).__name__
+
+
+class StateMachinePool(object):
+    def __init__(self):
+        """
+        Connected gammu.StateMachine per device, each with its own lock as
+        gammu serves one request at a time.
+        """
+
+        self.machines = {}
+        self.connecting = {}
+        self.lock = Lock()
+
+
+    def __contains__(self, device):
+        return device in self.machines
+
+
+    def acquire(self, device, connection):
+        """
+        Returns (machine, lock) of device, connecting it if needed. Only the
+        callers of the same device wait for its connection.
+        """
+
+        with self.lock:
+            entry = self.machines.get(device)
+            if entry is not None:
+                return entry
+            connecting = self.connecting.setdefault(device, Lock())
+
+        with connecting:
+            with self.lock:
+                entry = self.machines.get(device)
+            if entry is None:
+                # Init takes seconds, the pool lock is not held meanwhile
+                machine = gammu.StateMachine()
+                machine.SetConfig(0, {"Device": device,
+                    "Connection": connection})
+                machine.Init()
+                with self.lock:
+                    entry = self.machines[device] = (machine, Lock())
+            return entry
+
+
+    def release(self, device):
+        with self.lock:
+            entry = self.machines.pop(device, None)
+        if entry is not None:
+            machine, lock = entry
+            with lock:
+                try:
+                    machine.Terminate()
+                except gammu.GSMError:
+                    pass
+
+
+POOL = StateMachinePool()
+
+
+class Gammu(object):
+    def __init__(self, config, pool=None):
+        """
+        :config: gnokii config file of the modem, its port and connection
+            are used.
+        :pool: StateMachinePool, the module POOL by default.
+        """
+
+        import_gammu()
+        self.config = config
+        self.pool = POOL if pool is None else pool
+        self.recorder = FlightRecorder(config)
+        self.device = None
+        self.connection = None
+
+
+    def is_alive(self):
+        return self.device is not None and self.device in self.pool
+
+
+    def start(self):
+        """
+        Connect to the modem unless connected, returns True if successful.
+        """
+
+        if self.is_alive():
+            return False
+        settings = read_config(self.config)
+        self.device = settings["port"]
+        connection = settings.get("connection", "serial")
+        self.connection = CONNECTIONS.get(connection, connection)
+        self.call("Init")
+        return self.is_alive()
+
+
+    def stop(self):
+        if self.is_alive():
+            self.pool.release(self.device)
+            return True
+        return False
+
+
+    def restart(self):
+        self.stop()
+        return self.start()
+
+
+    def detach(self):
+        """
+        Sessions can't be handed over: disconnects and returns None.
+        """
+
+        self.stop()
+        return None
+
+
+    def call(self, name, *args, **kwargs):
+        """
+        Run a StateMachine method. gammu errors are raised as SendError,
+        PERMANENT for the ones of the request, TRANSIENT otherwise.
+        """
+
+        self.recorder.record(COMMAND, "%s %r %r" % (name, args, kwargs))
+        try:
+            machine, lock = self.pool.acquire(self.device, self.connection)
+            with lock:
+                result = None if name == "Init" else getattr(machine,
+                    name)(*args, **kwargs)
+        except gammu.GSMError, error:
+            kind = PERMANENT if error_name(error) in PERMANENT_ERRORS \
+                else TRANSIENT
+            self.recorder.record(EVENT, "%s: %s" % (error_name(error), error))
+            if error_name(error) in LINK_ERRORS:
+                self.recorder.dump(error_name(error))
+                self.pool.release(self.device)
+            raise SendError("%s %s" % (name, error_name(error)), kind)
+        self.recorder.record(OUTPUT, "%r" % (result,))
+        return result
+
+
+    def command(self, name, *args):
+        name = name.lstrip("-")
+        method = getattr(self, name, None)
+        if method is None or name.startswith("_") or name in ("call",
+            "command"):
+            raise NotImplementedError("%s is not supported by gammu" % name)
+        return method(*args)
+
+
+    def version(self):
+        return "gammu %s, python-gammu %s\n" % (gammu.Version()[1],
+            gammu.Version()[0])
+
+
+    def identify(self):
+        """
+        IMEI, manufacturer, model, revision and IMSI, as gnokii prints them.
+        """
+
+        lines = [
+            "IMEI         : %s" % self.call("GetIMEI"),
+            "Manufacturer : %s" % self.call("GetManufacturer"),
+            "Model        : %s" % self.call("GetModel")[0],
+            "Revision     : %s" % self.call("GetFirmware")[0],
+        ]
+        try:
+            lines.append("IMSI         : %s" % self.call("GetSIMIMSI"))
+        except SendError:
+            pass
+        return "\n".join(lines) + "\n"
+
+
+    def getsecuritycodestatus(self):
+        status = self.call("GetSecurityStatus")
+        return "Security code status: %s\n" % (status or "nothing to enter.")
+
+
+    def entersecuritycode(self, type, code):
+        assert type in ('PIN', 'PIN2', 'PUK', 'PUK2', 'SEC')
+
+        self.call("EnterSecurityCode", type, code)
+        return "Code ok.\n"
+
+
+    def reset(self, hard=False):
+        self.call("Reset", hard)
+        return ""
+
+
+    def getsmsc(self, start_number=None, end_number=None, raw=False):
+        """
+        The message centers from start_number to end_number, all by default,
+        raw is the format of setsmsc.
+        """
+
+        assert start_number or not end_number
+
+        start = int(start_number or 1)
+        end = int(end_number or start_number or MAX_SMSC)
+        lines = []
+        for location in xrange(start, end + 1):
+            try:
+                center = self.call("GetSMSC", Location=location)
+            except SendError, error:
+                if not start_number and any(name in "%s" % error
+                    for name in EMPTY_ERRORS):
+                    break
+                raise
+            if raw:
+                lines.append("%d;%s;0;0;%s;0;%s;0;%s" % (location,
+                    center.get("Name", ""), center.get("Validity", ""),
+                    center.get("Number", ""), center.get("DefaultNumber",
+                    "")))
+            else:
+                lines.append("No. %d: \"%s\"\nSMS center number is %s" % (
+                    location, center.get("Name", ""), center.get("Number")))
+        return "\n".join(lines) + "\n"
+
+
+    def monitor(self):
+        """
+        Signal, battery, power source and network, as gnokii prints them.
+        """
+
+        lines = []
+        signal = self.call("GetSignalQuality")
+        if signal.get("SignalPercent", -1) >= 0:
+            lines.append("RFLevel: %d %%" % signal["SignalPercent"])
+        try:
+            battery = self.call("GetBatteryCharge")
+        except SendError:
+            pass
+        else:
+            lines.append("Battery: %s" % battery.get("BatteryPercent", ""))
+            lines.append("Power Source: %s" % ("battery" if battery.get(
+                "ChargeState") == "BatteryPowered" else "AC"))
+        network = self.call("GetNetworkInfo")
+        if network.get("State") in ("HomeNetwork", "RoamingNetwork"):
+            lines.append("Network: %s" % (network.get("NetworkName") or
+                network.get("NetworkCode")))
+        else:
+            lines.append("Network: none")
+        return "\n".join(lines) + "\n"
+
+
+    def sendsms(self, message, destination, smsc=None, smscno=None,
+        report=False, use8bits=False, clase=None, validity=None, imelody=False,
+        animation=None, concat=None, wappush=None):
+        """
+        Same arguments as Gnokii.sendsms. Long texts are sent as linked
+        messages, imelody, animation, concat and wappush are not supported.
+        """
+
+        if imelody or animation or concat or wappush:
+            raise SendError("Option not supported by gammu", PERMANENT)
+
+        if isinstance(message, str):
+            message = message.decode("utf-8", "replace")
+        info = {"Class": int(clase) if clase else -1, "Unicode": False,
+            "Entries": [{"ID": "ConcatenatedAutoTextLong", "Buffer":
+            message}]}
+        if use8bits:
+            info["Entries"][0]["ID"] = "ConcatenatedTextLong"
+        parts = gammu.EncodeSMS(info)
+
+        references = []
+        for part in parts:
+            part["Number"] = destination
+            part["SMSC"] = {"Number": smsc} if smsc else {"Location":
+                int(smscno or 1)}
+            if report:
+                part["Type"] = "Status_Report"
+            if validity:
+                part["SMSC"]["Validity"] = "%sM" % validity
+            references.append("%s" % self.call("SendSMS", part))
+        return "Send succeeded with reference %s!\n" % ", ".join(references)
+
+
+    def _messages(self, memory_type, start, end=""):
+        """
+        SMS dicts stored in memory_type from location start to end ("end"
+        for all the following, only start by default).
+        """
+
+        start = int(start)
+        end = None if end == "end" else int(end or start)
+        try:
+            found = self.call("GetNextSMS", Start=True, Folder=0)
+            while True:
+                sms = found[0]
+                if sms.get("Memory", memory_type) == memory_type and (
+                    start <= sms["Location"] and (end is None or
+                    sms["Location"] <= end)):
+                    yield sms
+                found = self.call("GetNextSMS", Location=sms["Location"],
+                    Folder=0)
+        except SendError, error:
+            if not any(name in "%s" % error for name in EMPTY_ERRORS):
+                raise
+
+
+    def getsms(self, memory_type, start, end="", file="", append=True,
+        delete=False):
+        """
+        Same arguments as Gnokii.getsms, file is not supported.
+        """
+
+        if file:
+            raise SendError("Option not supported by gammu", PERMANENT)
+
+        output = []
+        for sms in list(self._messages(memory_type, start, end)):
+            lines = ["%d. Inbox Message (%s)" % (sms["Location"], STATUS.get(
+                sms.get("State"), sms.get("State"))),
+                "Date/time: %s" % sms.get("DateTime"),
+                "Sender: %s Msg Center: %s" % (sms.get("Number"),
+                sms.get("SMSC", {}).get("Number"))]
+            udh = sms.get("UDH") or {}
+            if udh.get("AllParts", -1) > 1:
+                reference = udh.get("ID16bit", -1)
+                if reference < 0:
+                    reference = udh.get("ID8bit", -1)
+                lines.append("Linked (%d/%d), reference %d:" % (
+                    udh["PartNumber"], udh["AllParts"], reference))
+            text = sms.get("Text") or u""
+            lines += ["Text:", text.encode("utf-8")]
+            output.append("\n".join(lines) + "\n")
+            if delete:
+                self.call("DeleteSMS", Folder=0, Location=sms["Location"])
+        return "\n".join(output)
+
+
+    def deletesms(self, memory_type, start, end=""):
+        deleted = 0
+        for sms in list(self._messages(memory_type, start, end)):
+            self.call("DeleteSMS", Folder=0, Location=sms["Location"])
+            deleted += 1
+        return "Deleted %d SMS.\n" % deleted
+
+
+def benchmark(server, operation, count, args, output):
+    """
+    Run operation count times through server writing a record per run, as
+    gnokii batch does (see simulator.load_timings). Returns the elapsed
+    times of the runs that succeeded.
+    """
+
+    elapsed = []
+    for number in xrange(count):
+        record = {"modem": server.config, "backend": type(server).__name__,
+            "command": operation, "args": args}
+        start = time.time()
+        try:
+            record["result"] = server.command(operation, *args)
+            elapsed.append(time.time() - start)
+        except (IOError, OSError), error:
+            record["error"] = "%s: %s" % (type(error).__name__, error)
+        record["elapsed"] = round(time.time() - start, 3)
+        output.write(json.dumps(record) + "\n")
+    return elapsed
+
+
+def summary(name, elapsed, count):
+    if not elapsed:
+        return "%-6s no run succeeded out of %d" % (name, count)
+    elapsed = sorted(elapsed)
+    return "%-6s ok %d/%d, mean %.3fs, p50 %.3fs, p99 %.3fs" % (name,
+        len(elapsed), count, sum(elapsed) / len(elapsed),
+        elapsed[len(elapsed) // 2], elapsed[min(len(elapsed) - 1,
+        int(len(elapsed) * .99))])
+
+
+def get_options():
+    # Instance the parser and define the usage message
+    optparser = optparse.OptionParser(usage="""
+    %prog -d device [-m model] [-n count] [-o operation] [args]...
+
+    Runs an operation count times through gnokii and then gammu on the same
+    modem. Records go to stdout as json lines, the summary to stderr.
+
+        %prog -d /dev/ttyUSB0 -o sendsms "benchmark" 3875123456
+    """, version="%prog .1")
+
+    # Define the options and the actions of each one
+    optparser.add_option("-d", "--device", dest="device",
+        help="Serial device of the modem")
+    optparser.add_option("-m", "--model", dest="model",
+        help="gnokii model of the modem")
+    optparser.add_option("-c", "--connection", dest="connection",
+        help="gnokii connection of the modem")
+    optparser.add_option("-n", "--count", type="int", dest="count",
+        help="Runs per backend")
+    optparser.add_option("-o", "--operation", dest="operation",
+        help="Operation to time, identify by default")
+
+    # Define the default options
+    optparser.set_defaults(model="AT", connection="serial", count=20,
+        operation="identify")
+
+    # Process the options
+    options, args = optparser.parse_args()
+    if not options.device:
+        optparser.error("a device is needed")
+    return options, args
+
+
+def main(options, args):
+    from devicemonitor import make_config_file, get_conf_name
+    from gnokii import Gnokii
+
+    make_config_file(options.device, options.model, options.connection)
+    config = get_conf_name(options.device)
+    results = []
+    for backend in (Gnokii, Gammu):
+        try:
+            server = backend(config)
+            server.start()
+        except (ImportError, IOError, OSError), error:
+            debug("%s: %s" % (backend.__name__, error))
+            continue
+        try:
+            elapsed = benchmark(server, options.operation, options.count,
+                args, sys.stdout)
+        finally:
+            # Both can't hold the port at once
+            server.stop()
+        results.append(summary(backend.__name__, elapsed, options.count))
+
+    for line in results:
+        sys.stderr.write(line + "\n")
+    return 0 if results else 1
+
 
 if __name__ == "__main__":
-    exit(main())
+    options, args = get_options()
+    exit(main(options, args))
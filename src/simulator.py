@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from bisect import bisect
+import heapq
+import json
+import math
+import optparse
+import random
+
+"""
+    Discrete event capacity simulator for campaign planning.
+
+    Models a fleet of modems pulling from one queue. Every SMS segment takes
+    a send time drawn from the timings measured on real sends (the json lines
+    written by gnokii.py batch mode, or any records with "elapsed" and an
+    optional "error") and fails with the measured probability. Failed
+    segments are retried up to ATTEMPTS times. A modem that reaches its daily
+    quota waits until the next simulated day.
+
+    Only one heap operation per segment, millions of messages take seconds.
+"""
+
+ATTEMPTS = 5
+DAY = 86400.
+MIX = "1:1"
+
+
+def load_timings(path):
+    """
+    Returns the (latencies, failure rate) of the sendsms records in path.
+    """
+
+    latencies = []
+    failures = 0
+    with open(path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("command", "sendsms").lstrip("-") != "sendsms":
+                continue
+            if "elapsed" not in record:
+                continue
+            latencies.append(float(record["elapsed"]))
+            result = record.get("result") or ""
+            if record.get("error") or "failed" in result.lower():
+                failures += 1
+
+    if not latencies:
+        raise ValueError("No sendsms timings in %s" % path)
+    return latencies, failures / float(len(latencies))
+
+
+def lognormal_timings(mean, deviation, samples=10000, seed=None):
+    """
+    Latencies drawn from a lognormal with the given mean and deviation, for
+    when there are no measures yet.
+    """
+
+    rng = random.Random(seed)
+    sigma = math.sqrt(math.log(1 + (deviation / mean) ** 2))
+    mu = math.log(mean) - sigma ** 2 / 2
+    return [rng.lognormvariate(mu, sigma) for i in xrange(samples)]
+
+
+def parse_mix(mix):
+    """
+    "1:0.8,2:0.15,3:0.05" (segments:share) to a cumulative table.
+    """
+
+    pairs = [item.split(":") for item in mix.split(",")]
+    total = sum(float(share) for segments, share in pairs)
+    cumulative = []
+    acc = 0.
+    for segments, share in pairs:
+        acc += float(share) / total
+        cumulative.append((acc, int(segments)))
+    return [acc for acc, segments in cumulative], [segments for acc, segments
+        in cumulative]
+
+
+class Simulator(object):
+    def __init__(self, latencies, failure=0., modems=1, quota=None,
+        throttle=0., attempts=ATTEMPTS, mix=MIX, seed=None):
+        """
+        :latencies: measured send times, seconds.
+        :failure: probability of a send failing.
+        :quota: segments per modem and day, None for no limit.
+        :throttle: minimum seconds between sends of a modem.
+        :mix: share of messages by number of segments.
+        """
+
+        self.latencies = latencies
+        self.failure = failure
+        self.modems = modems
+        self.quota = quota
+        self.throttle = throttle
+        self.attempts = attempts
+        self.mix = parse_mix(mix)
+        self.seed = seed
+
+
+    def run(self, messages, deadline=None, modems=None):
+        """
+        Simulates sending messages, returns a report dict. deadline (seconds)
+        only adds how many messages were done by then.
+        """
+
+        modems = modems or self.modems
+        rng = random.Random(self.seed)
+        rand = rng.random
+        latencies = self.latencies
+        count = len(latencies)
+        failure = self.failure
+        throttle = self.throttle
+        quota = self.quota
+        attempts = self.attempts
+        shares, sizes = self.mix
+
+        free = [(0., modem) for modem in xrange(modems)]
+        sent = [0] * modems
+        day = [0] * modems
+        failed = segments = sends = by_deadline = 0
+        finish = 0.
+
+        for index in xrange(messages):
+            parts = sizes[bisect(shares, rand())] if len(sizes) > 1 else (
+                sizes[0])
+            lost = False
+            for part in xrange(parts):
+                attempt = 0
+                while attempt < attempts:
+                    now, modem = free[0]
+                    if quota is not None:
+                        today = int(now // DAY)
+                        if day[modem] != today:
+                            day[modem], sent[modem] = today, 0
+                        if sent[modem] >= quota:
+                            # Out of quota, back with the next day
+                            heapq.heapreplace(free, ((today + 1) * DAY, modem))
+                            continue
+                        sent[modem] += 1
+                    done = now + latencies[int(rand() * count)]
+                    heapq.heapreplace(free, (done + throttle, modem))
+                    sends += 1
+                    attempt += 1
+                    if rand() >= failure:
+                        break
+                else:
+                    lost = True
+                segments += 1
+                if done > finish:
+                    finish = done
+
+            if lost:
+                failed += 1
+            elif deadline is not None and done <= deadline:
+                by_deadline += 1
+
+        return {
+            "messages": messages,
+            "segments": segments,
+            "sends": sends,
+            "modems": modems,
+            "eta": finish,
+            "failed": failed,
+            "by_deadline": by_deadline if deadline is not None else None,
+        }
+
+
+    def modems_for(self, messages, deadline, report=None):
+        """
+        Smallest fleet meeting deadline, starting from an estimate scaled from
+        a run with the current fleet. Raises ValueError when no fleet does:
+        the deadline is shorter than a send, or a modem per send isn't
+        enough.
+        """
+
+        if deadline < min(self.latencies):
+            raise ValueError("The deadline is shorter than any send")
+        report = report or self.run(messages)
+        if report["eta"] <= deadline:
+            return self.modems
+
+        # More modems than sends would stay idle
+        most = max(1, messages * max(self.mix[1]) * self.attempts)
+        modems = min(most, int(math.ceil(self.modems * report["eta"] /
+            deadline)))
+        while self.run(messages, modems=modems)["eta"] > deadline:
+            if modems >= most:
+                raise ValueError("No fleet meets the deadline")
+            modems = min(most, int(math.ceil(modems * 1.05)) + 1)
+        return modems
+
+
+def get_options():
+    # Instance the parser and define the usage message
+    optparser = optparse.OptionParser(usage="""
+    %prog [options] messages
+    """, version="%prog .1")
+
+    # Define the options and the actions of each one
+    optparser.add_option("-n", "--modems", type="int", dest="modems",
+        help="Modems in the fleet")
+    optparser.add_option("-t", "--timings", dest="timings",
+        help="Json lines with measured sendsms elapsed times")
+    optparser.add_option("--mean", type="float", dest="mean",
+        help="Mean send time when there are no timings")
+    optparser.add_option("--deviation", type="float", dest="deviation",
+        help="Send time deviation when there are no timings")
+    optparser.add_option("-f", "--failure", type="float", dest="failure",
+        help="Failure probability, overrides the measured one")
+    optparser.add_option("-q", "--quota", type="int", dest="quota",
+        help="Segments per modem and day")
+    optparser.add_option("--throttle", type="float", dest="throttle",
+        help="Minimum seconds between sends of a modem")
+    optparser.add_option("-m", "--mix", dest="mix",
+        help="Segments mix, like 1:0.8,2:0.2")
+    optparser.add_option("-d", "--deadline", type="float", dest="deadline",
+        help="Deadline in hours")
+    optparser.add_option("-s", "--seed", type="int", dest="seed",
+        help="Random seed")
+
+    # Define the default options
+    optparser.set_defaults(modems=1, mean=6., deviation=2., throttle=0.,
+        mix=MIX)
+
+    # Process the options
+    options, args = optparser.parse_args()
+    if len(args) != 1:
+        optparser.error("the number of messages is needed")
+    return options, args
+
+
+def main(options, args):
+    messages = int(args[0])
+    if options.timings:
+        latencies, failure = load_timings(options.timings)
+    else:
+        latencies = lognormal_timings(options.mean, options.deviation,
+            seed=options.seed)
+        failure = 0.
+    if options.failure is not None:
+        failure = options.failure
+
+    simulator = Simulator(latencies, failure, options.modems, options.quota,
+        options.throttle, mix=options.mix, seed=options.seed)
+    deadline = options.deadline * 3600 if options.deadline else None
+    report = simulator.run(messages, deadline)
+
+    print("ETA: %.2f hours for %d messages (%d segments, %d sends) on %d "
+        "modems" % (report["eta"] / 3600, messages, report["segments"],
+        report["sends"], report["modems"]))
+    print("Expected failures: %d (%.2f%%)" % (report["failed"],
+        100. * report["failed"] / max(messages, 1)))
+    if deadline:
+        print("Done by the deadline: %d" % report["by_deadline"])
+        try:
+            needed = simulator.modems_for(messages, deadline, report)
+        except ValueError, error:
+            print("Modems to meet the deadline: none, %s" % error)
+        else:
+            print("Modems to meet the deadline: %d (%+d)" % (needed,
+                needed - options.modems))
+    return 0
+
+
+if __name__ == "__main__":
+    options, args = get_options()
+    exit(main(options, args))
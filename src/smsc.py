@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from debug import debug
+import time
+
+"""
+    Spread the sends of a SIM across its message centers.
+
+    The SMSC entries of every SIM are read once when the modem comes up
+    (getsmsc --raw, see gnokii.parse_smsc) and kept in its profile. A worker
+    with more than one center hands them out in turn. A center that fails
+    THRESHOLD sends in a row (timeouts, congestion) is benched for COOLDOWN
+    seconds and the others take its share. If every center is benched the
+    one back the soonest is used. With a single center or none the phone
+    default (memory location 1) is left alone.
+"""
+
+THRESHOLD = 2
+COOLDOWN = 300.
+
+
+class SmscBalancer(object):
+    def __init__(self, name, numbers, threshold=THRESHOLD,
+        cooldown=COOLDOWN):
+        """
+        :numbers: message center numbers of the SIM.
+        :threshold: consecutive failures that bench a center.
+        :cooldown: seconds a benched center is skipped.
+        """
+
+        self.name = name
+        self.numbers = list(numbers)
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = dict.fromkeys(self.numbers, 0)
+        self.benched = dict.fromkeys(self.numbers, 0.)
+        self.next = 0
+
+
+    def choose(self):
+        """
+        Number to send the next message through, None for the phone default.
+        """
+
+        numbers = self.numbers
+        if len(numbers) < 2:
+            return None
+
+        now = time.time()
+        for step in xrange(len(numbers)):
+            index = (self.next + step) % len(numbers)
+            if self.benched[numbers[index]] <= now:
+                self.next = index + 1
+                return numbers[index]
+        return min(numbers, key=self.benched.get)
+
+
+    def success(self, number):
+        if number in self.failures:
+            self.failures[number] = 0
+
+
+    def failure(self, number):
+        if number not in self.failures:
+            return
+        self.failures[number] += 1
+        if self.failures[number] >= self.threshold:
+            debug("SMSC %s of %s benched for %.0fs" % (number, self.name,
+                self.cooldown))
+            self.failures[number] = 0
+            self.benched[number] = time.time() + self.cooldown
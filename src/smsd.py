@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+import time
+START = time.time()
+
+from client import SOCKET, submit
+from debug import mark, report_timings
+from statusboard import STATUS, StatusBoard
+import optparse
+import socket
+import sys
+
+mark("imports", START)
+
+"""
+    Command line front end for a running metaserver. Talks to its submission
+    socket only, it never touches the modems, so it starts in a few
+    milliseconds.
+
+        smsd send 3874980340 "hola" [--lane otp] [--campaign promo]
+            [--at "2024-05-01 09:00"] [--window 09:00-21:00] [--key order-81]
+        smsd status 12 13
+        smsd top
+        smsd profile [seconds]
+        smsd dump [modem]
+
+    top reads the shared memory status board instead of the socket.
+"""
+
+
+def cmd_send(options, args):
+    destination, text = args
+    at = time.mktime(time.strptime(options.at, "%Y-%m-%d %H:%M")) if (
+        options.at) else None
+    reply, = submit([{"destination": destination, "text": text, "lane":
+        options.lane, "campaign": options.campaign, "at": at, "window":
+        options.window, "key": options.key}], options.socket)
+    print(reply.get("id", reply))
+    return 0 if "id" in reply else 1
+
+
+def cmd_status(options, args):
+    replies = submit([{"op": "status", "id": int(id)} for id in args],
+        options.socket)
+    for reply in replies:
+        print("%s %s" % (reply.get("id"), reply.get("status", reply)))
+    return 0
+
+
+def cmd_profile(options, args):
+    request = {"op": "profile"}
+    if args and args[0] == "stop":
+        request["stop"] = True
+    elif args:
+        request["seconds"] = float(args[0])
+    reply, = submit([request], options.socket)
+    print(reply.get("path", reply))
+    return 0 if "path" in reply else 1
+
+
+def cmd_dump(options, args):
+    reply, = submit([{"op": "dump", "modem": args[0] if args else None}],
+        options.socket)
+    for modem, path in sorted(reply.get("paths", {}).items()):
+        print("%s %s" % (modem, path))
+    return 0 if "paths" in reply else 1
+
+
+def rate(current, previous, elapsed):
+    if previous is None or elapsed <= 0:
+        return None
+    return (current - previous) * 60. / elapsed
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "-"
+    return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60,
+        seconds % 60)
+
+
+def render(board, previous, elapsed):
+    """
+    One screen of the board, returns it with the counters to compute the
+    rates of the next one.
+    """
+
+    header = board.header()
+    counters = {}
+    lines = ["smsd up %s, updated %.1fs ago" % (format_eta(time.time() -
+        header["started"]), time.time() - header["updated"]), "",
+        "%-24s %-8s %-16s %8s %8s %8s" % ("MODEM", "STATE", "CAMPAIGN",
+        "SENT", "FAILED", "MSG/MIN")]
+
+    for name, state, campaign, sent, failed, updated in board.modems:
+        counters["modem", name] = sent
+        speed = rate(sent, previous.get(("modem", name)), elapsed)
+        lines.append("%-24s %-8s %-16s %8d %8d %8s" % (name[-24:], state,
+            campaign[-16:], sent, failed, "-" if speed is None else
+            "%.1f" % speed))
+
+    lines += ["", "%-24s %8s %8s %8s %8s" % ("LANE", "QUEUED", "SENT",
+        "FAILED", "P99")]
+    for name, queued, sent, failed, p99 in board.lanes:
+        lines.append("%-24s %8d %8d %8d %7.1fs" % (name, queued, sent,
+            failed, p99))
+
+    lines += ["", "%-24s %17s %6s %8s %9s" % ("CAMPAIGN", "DONE/TOTAL", "%",
+        "MSG/MIN", "ETA")]
+    for name, total, sent, failed in board.campaigns:
+        done = sent + failed
+        counters["campaign", name] = done
+        speed = rate(done, previous.get(("campaign", name)), elapsed)
+        eta = (total - done) * 60. / speed if speed else None
+        lines.append("%-24s %8d/%-8d %5.1f%% %8s %9s" % (name[-24:], done,
+            total, 100. * done / max(total, 1), "-" if speed is None else
+            "%.1f" % speed, "0:00:00" if done == total else format_eta(eta)))
+
+    return "\n".join(lines), counters
+
+
+def cmd_top(options, args):
+    try:
+        board = StatusBoard(options.board)
+    except (IOError, OSError, ValueError), error:
+        sys.stderr.write("Can't open %s: %s\n" % (options.board, error))
+        return 1
+
+    previous = {}
+    last = None
+    count = 0
+    try:
+        while True:
+            now = time.time()
+            screen, previous = render(board, previous, now - last if last
+                else 0)
+            last = now
+            sys.stdout.write("\x1b[H\x1b[2J" if options.count != 1 else "")
+            sys.stdout.write(screen + "\n")
+            sys.stdout.flush()
+            count += 1
+            if options.count and count >= options.count:
+                break
+            time.sleep(options.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+COMMANDS = {
+    "send": cmd_send,
+    "status": cmd_status,
+    "top": cmd_top,
+    "profile": cmd_profile,
+    "dump": cmd_dump,
+}
+
+
+def get_options():
+    # Instance the parser and define the usage message
+    optparser = optparse.OptionParser(usage="""
+    %prog [-s socket] [--timing] send destination text [-l lane]
+    %prog [-s socket] [--timing] status id...
+    %prog [-b board] [-i interval] [-n count] top
+    %prog [-s socket] profile [seconds|stop]
+    %prog [-s socket] dump [modem]
+    """, version="%prog .1")
+
+    # Define the options and the actions of each one
+    optparser.add_option("-s", "--socket", dest="socket",
+        help="Submission socket of the metaserver")
+    optparser.add_option("-l", "--lane", dest="lane",
+        help="Lane for send, otp or bulk")
+    optparser.add_option("-c", "--campaign", dest="campaign",
+        help="Campaign of the message for send")
+    optparser.add_option("-a", "--at", dest="at",
+        help="Send time for send, \"YYYY-MM-DD HH:MM\" local time")
+    optparser.add_option("-w", "--window", dest="window",
+        help="Delivery window for send, HH:MM-HH:MM local time")
+    optparser.add_option("-k", "--key", dest="key",
+        help="Idempotency key for send, repeated keys are sent once")
+    optparser.add_option("-b", "--board", dest="board",
+        help="Status board of the metaserver for top")
+    optparser.add_option("-i", "--interval", type="float", dest="interval",
+        help="Seconds between top refreshes")
+    optparser.add_option("-n", "--count", type="int", dest="count",
+        help="Refreshes before top exits, 0 for ever")
+    optparser.add_option("-t", "--timing", action="store_true", dest="timing",
+        help="Report import and run times on stderr")
+
+    # Define the default options
+    optparser.set_defaults(socket=SOCKET, lane=None, campaign=None, at=None,
+        window=None, key=None, board=STATUS, interval=1., count=0,
+        timing=False)
+
+    # Process the options
+    options, args = optparser.parse_args()
+    if not args or args[0] not in COMMANDS:
+        optparser.error("command must be one of %s" % ", ".join(COMMANDS))
+    return options, args
+
+
+def main(options, args):
+    try:
+        return COMMANDS[args[0]](options, args[1:])
+    except socket.error, error:
+        sys.stderr.write("Can't reach %s: %s\n" % (options.socket, error))
+        return 1
+    finally:
+        mark("total", START)
+        if options.timing:
+            report_timings()
+
+
+if __name__ == "__main__":
+    options, args = get_options()
+    exit(main(options, args))
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from debug import debug
+from scheduler import Message
+from threading import Lock
+import json
+import os
+
+"""
+    Durable message spool.
+
+    Append only journal of JSON lines. A message line carries the full message
+    and its id; a status line carries only id and status. Messages are
+    acknowledged only after the batch containing them was fsync'ed, status
+    updates are written right away but synced with the next batch. Every
+    COMPACT_EVERY messages sent or given up the journal is rewritten with
+    only the unfinished ones.
+
+    Messages with an idempotency key are marked dispatched right before the
+    modem gets them, and queued again when the send failed and is retried.
+    After a crash the ones still dispatched are not recovered, a message
+    that may have been sent already is never sent again (see idempotency). Their
+    submission time is kept so the key is not remembered longer after a
+    restart.
+"""
+
+QUEUED = "queued"
+DISPATCHED = "dispatched"
+SENT = "sent"
+FAILED = "failed"
+COMPACT_EVERY = 50000
+
+
+class Spool(object):
+    def __init__(self, path, compact_every=COMPACT_EVERY):
+        """
+        Open (or create) the journal at path and replay it.
+
+        :compact_every: messages sent or given up after which the journal
+            is rewritten without them.
+        """
+
+        self.path = path
+        self.compact_every = compact_every
+        self.lock = Lock()
+        self.status = {}
+        self.pending = {}
+        self.keys = {}
+        self.last_id = 0
+        self.finished = 0
+        self.replay()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        if self.finished >= compact_every:
+            self.compact()
+
+
+    def replay(self):
+        """
+        Rebuild statuses and pending messages from the journal.
+        """
+
+        if not os.path.exists(self.path):
+            return
+
+        # Dispatched messages, queued again if they went back to a retry
+        held = {}
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    debug("Spool: skipping truncated line")
+                    continue
+
+                id = record["id"]
+                self.last_id = max(self.last_id, id)
+                if record.get("mark"):
+                    continue
+                if record.get("key") is not None:
+                    self.keys[record["key"]] = (id, record.get("created"))
+                status = record.get("status", QUEUED)
+                self.status[id] = status
+                if "text" in record:
+                    self.pending[id] = record
+                elif status == QUEUED:
+                    if id in held:
+                        self.pending[id] = held.pop(id)
+                elif status == DISPATCHED:
+                    if id in self.pending:
+                        held[id] = self.pending.pop(id)
+                else:
+                    self.pending.pop(id, None)
+                    held.pop(id, None)
+
+        self.finished = sum(1 for status in self.status.itervalues()
+            if status in (SENT, FAILED))
+        debug("Spool: %d messages, %d pending" % (len(self.status),
+            len(self.pending)))
+
+
+    def append(self, records):
+        """
+        Assign ids to records (dicts with destination, text and optionally
+        lane, options, campaign, at, the send time, and key) and write them
+        durably. Returns the Messages.
+        """
+
+        messages = []
+        with self.lock:
+            lines = []
+            for record in records:
+                self.last_id += 1
+                message = Message(self.last_id, record["destination"],
+                    record["text"], record.get("lane"), record.get("options"),
+                    record.get("campaign"), record.get("at"),
+                    record.get("key"))
+                lines.append(self.dumps(message))
+                messages.append(message)
+
+            os.write(self.fd, "".join(lines))
+            os.fsync(self.fd)
+
+            for message in messages:
+                self.status[message.id] = QUEUED
+
+        return messages
+
+
+    def dumps(self, message):
+        return json.dumps({"id": message.id, "destination":
+            message.destination, "text": message.text, "lane": message.lane,
+            "options": message.options, "campaign": message.campaign, "at":
+            message.at, "key": message.key, "created": int(
+            message.enqueued)}) + "\n"
+
+
+    def update(self, id, status):
+        with self.lock:
+            self.status[id] = status
+            self.pending.pop(id, None)
+            os.write(self.fd, json.dumps({"id": id, "status": status}) + "\n")
+            if status in (SENT, FAILED):
+                self.finished += 1
+            compact = self.finished >= self.compact_every
+        if compact:
+            self.compact()
+
+
+    def done(self, message, result=None, error=None):
+        """
+        Scheduler.on_done callback.
+        """
+
+        return self.update(message.id, SENT if error is None else FAILED)
+
+
+    def dispatched(self, message):
+        """
+        Scheduler.on_dispatch callback.
+        """
+
+        return self.update(message.id, DISPATCHED)
+
+
+    def retrying(self, message):
+        """
+        Scheduler.on_retry callback, the send failed and the message waits
+        to be dispatched again.
+        """
+
+        return self.update(message.id, QUEUED)
+
+
+    def recover(self):
+        """
+        Messages still queued when the journal was last closed.
+        """
+
+        messages = [Message(id, record["destination"], record["text"],
+            record.get("lane"), record.get("options"), record.get("campaign"),
+            record.get("at"), record.get("key")) for id, record
+            in sorted(self.pending.items())]
+        self.pending = {}
+        return messages
+
+
+    def compact(self):
+        """
+        Rewrite the journal keeping only messages not yet sent, and forget
+        the status of the others.
+        """
+
+        with self.lock:
+            if self.finished < self.compact_every:
+                # Done by another thread meanwhile
+                return
+            pending = set(id for id, status in self.status.iteritems()
+                if status in (QUEUED, DISPATCHED))
+            records = {}
+            with open(self.path) as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "text" in record and record["id"] in pending:
+                        records[record["id"]] = line
+
+            tmp = "%s.tmp" % self.path
+            with open(tmp, "w") as file:
+                file.write(json.dumps({"id": self.last_id, "mark": True})
+                    + "\n")
+                file.writelines(records[id] for id in sorted(records))
+                file.writelines(json.dumps({"id": id, "status": DISPATCHED})
+                    + "\n" for id in sorted(records)
+                    if self.status[id] == DISPATCHED)
+                file.flush()
+                os.fsync(file.fileno())
+            os.rename(tmp, self.path)
+            os.close(self.fd)
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            self.status = dict((id, self.status[id]) for id in records)
+            self.finished = 0
+            debug("Spool: compacted to %d messages" % len(records))
+
+
+    def close(self):
+        os.fsync(self.fd)
+        os.close(self.fd)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from threading import Lock, Thread
+import mmap
+import os
+import struct
+import time
+
+"""
+    Live status board in shared memory.
+
+    A fixed layout file mapped by the metaserver: a header followed by arrays
+    of slots for modems, lanes and campaigns. Every slot has a single writer
+    (a modem slot belongs to its worker, lanes and campaigns to the Publisher
+    thread) and starts with a sequence number used as a seqlock: the writer
+    makes it odd, packs the values and makes it even again, readers retry
+    while it is odd or changed under them. Nobody ever takes a lock, so
+    readers like `smsd top` can't slow the workers down.
+
+    Slots only hold counters, rates and ETAs are derived by the reader from
+    two snapshots.
+"""
+
+STATUS = "/dev/shm/smsd.status" if os.path.isdir("/dev/shm") else (
+    "/tmp/smsd.status")
+MAGIC = "SMSB"
+VERSION = 1
+MODEMS = 64
+LANES = 4
+CAMPAIGNS = 32
+INTERVAL = 1.
+RETRIES = 100
+
+HEADER = struct.Struct("<4sIIIIdd")
+SEQ = struct.Struct("<I")
+MODEM = struct.Struct("<I32s8s32sQQd")
+LANE = struct.Struct("<I16sIQQd")
+CAMPAIGN = struct.Struct("<I32sQQQ")
+
+IDLE, SENDING, ERROR, OPEN, QUOTA, STOPPED = ("idle", "sending", "error",
+    "open", "quota", "stopped")
+CONTINUATION = "".join(chr(byte) for byte in xrange(0x80, 0xc0))
+
+
+def field(name, size=32):
+    """
+    The last size bytes of name utf-8 encoded, without a character cut in
+    half, to pack as a fixed size string.
+    """
+
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    name = "%s" % name
+    if len(name) <= size:
+        return name
+    return name[-size:].lstrip(CONTINUATION)
+
+
+class Section(object):
+    def __init__(self, mm, offset, layout, count):
+        """
+        count slots of the struct layout at offset of mm.
+        """
+
+        self.mm = mm
+        self.offset = offset
+        self.layout = layout
+        self.count = count
+        self.end = offset + layout.size * count
+
+
+    def write(self, index, *values):
+        offset = self.offset + self.layout.size * index
+        seq, = SEQ.unpack_from(self.mm, offset)
+        SEQ.pack_into(self.mm, offset, seq + 1)
+        self.layout.pack_into(self.mm, offset, seq + 1, *values)
+        SEQ.pack_into(self.mm, offset, seq + 2)
+
+
+    def read(self, index):
+        """
+        Consistent copy of the values of slot index, None if the writer kept
+        changing it.
+        """
+
+        offset = self.offset + self.layout.size * index
+        for retry in xrange(RETRIES):
+            values = self.layout.unpack_from(self.mm, offset)
+            seq, = SEQ.unpack_from(self.mm, offset)
+            if not values[0] & 1 and seq == values[0]:
+                return tuple(value.rstrip("\0") if isinstance(value, str)
+                    else value for value in values[1:])
+        return None
+
+
+    def __iter__(self):
+        for index in xrange(self.count):
+            values = self.read(index)
+            if values and values[0]:
+                yield values
+
+
+class StatusBoard(object):
+    def __init__(self, path=STATUS, create=False, modems=MODEMS, lanes=LANES,
+        campaigns=CAMPAIGNS):
+        """
+        Map the board at path. The metaserver creates it, readers open the
+        existing one read only and take the sizes from its header.
+        """
+
+        self.path = path
+        self.lock = Lock()
+        self.names = {}
+
+        if create:
+            size = HEADER.size + MODEM.size * modems + LANE.size * lanes + (
+                CAMPAIGN.size * campaigns)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, modems, lanes,
+                campaigns, time.time(), time.time())
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+            magic, version, modems, lanes, campaigns, started, updated = (
+                HEADER.unpack_from(self.mm, 0))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("%s is not a status board" % path)
+        os.close(fd)
+
+        self.modems = Section(self.mm, HEADER.size, MODEM, modems)
+        self.lanes = Section(self.mm, self.modems.end, LANE, lanes)
+        self.campaigns = Section(self.mm, self.lanes.end, CAMPAIGN, campaigns)
+
+
+    def header(self):
+        magic, version, modems, lanes, campaigns, started, updated = (
+            HEADER.unpack_from(self.mm, 0))
+        return {"started": started, "updated": updated}
+
+
+    def touch(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.modems.count,
+            self.lanes.count, self.campaigns.count,
+            self.header()["started"], time.time())
+
+
+    def slot(self, section, name):
+        """
+        Index of the slot of name in section, taking a free one the first
+        time. None when the section is full.
+        """
+
+        with self.lock:
+            names = self.names.setdefault(id(section), {})
+            if name not in names:
+                if len(names) >= section.count:
+                    return None
+                names[name] = len(names)
+            return names[name]
+
+
+    def modem(self, name):
+        """
+        ModemSlot for the worker of name.
+        """
+
+        return ModemSlot(self.modems, self.slot(self.modems, name), name)
+
+
+    def close(self):
+        self.mm.close()
+
+
+class ModemSlot(object):
+    def __init__(self, section, index, name):
+        """
+        The slot of one worker, only that worker thread writes it.
+        """
+
+        self.section = section
+        self.index = index
+        self.name = name
+        self.sent = 0
+        self.failed = 0
+
+
+    def publish(self, state, campaign=None):
+        if self.index is not None:
+            self.section.write(self.index, field(self.name), state,
+                field(campaign or ""), self.sent, self.failed, time.time())
+
+
+class Publisher(Thread):
+    def __init__(self, board, scheduler, interval=INTERVAL):
+        """
+        Copies the scheduler lane and campaign counters to the board every
+        interval seconds.
+        """
+
+        Thread.__init__(self, name="statusboard")
+        self.daemon = True
+        self.board = board
+        self.scheduler = scheduler
+        self.interval = interval
+
+
+    def run(self):
+        while True:
+            self.publish()
+            time.sleep(self.interval)
+
+
+    def publish(self):
+        board = self.board
+        for lane, report in self.scheduler.report().items():
+            index = board.slot(board.lanes, lane)
+            if index is not None:
+                board.lanes.write(index, field(lane, 16), report["queued"],
+                    report["sent"], report["failed"], report["p99"])
+
+        # Unfinished campaigns first, the rest only while there is room
+        campaigns = sorted(self.scheduler.campaigns.items(), key=lambda item:
+            (item[1][0] == item[1][1] + item[1][2], item[0]))
+        section = board.campaigns
+        for index in xrange(section.count):
+            if index < len(campaigns):
+                name, (total, sent, failed) = campaigns[index]
+                section.write(index, field(name), total, sent, failed)
+            else:
+                section.write(index, "", 0, 0, 0)
+        board.touch()
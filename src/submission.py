@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from client import SOCKET, CHUNK
+from debug import debug
+from idempotency import IdempotencyIndex
+from spool import Spool, QUEUED, DISPATCHED
+from timerwheel import release_time
+import SocketServer
+import profiler
+import json
+import optparse
+import os
+import time
+
+"""
+    Local submission service.
+
+    Listens on a Unix socket and speaks NDJSON, one request per line:
+
+        {"destination": "3874980340", "text": "hola", "lane": "otp"}
+            -> {"id": 12}
+        {"destination": "3874980340", "text": "oferta", "campaign": "promo"}
+            -> {"id": 13}
+        {"destination": "3874980340", "text": "hola", "key": "order-81"}
+            -> {"id": 15}, and {"id": 15, "duplicate": true} when repeated
+        {"destination": "3874980340", "text": "oferta", "at": 1700000000,
+            "window": "09:00-21:00", "offset": -180}
+            -> {"id": 14}
+        {"op": "status", "id": 12}
+            -> {"id": 12, "status": "sent"}
+        {"op": "profile", "seconds": 30}
+            -> {"path": "/tmp/smsd-812-1700000000.folded", ...}
+        {"op": "dump", "modem": "/dev/ttyUSB0"}
+            -> {"paths": {"/dev/ttyUSB0": "/tmp/flight-...jsonl"}}
+
+    Every message line read in the same chunk is written to the spool with a
+    single fsync and then acknowledged, so clients pushing batches pay one
+    disk sync per chunk instead of one per message.
+
+    at (epoch seconds) defers the send, window ("HH:MM-HH:MM", in the time
+    of offset minutes east of UTC or the server's) keeps it out of quiet
+    hours, see timerwheel.
+
+    key makes the submission idempotent: resubmitting the same key returns
+    the first id and queues nothing, see idempotency.
+"""
+
+SPOOL = "spool.ndjson"
+INDEX = "idempotency.idx"
+
+
+class Handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        buffer = ""
+        while True:
+            data = self.request.recv(CHUNK)
+            if not data:
+                break
+
+            lines = (buffer + data).split("\n")
+            buffer = lines.pop()
+            replies = self.server.process([line for line in lines if line])
+            self.request.sendall("".join(json.dumps(reply) + "\n"
+                for reply in replies))
+
+        if buffer.strip():
+            replies = self.server.process([buffer])
+            self.request.sendall("".join(json.dumps(reply) + "\n"
+                for reply in replies))
+
+
+class Submission(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, spool, scheduler=None, path=SOCKET, index=None):
+        """
+        Serve submissions on the Unix socket path, storing them in spool and
+        handing them to scheduler once durable. index is the
+        IdempotencyIndex of the keys, kept in memory only by default.
+        """
+
+        self.spool = spool
+        self.scheduler = scheduler
+        self.index = IdempotencyIndex() if index is None else index
+        self.restore_keys(spool)
+        self.operations = {"status": self.op_status, "profile":
+            self.op_profile, "dump": self.op_dump}
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+
+
+    def restore_keys(self, spool):
+        """
+        Index the keys spooled but not indexed when the last process died,
+        from the time they were submitted. Keys of messages not sent yet are
+        kept a full ttl whatever their age.
+        """
+
+        now = time.time()
+        oldest = now - self.index.ttl
+        entries = []
+        for key, (id, created) in spool.keys.iteritems():
+            if self.index.get(key) is not None:
+                continue
+            if created is None or created <= oldest:
+                if spool.status.get(id) not in (QUEUED, DISPATCHED):
+                    continue
+                created = now
+            entries.append((key, id, created))
+        self.index.restore(entries)
+        spool.keys = {}
+
+
+    def process(self, lines):
+        """
+        Parse and apply a chunk of request lines, returns one reply per line.
+        """
+
+        replies = [None] * len(lines)
+        records = []
+        for index, line in enumerate(lines):
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("Requests are json objects")
+                if "op" in request:
+                    replies[index] = self.operations[request["op"]](request)
+                elif request.get("destination") and "text" in request:
+                    lane = request.get("lane")
+                    if lane is not None and self.scheduler is not None and (
+                        lane not in self.scheduler.lanes):
+                        raise ValueError("Unknown lane: %s" % lane)
+                    at = request.get("at")
+                    request["at"] = release_time(None if at is None else
+                        float(at), request.get("window"),
+                        request.get("offset"))
+                    records.append((index, request))
+                else:
+                    replies[index] = {"error": "destination and text needed"}
+            except (ValueError, KeyError, TypeError), error:
+                replies[index] = {"error": "%s: %s" % (type(error).__name__,
+                    error)}
+
+        if records:
+            messages = self.queue(records, replies)
+            if self.scheduler is not None:
+                for message in messages:
+                    self.scheduler.put(message)
+
+        return replies
+
+
+    def queue(self, records, replies):
+        """
+        Spool the (index, request) records whose key was not seen yet and
+        fill their replies, returns the new Messages.
+        """
+
+        with self.index.lock:
+            fresh, repeated, first = [], [], {}
+            for index, request in records:
+                key = request.get("key")
+                id = None if key is None else self.index.get(key)
+                if id is not None:
+                    replies[index] = {"id": id, "duplicate": True}
+                elif key is not None and key in first:
+                    repeated.append((index, first[key]))
+                else:
+                    if key is not None:
+                        first[key] = index
+                    fresh.append((index, request))
+
+            messages = self.spool.append(request for index, request
+                in fresh) if fresh else []
+            for (index, request), message in zip(fresh, messages):
+                replies[index] = {"id": message.id}
+            for index, original in repeated:
+                replies[index] = {"id": replies[original]["id"],
+                    "duplicate": True}
+            self.index.record((message.key, message.id) for message
+                in messages if message.key is not None)
+        return messages
+
+
+    def op_status(self, request):
+        id = request["id"]
+        return {"id": id, "status": self.spool.status.get(id, "unknown")}
+
+
+    def op_profile(self, request):
+        """
+        Sample every thread for request["seconds"], or stop the sampling
+        in progress with request["stop"].
+        """
+
+        if request.get("stop"):
+            sampler = profiler.stop()
+        else:
+            sampler = profiler.start(float(request.get("seconds",
+                profiler.WINDOW)))
+        if sampler is None:
+            return {"error": "not profiling"}
+        return {"path": sampler.path, "seconds": sampler.window, "running":
+            sampler.running or sampler.is_alive()}
+
+
+    def op_dump(self, request):
+        """
+        Write the flight recorder of request["modem"], or of every modem.
+        """
+
+        workers = {}
+        if self.scheduler is not None:
+            workers = self.scheduler.workers
+        names = [request["modem"]] if request.get("modem") else workers.keys()
+        return {"paths": dict((name, workers[name].dump("request"))
+            for name in names if name in workers)}
+
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def get_options():
+    # Instance the parser and define the usage message
+    optparser = optparse.OptionParser(usage="""
+    %prog [-s socket] [-p spool] [-i index]
+    """, version="%prog .1")
+
+    # Define the options and the actions of each one
+    optparser.add_option("-s", "--socket", dest="socket",
+        help="Unix socket to listen on")
+    optparser.add_option("-p", "--spool", dest="spool",
+        help="Spool journal path")
+    optparser.add_option("-i", "--index", dest="index",
+        help="Idempotency keys index path")
+
+    # Define the default options
+    optparser.set_defaults(socket=SOCKET, spool=SPOOL, index=INDEX)
+
+    # Process the options
+    return optparser.parse_args()
+
+
+def main(options, args):
+    server = Submission(Spool(options.spool), path=options.socket,
+        index=IdempotencyIndex(options.index))
+    debug("Listening on %s" % options.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    options, args = get_options()
+    exit(main(options, args))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from debug import debug
+from gnokii import parse_fields
+import re
+import time
+
+"""
+    Radio telemetry of the modems and the dispatch weight derived from it.
+
+    Workers read "gnokii --monitor once" between sends, every SAMPLE_EVERY
+    seconds while idle or SAMPLE_MAX seconds at most when busy, like the
+    inbox polls: the gnokii shell serves one command at a time, so sampling
+    from another thread would only queue behind a sendsms. The last reading
+    is cached and turned into a weight in [MIN_WEIGHT, 1]:
+
+        * not registered to a network: MIN_WEIGHT
+        * signal at or above GOOD_SIGNAL: 1, weaker: proportionally less
+        * on battery below LOW_BATTERY percent: halved
+
+    Readings older than STALE seconds, or a modem that does not report a
+    value, count as full weight. The scheduler uses the weights to let weak
+    modems leave the queued work to stronger idle ones (Scheduler.weigh).
+"""
+
+SAMPLE_EVERY = 120.
+SAMPLE_MAX = 600.
+STALE = 1800.
+GOOD_SIGNAL = .5
+LOW_BATTERY = 20
+MIN_WEIGHT = .1
+NUMBER_RE = re.compile(r"-?\d+")
+CSQ_MAX = 31
+CSQ_UNKNOWN = 99
+
+
+def number(value):
+    match = NUMBER_RE.search(value or "")
+    return int(match.group()) if match else None
+
+
+def parse_monitor(output):
+    """
+    Signal (0 to 1), battery (percent), power source, network and whether
+    it is registered, from the output of monitor. Values the phone does not
+    report are None.
+    """
+
+    fields = dict((key.lower(), value) for key, value
+        in parse_fields(output).iteritems())
+
+    level = fields.get("rflevel")
+    signal = number(level)
+    if signal is None or signal < 0 or signal == CSQ_UNKNOWN:
+        signal = None
+    elif "%" in level or signal > CSQ_MAX:
+        signal = min(signal, 100) / 100.
+    else:
+        # AT modems report the +CSQ value, 0 to 31
+        signal = signal / float(CSQ_MAX)
+
+    network = fields.get("network")
+    registered = None
+    if network is not None:
+        registered = bool(network.strip()) and network.strip().lower() not in (
+            "unknown", "none", "no network")
+
+    return {
+        "signal": signal,
+        "battery": number(fields.get("battery")),
+        "power": fields.get("power source"),
+        "network": network,
+        "registered": registered,
+    }
+
+
+def weight(reading):
+    """
+    Dispatch weight of a parse_monitor reading, see the module docstring.
+    """
+
+    if reading is None:
+        return 1.
+    if reading["registered"] is False:
+        return MIN_WEIGHT
+
+    value = 1.
+    if reading["signal"] is not None:
+        value = min(1., reading["signal"] / GOOD_SIGNAL)
+    power = (reading["power"] or "").lower()
+    if reading["battery"] is not None and reading["battery"] < LOW_BATTERY \
+        and "battery" in power:
+        value /= 2
+    return max(MIN_WEIGHT, value)
+
+
+class Telemetry(object):
+    def __init__(self, name, every=SAMPLE_EVERY, most=SAMPLE_MAX,
+        stale=STALE):
+        """
+        Cached readings of one modem.
+
+        :every: seconds between samples while idle.
+        :most: seconds between samples at most while busy.
+        :stale: age after which a reading is no longer trusted.
+        """
+
+        self.name = name
+        self.every = every
+        self.most = most
+        self.stale = stale
+        self.reading = None
+        self.sampled = 0.
+        self.updated = 0.
+
+
+    def due(self, idle):
+        elapsed = time.time() - self.sampled
+        return elapsed >= (self.every if idle else self.most)
+
+
+    def sample(self, gnokii):
+        """
+        Read the modem through gnokii, returns the new weight. A failed read
+        keeps the previous reading.
+        """
+
+        self.sampled = time.time()
+        try:
+            self.reading = parse_monitor(gnokii.monitor())
+            self.updated = self.sampled
+        except (IOError, OSError), error:
+            debug("Telemetry of %s: %s" % (self.name, error))
+        return self.weight()
+
+
+    def weight(self):
+        if self.reading is None or time.time() - self.updated > self.stale:
+            return 1.
+        return weight(self.reading)
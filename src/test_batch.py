@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from batch import MessageBatch, Feeder, QUEUED, DISPATCHED, SENT, FAILED
+from batch import pack_number, unpack_number
+from scheduler import Scheduler
+import time
+import unittest
+
+"""
+    Column storage of big campaigns and the feeder windowing it into the
+    scheduler, without workers.
+"""
+
+TIMEOUT = 5.
+SENT_RESULT = "Send succeeded with reference 1!"
+
+
+class MessageBatchTest(unittest.TestCase):
+    def test_pack_number(self):
+        self.assertEqual(unpack_number(pack_number("0038749803")),
+            "0038749803")
+        self.assertRaises(ValueError, pack_number, "+5493874980340")
+        self.assertRaises(ValueError, pack_number, "1" * 19)
+
+
+    def test_rows(self):
+        batch = MessageBatch(["Hola %s, debes %s"], campaign="cobranza")
+        batch.append("3874980340", 0, ("Ana", "$10"))
+        batch.extend([("3874980341", ("Juan", "$20"))])
+        greeting = batch.add_template("Hola")
+        batch.append("03874980342", greeting)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.text(1), "Hola Juan, debes $20")
+        self.assertEqual(batch.number(2), "03874980342")
+        self.assertEqual(batch.variables(2), ())
+        self.assertEqual(batch.text(2), "Hola")
+
+
+    def test_status(self):
+        batch = MessageBatch(["hola"])
+        batch.extend(("387498%04d" % number, ()) for number in xrange(10))
+        batch.mark(slice(0, 4), DISPATCHED)
+        batch.mark([8], FAILED)
+        self.assertEqual(batch.find(), 4)
+        self.assertEqual(list(batch.rows(DISPATCHED)), [0, 1, 2, 3])
+        self.assertEqual(list(batch.rows(QUEUED, 5, 9)), [5, 6, 7])
+        batch.replace(DISPATCHED, QUEUED, 2)
+        self.assertEqual(batch.counts(), {QUEUED: 7, DISPATCHED: 2, SENT: 0,
+            FAILED: 1})
+
+
+    def test_message_done(self):
+        batch = MessageBatch(["hola %s"], lane="bulk", campaign="promo")
+        batch.append("3874980340", 0, ("Ana",))
+        batch.append("3874980341", 0, ("Juan",))
+        scheduler = Scheduler()
+        for row in xrange(2):
+            scheduler.put(batch.message(row))
+        message = scheduler.get(timeout=0)
+        self.assertEqual(message.campaign, "promo")
+        scheduler.done(message, SENT_RESULT)
+        message = scheduler.get(timeout=0)
+        message.attempts = scheduler.policy.attempts
+        scheduler.done(message, error=IOError("busy"))
+        self.assertEqual(batch.counts()[SENT], 1)
+        self.assertEqual(batch.counts()[FAILED], 1)
+
+
+class FeederTest(unittest.TestCase):
+    def test_window(self):
+        scheduler = Scheduler()
+        batch = MessageBatch(["hola"], lane="bulk")
+        batch.extend(("387498%04d" % number, ()) for number in xrange(25))
+        feeder = Feeder(scheduler, batch, window=10, poll=.01)
+        feeder.start()
+
+        sent = 0
+        deadline = time.time() + TIMEOUT
+        while sent < 25 and time.time() < deadline:
+            self.assertTrue(len(scheduler.queues["bulk"]) <= 10)
+            message = scheduler.get(timeout=.1)
+            if message:
+                scheduler.done(message, SENT_RESULT)
+                sent += 1
+        feeder.join(TIMEOUT)
+        self.assertFalse(feeder.is_alive())
+        self.assertEqual(batch.count(SENT), 25)
+
+
+    def test_stop(self):
+        scheduler = Scheduler()
+        batch = MessageBatch(["hola"], lane="bulk")
+        batch.extend(("387498%04d" % number, ()) for number in xrange(25))
+        feeder = Feeder(scheduler, batch, window=10, poll=.01)
+        feeder.start()
+        feeder.stop()
+        feeder.join(TIMEOUT)
+        self.assertFalse(feeder.is_alive())
+        self.assertTrue(batch.count(QUEUED) >= 15)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+import decoradores
+import unittest
+
+"""
+    Helpers of decoradores.
+"""
+
+
+class MonotonicTest(unittest.TestCase):
+    def setUp(self):
+        self.lookup = decoradores._get_clock_gettime
+        self.lookups = 0
+
+        def lookup():
+            self.lookups += 1
+            return self.lookup()
+
+        decoradores._clock = None
+        decoradores._get_clock_gettime = lookup
+
+
+    def tearDown(self):
+        decoradores._get_clock_gettime = self.lookup
+
+
+    def test_looked_up_once(self):
+        monotonic = decoradores.monotonic
+        values = [monotonic() for count in xrange(100)]
+        self.assertEqual(self.lookups, 1)
+        self.assertEqual(values, sorted(values))
+        self.assertTrue(decoradores.monotonic is monotonic)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from fairqueue import FairQueue, QUANTUM, load_shares
+from scheduler import Message
+import os
+import shutil
+import tempfile
+import unittest
+
+"""
+    Deficit round robin sharing between campaigns.
+"""
+
+
+def messages(campaign, count):
+    return [Message(number, "3874980340", "hola", "bulk", campaign=campaign)
+        for number in xrange(count)]
+
+
+class FairQueueTest(unittest.TestCase):
+    def take(self, queue, count, worker=None):
+        taken = []
+        for number in xrange(count):
+            message = queue.take(worker)
+            taken.append(message.campaign if message else None)
+        return taken
+
+
+    def test_weights(self):
+        queue = FairQueue({"big": 3, "small": 1})
+        for message in messages("big", 100) + messages("small", 100):
+            queue.append(message)
+        taken = self.take(queue, 8 * QUANTUM)
+        self.assertEqual(taken.count("big"), 6 * QUANTUM)
+        self.assertEqual(taken.count("small"), 2 * QUANTUM)
+        self.assertEqual(len(queue), 200 - 8 * QUANTUM)
+
+
+    def test_idle_campaign_share(self):
+        queue = FairQueue({"big": 3})
+        for message in messages("big", 2) + messages(None, 20):
+            queue.append(message)
+        taken = self.take(queue, 22)
+        self.assertEqual(taken.count("big"), 2)
+        self.assertEqual(taken[2:], [None] * 20)
+        self.assertEqual(queue.take(), None)
+        self.assertEqual(len(queue), 0)
+
+
+    def test_fifo_within_campaign(self):
+        queue = FairQueue()
+        for message in messages("promo", 5):
+            queue.append(message)
+        queue.appendleft(Message(99, "3874980340", "retry", "bulk",
+            campaign="promo"))
+        self.assertEqual([queue.take().id for number in xrange(6)], [99, 0, 1,
+            2, 3, 4])
+
+
+    def test_excluded(self):
+        queue = FairQueue()
+        first, second = messages("promo", 2)
+        first.excluded = set(["modem0"])
+        queue.append(first)
+        queue.append(second)
+        self.assertTrue(queue.take("modem0") is second)
+        self.assertTrue(queue.take("modem0") is None)
+        self.assertTrue(queue.take("modem1") is first)
+
+
+    def test_load_shares(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for name, config in (("promo", "[campaign]\nweight = 3\n"),
+                ("tiny", "[campaign]\nweight = 0\n"), ("plain", "[other]\n"),
+                ("broken", "[campaign]\nweight = many\n")):
+                os.mkdir(os.path.join(directory, name))
+                with open(os.path.join(directory, name, "config.ini"),
+                    "w") as file:
+                    file.write(config)
+            self.assertEqual(load_shares(directory), {"promo": 3.,
+                "tiny": 1. / QUANTUM})
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
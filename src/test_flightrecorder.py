@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from flightrecorder import FlightRecorder, COMMAND, OUTPUT, EVENT, load
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+"""
+    Flight recorder ring and dumps.
+"""
+
+
+class FlightRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_entries(self):
+        recorder = FlightRecorder("modem", directory=self.directory)
+        recorder.record(COMMAND, "--identify\n")
+        recorder.record(OUTPUT, "IMEI : 355849033413395\n")
+        self.assertEqual([(kind, data) for created, kind, data
+            in recorder.entries()], [(COMMAND, "--identify\n"), (OUTPUT,
+            "IMEI : 355849033413395\n")])
+
+
+    def test_unicode(self):
+        recorder = FlightRecorder("modem", directory=self.directory)
+        recorder.record(COMMAND, u"--sendsms 3874980340\nañoranza €\x03")
+        self.assertEqual(recorder.entries()[0][2],
+            u"--sendsms 3874980340\nañoranza €\x03".encode("utf-8"))
+
+
+    def test_wraps(self):
+        recorder = FlightRecorder("modem", capacity=16, entries=4,
+            directory=self.directory)
+        for number in xrange(6):
+            recorder.record(OUTPUT, "%05d\n" % number)
+        self.assertEqual([data for created, kind, data
+            in recorder.entries()], ["00004\n", "00005\n"])
+
+
+    def test_dump(self):
+        recorder = FlightRecorder("/dev/ttyUSB0", directory=self.directory)
+        recorder.record(COMMAND, u"--sendsms ñ")
+        records = load(recorder.dump("test"))
+        self.assertEqual([record["kind"] for record in records], ["command",
+            "event"])
+        self.assertEqual(records[1]["data"], "dump: test")
+
+
+    def test_keep(self):
+        recorder = FlightRecorder("/dev/ttyUSB0", keep=3,
+            directory=self.directory)
+        other = FlightRecorder("/dev/ttyUSB1", directory=self.directory)
+        other.dump("timeout")
+        paths = []
+        for number in xrange(5):
+            paths.append(recorder.dump("timeout"))
+            time.sleep(.002)
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual(len(names), 4)
+        self.assertEqual([os.path.join(self.directory, name) for name in names
+            if name.startswith("flight-dev.ttyUSB0-")], paths[-3:])
+
+
+    def test_explicit_path_kept(self):
+        recorder = FlightRecorder("modem", keep=1, directory=self.directory)
+        recorder.dump(path=os.path.join(self.directory, "saved.jsonl"))
+        recorder.dump()
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
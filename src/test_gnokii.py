@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from gnokii import Gnokii, GnokiiTimeout, Pipeline, dispatch
+from gnokii import parse_fields, parse_smsc
+from threading import Thread
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+"""
+    Gnokii shell driver against a fake shell that echoes the commands.
+"""
+
+SHELL = r'''
+import os, sys, time
+sys.stdout.write("gnokii> ")
+sys.stdout.flush()
+buffer = ""
+while True:
+    while "\n" not in buffer:
+        data = os.read(0, 4096)
+        if not data:
+            sys.exit(0)
+        buffer += data
+    line, buffer = buffer.split("\n", 1)
+    if line.startswith("--sendsms"):
+        while "\x03" not in buffer:
+            buffer += os.read(0, 4096)
+        text, buffer = buffer.split("\x03", 1)
+        sys.stdout.write("%s\nSend succeeded with reference %d!\n" % (line,
+            len(text.strip().decode("utf-8"))))
+    elif line.startswith("--getmms"):
+        path = [word for word in line.split() if word.startswith("/")][0]
+        with open(path, "w") as file:
+            for number in range(3):
+                file.write("chunk %d\n" % number)
+                file.flush()
+                time.sleep(.05)
+        sys.stdout.write("%s\ndone\n" % line)
+    elif line.startswith("--stall"):
+        time.sleep(float(line.split()[1]))
+        sys.stdout.write("%s\nlate\n" % line)
+    else:
+        sys.stdout.write("%s\nok %s\n" % (line, line))
+    sys.stdout.write("gnokii> ")
+    sys.stdout.flush()
+'''
+
+
+class GnokiiTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "gnokii.py")
+        with open(path, "w") as file:
+            file.write(SHELL)
+        self.gnokii = Gnokii(executable=[sys.executable, path])
+        self.gnokii.recorder.directory = self.directory
+        self.gnokii.start()
+
+
+    def tearDown(self):
+        self.gnokii.stop()
+        shutil.rmtree(self.directory)
+
+
+    def test_send(self):
+        self.assertEqual(self.gnokii.send("--identify", "\n").strip(),
+            "ok --identify")
+
+
+    def test_timeout_resync(self):
+        pid = self.gnokii._proc.pid
+        start = time.time()
+        self.assertRaises(GnokiiTimeout, self.gnokii.send, "--stall", .3,
+            "\n", timeout=.1)
+        self.assertTrue(time.time() - start < .3)
+        # The late answer is drained, same shell
+        self.assertEqual(self.gnokii.send("--identify", "\n").strip(),
+            "ok --identify")
+        self.assertEqual(self.gnokii._proc.pid, pid)
+
+
+    def test_timeout_restart(self):
+        pid = self.gnokii._proc.pid
+        self.assertRaises(GnokiiTimeout, self.gnokii.send, "--stall", 5,
+            "\n", timeout=.1)
+        # Still stalled after the drain, the shell is restarted
+        self.assertEqual(self.gnokii.send("--identify", "\n").strip(),
+            "ok --identify")
+        self.assertNotEqual(self.gnokii._proc.pid, pid)
+
+
+    def test_sendsms_unicode(self):
+        result = self.gnokii.sendsms(u"añoranza €", "3874980340")
+        self.assertIn("reference 10!", result)
+        self.assertTrue(self.gnokii.is_alive())
+
+
+    def test_stream(self):
+        self.assertEqual(self.gnokii.getmms("MM", 1),
+            "chunk 0\nchunk 1\nchunk 2\n")
+
+
+    def test_stream_failed_command(self):
+        self.gnokii.stop()
+        result = []
+
+        def read():
+            try:
+                self.gnokii.getmms("MM", 1)
+            except IOError, error:
+                result.append(error)
+
+        thread = Thread(target=read)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(result), 1)
+
+
+    def test_parse_fields(self):
+        self.assertEqual(parse_fields("IMEI : 355849033413395\nModel: E1756"),
+            {"IMEI": "355849033413395", "Model": "E1756"})
+
+
+    def test_parse_smsc(self):
+        output = ("gnokii> 1;Personal;;Text;72h;0;+543894990000;0;\n"
+            "2;Spare;;Text;72h;0;;0;\n")
+        self.assertEqual(parse_smsc(output), [{"location": 1, "name":
+            "Personal", "number": "+543894990000"}])
+
+
+class FailingGnokii(object):
+    def command(self, name, *args):
+        if name == "boom":
+            raise ValueError("bad argument")
+        return "ok %s" % name
+
+
+class PipelineTest(unittest.TestCase):
+    def test_error_keeps_running(self):
+        records = []
+        pipeline = Pipeline("modem", FailingGnokii(), records.append)
+        pipeline.start()
+        for lineno, words in enumerate((["boom"], ["identify"]), 1):
+            pipeline.queue.put((lineno, words))
+        pipeline.queue.put(None)
+        pipeline.join(5)
+        self.assertFalse(pipeline.is_alive())
+        self.assertEqual([(record["line"], record.get("result"),
+            record.get("error")) for record in records], [(1, None,
+            "ValueError: bad argument"), (2, "ok identify", None)])
+
+
+    def test_dispatch(self):
+        records = []
+        pipelines = {"ttyUSB0": Pipeline("ttyUSB0", FailingGnokii(),
+            records.append)}
+        dispatch(['identify\n', 'sendsms "unbalanced\n', '@ttyUSB9 reset\n',
+            '# comment\n', '@ttyUSB0 monitor\n'], pipelines, records.append)
+        queue = pipelines["ttyUSB0"].queue
+        self.assertEqual([queue.get_nowait() for count in xrange(2)],
+            [(1, ["identify"]), (5, ["monitor"])])
+        self.assertTrue(queue.empty())
+        self.assertEqual([(record["modem"], record["line"]) for record
+            in records], [(None, 2), ("ttyUSB9", 3)])
+        self.assertTrue(records[0]["error"].startswith("ValueError"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from idempotency import IdempotencyIndex, digest
+from spool import Spool
+from submission import Submission
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+"""
+    Idempotency keys across restarts of the index and of the spool.
+"""
+
+TTL = 3600.
+
+
+class IdempotencyIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "idempotency.idx")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_record(self):
+        index = IdempotencyIndex(ttl=TTL)
+        index.record([("order-81", 12), (u"pedido-ñ", 13)])
+        self.assertEqual(index.get("order-81"), 12)
+        self.assertEqual(index.get(u"pedido-ñ"), 13)
+        self.assertEqual(index.get("order-82"), None)
+
+
+    def test_ttl_across_restart(self):
+        now = time.time()
+        with open(self.path, "w") as file:
+            file.write("%x %d %d\n" % (digest("old"), 1, now - 2 * TTL))
+            file.write("%x %d %d\n" % (digest("recent"), 2, now - TTL / 2))
+
+        index = IdempotencyIndex(self.path, ttl=TTL)
+        self.assertEqual(index.get("old"), None)
+        self.assertEqual(index.get("recent"), 2)
+        index.record([("new", 3)])
+        index.close()
+
+        index = IdempotencyIndex(self.path, ttl=TTL)
+        self.assertEqual((index.get("old"), index.get("recent"),
+            index.get("new")), (None, 2, 3))
+        # Expires at its first submission time plus the ttl
+        index.expire(now + TTL / 2 + index.span + 1)
+        self.assertEqual((index.get("recent"), index.get("new")), (None, 3))
+        index.close()
+
+
+    def test_compact_keeps_creation_time(self):
+        now = time.time()
+        # Both in the same generation
+        live = ["%x %d %d\n" % (digest("first"), 1, now - TTL / 2),
+            "%x %d %d\n" % (digest("second"), 2, now - TTL / 2 + 10)]
+        with open(self.path, "w") as file:
+            file.writelines(live)
+            file.writelines("%x %d %d\n" % (digest(number), number,
+                now - 2 * TTL) for number in xrange(10))
+
+        index = IdempotencyIndex(self.path, ttl=TTL)
+        index.close()
+        with open(self.path) as file:
+            self.assertEqual(sorted(file), sorted(live))
+
+
+    def test_restore(self):
+        now = time.time()
+        index = IdempotencyIndex(self.path, ttl=TTL)
+        index.record([("new", 3)])
+        index.restore([("old", 1, now - 2 * TTL), ("recent", 2, now -
+            TTL / 2)])
+        self.assertEqual((index.get("old"), index.get("recent")), (None, 2))
+        index.expire(now + TTL / 2 + index.span + 1)
+        self.assertEqual((index.get("recent"), index.get("new")), (None, 3))
+        index.close()
+
+
+class SpoolKeysTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "spool.ndjson")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_reindex_from_spool(self):
+        now = time.time()
+        spool = Spool(self.path)
+        sent, pending, recent = spool.append([{"destination": "3874980340",
+            "text": "hola", "key": key} for key in ("sent", "pending",
+            "recent")])
+        sent.enqueued = pending.enqueued = now - 30 * 86400
+        recent.enqueued = now - TTL / 2
+        spool.close()
+        # Rewrite the journal as if written a month ago
+        with open(self.path, "w") as file:
+            file.writelines(spool.dumps(message) for message
+                in (sent, pending, recent))
+            file.write('{"id": %d, "status": "sent"}\n' % sent.id)
+
+        spool = Spool(self.path)
+        index = IdempotencyIndex(ttl=TTL)
+        server = Submission(spool, path=os.path.join(self.directory,
+            "smsd.sock"), index=index)
+        self.assertEqual(index.get("sent"), None)
+        self.assertEqual(index.get("pending"), pending.id)
+        self.assertEqual(index.get("recent"), recent.id)
+        index.expire(now + TTL / 2 + index.span + 1)
+        self.assertEqual((index.get("pending"), index.get("recent")),
+            (pending.id, None))
+        server.server_close()
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from inbound import Inbound, KeywordRouter, Rule, Suppression, load_rules
+from scheduler import Scheduler, Worker
+import os
+import shutil
+import tempfile
+import unittest
+
+"""
+    Keyword rules, their validation and routing.
+"""
+
+INBOX = """1. Inbox Message (Read)
+Date/time: 19/10/2026 10:00:00 -0300
+Sender: +5493875551234 Msg Center: +5493870001
+Text:
+hola
+
+2. Inbox Message (Read)
+Text:
+baja
+"""
+
+
+class FakeGnokii(object):
+    def __init__(self):
+        self.deleted = []
+
+
+    def getsms(self, memory_type, start, end):
+        return INBOX
+
+
+    def deletesms(self, memory_type, start, end):
+        self.deleted.append((start, end))
+
+
+class InboundTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rules = os.path.join(self.directory, "keywords.csv")
+        self.suppression = Suppression(os.path.join(self.directory,
+            "suppression.txt"))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def write_rules(self, rows):
+        with open(self.rules, "w") as file:
+            file.write(rows)
+        return load_rules(self.rules)
+
+
+    def test_match(self):
+        router = KeywordRouter(self.write_rules('"baja","suppress"\n'
+            '"info","reply","Horario 9 a 18"\n"stop","suppress","","yes"\n'))
+        self.assertEqual(router.match(u"Quiero la BAJA").action, "suppress")
+        self.assertEqual(router.match("informacion"), None)
+        self.assertEqual(router.match("info por favor").argument,
+            "Horario 9 a 18")
+        self.assertEqual(router.match("no stop"), None)
+        self.assertEqual(router.match("stop ya").keyword, "STOP")
+
+
+    def test_unknown_action(self):
+        rules = self.write_rules('"baja","suppress"\n"promo","forward"\n')
+        self.assertRaises(ValueError, KeywordRouter, rules)
+        self.assertRaises(ValueError, Inbound, rules, self.suppression)
+
+
+    def test_handle(self):
+        sent = []
+        inbound = Inbound([Rule(0, "baja", "suppress"), Rule(1, "info",
+            "reply", "Horario 9 a 18")], self.suppression,
+            lambda text, destination: sent.append((destination, text)))
+        inbound.handle({"text": "info", "sender": "+5493875551234"})
+        inbound.handle({"text": "baja", "sender": "+5493875551234"})
+        self.assertEqual(sent, [("+5493875551234", "Horario 9 a 18")])
+        self.assertTrue("+5493875551234" in self.suppression)
+        self.assertEqual(inbound.handled, {"reply": 1, "suppress": 1})
+
+
+    def test_no_sender(self):
+        sent = []
+        inbound = Inbound([Rule(0, "baja", "suppress"), Rule(1, "info",
+            "reply", "Horario 9 a 18")], self.suppression,
+            lambda text, destination: sent.append((destination, text)))
+        inbound.handle({"text": "baja"})
+        inbound.handle({"text": "info", "sender": ""})
+        self.assertEqual(sent, [])
+        self.assertEqual(inbound.handled, {"reply": 1, "suppress": 1})
+
+
+    def test_inbox_drained_without_rules(self):
+        inbound = Inbound([], self.suppression)
+        gnokii = FakeGnokii()
+        worker = Worker(Scheduler(inbound=inbound), "modem", gnokii)
+        worker.idle = True
+        worker.poll_inbox()
+        self.assertEqual(gnokii.deleted, [(1, 2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
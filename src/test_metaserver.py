@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from metaserver import Metaserver, sim_ready
+from threading import Event, Lock, Thread
+import unittest
+
+"""
+    Metaserver device bring up, without the device monitor loop.
+"""
+
+TIMEOUT = 5.
+
+
+class Preparing(Metaserver):
+    def __init__(self):
+        # Only the state prepare_device uses, __init__ runs the main loop
+        self.servers = {}
+        self.pending = set()
+        self.lock = Lock()
+        self.started = Event()
+        self.proceed = Event()
+        self.calls = 0
+
+
+    def _prepare_device(self, device_path, model, connection):
+        self.calls += 1
+        self.started.set()
+        self.proceed.wait(TIMEOUT)
+        return ("server", {"IMEI": "355849033413395"})
+
+
+class PrepareDeviceTest(unittest.TestCase):
+    def test_repeated_event(self):
+        server = Preparing()
+        results = []
+        thread = Thread(target=lambda: results.append(server.prepare_device(
+            "/dev/ttyUSB0", "AT")))
+        thread.start()
+        self.assertTrue(server.started.wait(TIMEOUT))
+        self.assertEqual(server.prepare_device("/dev/ttyUSB0", "AT"), None)
+        server.proceed.set()
+        thread.join(TIMEOUT)
+        self.assertEqual(server.calls, 1)
+        self.assertEqual(results, [("server", {"IMEI": "355849033413395"})])
+        # Still claimed until activated
+        self.assertEqual(server.pending, set(["/dev/ttyUSB0"]))
+
+
+    def test_failure_releases(self):
+        server = Preparing()
+        server.proceed.set()
+        server._prepare_device = lambda *args: None
+        self.assertEqual(server.prepare_device("/dev/ttyUSB0", "AT"), None)
+        self.assertEqual(server.pending, set())
+
+
+    def test_in_rotation(self):
+        server = Preparing()
+        server.servers["/dev/ttyUSB0"] = "server"
+        self.assertEqual(server.prepare_device("/dev/ttyUSB0", "AT"), None)
+        self.assertEqual(server.calls, 0)
+
+
+class SimReadyTest(unittest.TestCase):
+    def test_sim_ready(self):
+        self.assertTrue(sim_ready("Nothing to enter."))
+        self.assertFalse(sim_ready("Waiting for PIN."))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from mms import MMSParser
+import unittest
+
+"""
+    Incremental MMS PDU parsing, whatever the chunk boundaries.
+"""
+
+IMAGE = "".join(chr(value % 256) for value in xrange(300))
+MULTIPART = ("\x8c\x84"             # X-Mms-Message-Type: m-retrieve-conf
+    "\x84\xa3"                      # Content-Type: multipart.mixed
+    "\x02"                          # Two entries
+    "\x08\x04"                      # Headers and data lengths
+    "\x83\x8ea.txt\0"               # text/plain, Content-Location
+    "hola"
+    "\x01\x82\x2c"                  # One byte of headers, 300 of data
+    "\x9e" + IMAGE)                 # image/jpeg
+PARTS = [("text/plain", "a.txt", "hola"), ("image/jpeg", None, IMAGE)]
+
+
+def parse(pdu, size):
+    parser = MMSParser()
+    parts = []
+    for start in xrange(0, len(pdu), size):
+        parts.extend(parser.feed(pdu[start:start + size]))
+    return parts + parser.close()
+
+
+class MMSParserTest(unittest.TestCase):
+    def test_whole(self):
+        self.assertEqual(parse(MULTIPART, len(MULTIPART)), PARTS)
+
+
+    def test_chunk_splits(self):
+        for size in xrange(1, 40):
+            self.assertEqual(parse(MULTIPART, size), PARTS, size)
+
+
+    def test_parts_as_completed(self):
+        parser = MMSParser()
+        split = MULTIPART.index("hola") + 4
+        self.assertEqual(parser.feed(MULTIPART[:split]), PARTS[:1])
+        self.assertEqual(parser.feed(MULTIPART[split:-1]), [])
+        self.assertEqual(parser.feed(MULTIPART[-1:]), PARTS[1:])
+        self.assertEqual(parser.close(), [])
+
+
+    def test_single(self):
+        pdu = "\x8c\x84\x84\x83" + "x" * 1000
+        self.assertEqual(parse(pdu, 7), [("text/plain", None, "x" * 1000)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from quota import Quota, segments
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+"""
+    SMS segment counting and the per SIM quota counters.
+"""
+
+
+class SegmentsTest(unittest.TestCase):
+    def test_gsm_boundaries(self):
+        self.assertEqual(segments("a" * 160), 1)
+        self.assertEqual(segments("a" * 161), 2)
+        self.assertEqual(segments("a" * 306), 2)
+        self.assertEqual(segments("a" * 307), 3)
+
+
+    def test_extension_characters(self):
+        # Two septets each
+        self.assertEqual(segments("a" * 158 + "{"), 1)
+        self.assertEqual(segments("a" * 159 + "{"), 2)
+        self.assertEqual(segments(u"€" * 80), 1)
+        self.assertEqual(segments(u"€" * 81), 2)
+        self.assertEqual(segments("a" * 304 + "|"), 2)
+        self.assertEqual(segments("a" * 305 + "|"), 3)
+
+
+    def test_ucs2_boundaries(self):
+        self.assertEqual(segments(u"á" * 70), 1)
+        self.assertEqual(segments(u"á" * 71), 2)
+        self.assertEqual(segments(u"á" * 134), 2)
+        self.assertEqual(segments(u"á" * 135), 3)
+
+
+    def test_utf8_str(self):
+        self.assertEqual(segments(u"ñ€".encode("utf-8")), 1)
+
+
+class QuotaTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "quota.json")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_limits(self):
+        quota = Quota(daily=2, monthly=3)
+        quota.add("sim", 2)
+        self.assertFalse(quota.available("sim"))
+        self.assertTrue(quota.available("other"))
+
+
+    def test_flush_and_load(self):
+        quota = Quota(self.path, batch=10)
+        quota.add("sim", 3)
+        self.assertFalse(os.path.exists(self.path))
+        quota.flush()
+        self.assertEqual(json.load(open(self.path))["sim"][2:], [3, 3])
+        self.assertEqual(Quota(self.path).counter("sim").monthly, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
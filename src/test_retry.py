@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from retry import RetryPolicy, CircuitBreaker, SendError
+from retry import OK, TRANSIENT, PERMANENT, CLOSED, OPEN, HALF_OPEN
+from scheduler import Scheduler, Message
+import time
+import unittest
+
+"""
+    Retry policy, circuit breaker and redelivery of failed sends.
+"""
+
+
+class Identify(object):
+    def __init__(self, answer):
+        self.answer = answer
+
+
+    def identify(self):
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_classify(self):
+        policy = RetryPolicy()
+        self.assertEqual(policy.classify("Send succeeded with reference 3!"),
+            OK)
+        self.assertEqual(policy.classify("Invalid phone number"), PERMANENT)
+        self.assertEqual(policy.classify("SMS Send failed (Command timed "
+            "out)"), TRANSIENT)
+        self.assertEqual(policy.classify(None), TRANSIENT)
+        self.assertEqual(policy.classify(error=IOError("busy")), TRANSIENT)
+        self.assertEqual(policy.classify(error=SendError("bad", PERMANENT)),
+            PERMANENT)
+        self.assertEqual(policy.classify(error=ValueError("bug")), PERMANENT)
+
+
+    def test_delay(self):
+        policy = RetryPolicy(base=1., cap=10.)
+        for attempt in xrange(1, 8):
+            bound = min(10., 2. ** attempt)
+            delays = [policy.delay(attempt) for count in xrange(200)]
+            self.assertTrue(all(0 <= delay <= bound for delay in delays))
+        self.assertTrue(max(policy.delay(6) for count in xrange(200)) > 5)
+
+
+    def test_should_retry(self):
+        policy = RetryPolicy(attempts=3)
+        message = Message(1, "3874980340", "hola", "bulk")
+        for attempts, kind, expected in ((1, TRANSIENT, True), (2, TRANSIENT,
+            True), (3, TRANSIENT, False), (1, PERMANENT, False), (1, OK,
+            False)):
+            message.attempts = attempts
+            self.assertEqual(policy.should_retry(message, kind), expected)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_transitions(self):
+        trips = []
+        breaker = CircuitBreaker("modem", threshold=2, cooldown=.05,
+            max_cooldown=.15, on_trip=lambda: trips.append(breaker.state))
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual((breaker.state, breaker.allow(), trips), (OPEN, False,
+            [OPEN]))
+        self.assertTrue(0 < breaker.remaining() <= .05)
+
+        time.sleep(.06)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state, HALF_OPEN)
+        # A failed probe opens it again for twice as long
+        self.assertFalse(breaker.probe(Identify(IOError("dead"))))
+        self.assertEqual((breaker.state, breaker.cooldown), (OPEN, .1))
+        breaker.opened -= .1
+        breaker.allow()
+        self.assertFalse(breaker.probe(Identify("no answer")))
+        self.assertEqual(breaker.cooldown, .15)
+
+        breaker.opened -= .15
+        breaker.allow()
+        self.assertTrue(breaker.probe(Identify("IMEI : 355849033413395")))
+        self.assertEqual((breaker.state, breaker.cooldown, breaker.failures),
+            (CLOSED, .05, 0))
+        self.assertTrue(breaker.allow())
+        self.assertEqual(len(trips), 3)
+
+
+    def test_success_resets_count(self):
+        breaker = CircuitBreaker("modem", threshold=2)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.state, CLOSED)
+
+
+class RedeliveryTest(unittest.TestCase):
+    def test_redelivered_after_delay(self):
+        done = []
+        scheduler = Scheduler(policy=RetryPolicy(attempts=2, base=.01,
+            cap=.02), on_done=lambda message, result, error: done.append(
+            (message.id, error)))
+        scheduler.workers = {"modem0": None, "modem1": None}
+        scheduler.submit("3874980340", "hola")
+
+        message = scheduler.get(timeout=0, worker="modem0")
+        self.assertEqual(scheduler.done(message, "SMS Send failed",
+            worker="modem0"), TRANSIENT)
+        self.assertEqual(len(scheduler), 1)
+        # Held in the delay heap, and not for the modem it failed on
+        self.assertEqual(scheduler.get(timeout=.1, worker="modem0"), None)
+        again = scheduler.get(timeout=1, worker="modem1")
+        self.assertTrue(again is message)
+        self.assertEqual(again.attempts, 2)
+
+        # Out of attempts, given up
+        scheduler.done(again, "SMS Send failed", worker="modem1")
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(done[0][0], message.id)
+        self.assertTrue(isinstance(done[0][1], SendError))
+
+
+    def test_permanent_not_retried(self):
+        done = []
+        scheduler = Scheduler(on_done=lambda message, result, error:
+            done.append(message))
+        message = scheduler.submit("3874980340", "hola")
+        scheduler.done(scheduler.get(timeout=0), "Invalid phone number")
+        self.assertEqual((len(scheduler), done), (0, [message]))
+
+
+if __name__ == "__main__":
+    unittest.main()
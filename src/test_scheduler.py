@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from scheduler import Scheduler, Message
+import unittest
+
+"""
+    Lane priorities of the scheduler, without workers.
+"""
+
+
+class SchedulerTest(unittest.TestCase):
+    def fill(self, scheduler, lane, count):
+        for number in xrange(count):
+            scheduler.submit("387498%04d" % number, "hola", lane)
+
+
+    def lanes(self, scheduler, count, lanes=None):
+        return [scheduler.get(lanes, timeout=0).lane for number
+            in xrange(count)]
+
+
+    def test_priority(self):
+        scheduler = Scheduler(bulk_every=100)
+        self.fill(scheduler, "bulk", 2)
+        self.fill(scheduler, "otp", 2)
+        self.assertEqual(self.lanes(scheduler, 4), ["otp", "otp", "bulk",
+            "bulk"])
+        self.assertEqual(scheduler.get(timeout=0), None)
+
+
+    def test_bulk_every(self):
+        scheduler = Scheduler(bulk_every=2)
+        self.fill(scheduler, "bulk", 2)
+        self.fill(scheduler, "otp", 6)
+        self.assertEqual(self.lanes(scheduler, 4), ["otp", "otp", "bulk",
+            "otp"])
+
+
+    def test_reserved_pops_keep_streak(self):
+        scheduler = Scheduler(bulk_every=2)
+        self.fill(scheduler, "bulk", 2)
+        self.fill(scheduler, "otp", 8)
+        lanes = []
+        for number in xrange(3):
+            lanes.extend(self.lanes(scheduler, 1))
+            # A reserved worker takes otp in between
+            self.assertEqual(self.lanes(scheduler, 1, ["otp"]), ["otp"])
+        self.assertEqual(lanes, ["otp", "otp", "bulk"])
+
+
+    def test_finished_campaign_pruned(self):
+        scheduler = Scheduler()
+        for number in xrange(2):
+            scheduler.put(Message(number, "3874980340", "hola", "bulk",
+                campaign="promo"))
+        scheduler.finish(scheduler.get(timeout=0))
+        self.assertEqual(scheduler.campaigns, {"promo": [2, 1, 0]})
+        scheduler.finish(scheduler.get(timeout=0), error=IOError("busy"))
+        self.assertEqual(scheduler.campaigns, {})
+
+
+    def test_on_retry(self):
+        retried = []
+        scheduler = Scheduler(on_retry=retried.append)
+        keyed = Message(1, "3874980340", "hola", "bulk", key="order-81")
+        plain = Message(2, "3874980340", "hola", "bulk")
+        for message in (keyed, plain):
+            scheduler.put(message)
+            message = scheduler.get(timeout=0)
+            scheduler.done(message, error=IOError("busy"))
+        self.assertEqual(retried, [keyed])
+        self.assertEqual(len(scheduler.delayed), 2)
+
+
+    def test_unknown_lane(self):
+        scheduler = Scheduler()
+        self.assertRaises(ValueError, scheduler.put, Message(1, "3874980340",
+            "hola", "vip"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from subprocess import Popen, PIPE
+from threading import Event, Thread
+import os
+import sender
+import shutil
+import sys
+import tempfile
+import unittest
+
+"""
+    python-gammu backend: deferred import and the StateMachine pool, on a
+    fake gammu module.
+"""
+
+TIMEOUT = 5.
+
+
+class FakeGammu(object):
+    class GSMError(Exception):
+        pass
+
+
+    class StateMachine(object):
+        inits = []
+        slow = {}
+
+        def SetConfig(self, section, config):
+            self.device = config["Device"]
+
+
+        def Init(self):
+            self.inits.append(self.device)
+            if self.device in self.slow:
+                self.slow[self.device].wait(TIMEOUT)
+
+
+        def Terminate(self):
+            pass
+
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, "gammu.py"), "w") as file:
+            file.write("class GSMError(Exception):\n    pass\n")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_deferred(self):
+        script = ("import sender, sys\n"
+            "print 'gammu' in sys.modules\n"
+            "sender.Gammu('modem.conf')\n"
+            "print 'gammu' in sys.modules\n")
+        path = os.pathsep.join((self.directory, os.path.dirname(
+            os.path.abspath(sender.__file__))))
+        output = Popen([sys.executable, "-c", script], stdout=PIPE,
+            env=dict(os.environ, PYTHONPATH=path)).communicate()[0]
+        self.assertEqual(output.split(), ["False", "True"])
+
+
+class StateMachinePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.gammu = sender.gammu
+        sender.gammu = FakeGammu
+        FakeGammu.StateMachine.inits = []
+        FakeGammu.StateMachine.slow = {}
+
+
+    def tearDown(self):
+        sender.gammu = self.gammu
+
+
+    def test_acquire_once(self):
+        pool = sender.StateMachinePool()
+        entry = pool.acquire("/dev/ttyUSB0", "at19200")
+        self.assertTrue(pool.acquire("/dev/ttyUSB0", "at19200") is entry)
+        self.assertTrue("/dev/ttyUSB0" in pool)
+        self.assertEqual(FakeGammu.StateMachine.inits, ["/dev/ttyUSB0"])
+        pool.release("/dev/ttyUSB0")
+        self.assertFalse("/dev/ttyUSB0" in pool)
+
+
+    def test_init_outside_lock(self):
+        pool = sender.StateMachinePool()
+        slow = FakeGammu.StateMachine.slow["/dev/ttyUSB0"] = Event()
+        entries = []
+        threads = [Thread(target=lambda: entries.append(pool.acquire(
+            "/dev/ttyUSB0", "at19200"))) for count in xrange(2)]
+        for thread in threads:
+            thread.start()
+
+        # Another device connects while the first one is in Init
+        pool.acquire("/dev/ttyUSB1", "at19200")
+        self.assertTrue("/dev/ttyUSB1" in pool)
+        self.assertFalse("/dev/ttyUSB0" in pool)
+        slow.set()
+        for thread in threads:
+            thread.join(TIMEOUT)
+        self.assertTrue(entries[0] is entries[1])
+        self.assertEqual(FakeGammu.StateMachine.inits.count("/dev/ttyUSB0"),
+            1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from simulator import Simulator, parse_mix
+import unittest
+
+"""
+    Capacity simulator runs and fleet sizing.
+"""
+
+
+class SimulatorTest(unittest.TestCase):
+    def test_run(self):
+        report = Simulator([10.], modems=2, seed=1).run(10, deadline=30)
+        self.assertEqual((report["segments"], report["sends"], report["eta"],
+            report["by_deadline"]), (10, 10, 50., 6))
+
+
+    def test_parse_mix(self):
+        self.assertEqual(parse_mix("1:3,2:1"), ([.75, 1.], [1, 2]))
+
+
+    def test_modems_for(self):
+        simulator = Simulator([10.], modems=1, seed=1)
+        self.assertEqual(simulator.modems_for(100, 100.), 10)
+        self.assertEqual(simulator.modems_for(5, 100.), 1)
+
+
+    def test_deadline_shorter_than_a_send(self):
+        simulator = Simulator([10., 20.], seed=1)
+        self.assertRaises(ValueError, simulator.modems_for, 100, 5.)
+
+
+    def test_unreachable_deadline(self):
+        # Some of the 50 sends take 20s, whatever the fleet
+        simulator = Simulator([10., 20.], modems=1, seed=1)
+        self.assertRaises(ValueError, simulator.modems_for, 50, 15.)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from smsc import SmscBalancer
+import time
+import unittest
+
+"""
+    Round robin of the message centers of a SIM and the benching of failing
+    ones.
+"""
+
+NUMBERS = ["+5493870001", "+5493870002", "+5493870003"]
+
+
+class SmscBalancerTest(unittest.TestCase):
+    def choices(self, balancer, count):
+        return [balancer.choose() for number in xrange(count)]
+
+
+    def test_single_center_uses_default(self):
+        self.assertEqual(SmscBalancer("modem", []).choose(), None)
+        self.assertEqual(SmscBalancer("modem", NUMBERS[:1]).choose(), None)
+
+
+    def test_even_distribution(self):
+        choices = self.choices(SmscBalancer("modem", NUMBERS), 300)
+        self.assertEqual([choices.count(number) for number in NUMBERS],
+            [100, 100, 100])
+        self.assertEqual(choices[:3], NUMBERS)
+
+
+    def test_benched_share_goes_to_others(self):
+        balancer = SmscBalancer("modem", NUMBERS, threshold=2, cooldown=60)
+        balancer.failure(NUMBERS[1])
+        self.assertTrue(NUMBERS[1] in self.choices(balancer, 3))
+        balancer.failure(NUMBERS[1])
+        choices = self.choices(balancer, 100)
+        self.assertFalse(NUMBERS[1] in choices)
+        self.assertEqual(choices.count(NUMBERS[0]), 50)
+
+
+    def test_success_resets_failures(self):
+        balancer = SmscBalancer("modem", NUMBERS, threshold=2, cooldown=60)
+        balancer.failure(NUMBERS[0])
+        balancer.success(NUMBERS[0])
+        balancer.failure(NUMBERS[0])
+        self.assertTrue(NUMBERS[0] in self.choices(balancer, 3))
+
+
+    def test_cooldown(self):
+        balancer = SmscBalancer("modem", NUMBERS[:2], threshold=1,
+            cooldown=.05)
+        balancer.failure(NUMBERS[0])
+        self.assertEqual(self.choices(balancer, 2), [NUMBERS[1]] * 2)
+        time.sleep(.06)
+        self.assertTrue(NUMBERS[0] in self.choices(balancer, 2))
+
+
+    def test_all_benched_soonest_back(self):
+        balancer = SmscBalancer("modem", NUMBERS[:2], threshold=1,
+            cooldown=60)
+        balancer.failure(NUMBERS[1])
+        balancer.failure(NUMBERS[0])
+        self.assertEqual(balancer.choose(), NUMBERS[1])
+
+
+    def test_unknown_number_ignored(self):
+        balancer = SmscBalancer("modem", NUMBERS, threshold=1)
+        balancer.failure("+5493879999")
+        balancer.success("+5493879999")
+        self.assertEqual(self.choices(balancer, 3), NUMBERS)
+
+
+if __name__ == "__main__":
+    unittest.main()
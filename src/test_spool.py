@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from spool import Spool, QUEUED, DISPATCHED, SENT, FAILED
+import os
+import shutil
+import tempfile
+import unittest
+
+"""
+    Spool journal replay and recovery across restarts.
+"""
+
+
+def records(count, **fields):
+    return [dict({"destination": "387498%04d" % number, "text": "hola %d" %
+        number}, **fields) for number in xrange(count)]
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "spool.ndjson")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def reopen(self, spool):
+        spool.close()
+        return Spool(self.path)
+
+
+    def test_recover_pending(self):
+        spool = Spool(self.path)
+        messages = spool.append(records(4, lane="otp", campaign="promo"))
+        spool.done(messages[0])
+        spool.done(messages[1], error=IOError("busy"))
+        spool.dispatched(messages[2])
+
+        spool = self.reopen(spool)
+        self.assertEqual(spool.status, {1: SENT, 2: FAILED, 3: DISPATCHED,
+            4: QUEUED})
+        recovered = spool.recover()
+        self.assertEqual([(message.id, message.text, message.lane,
+            message.campaign) for message in recovered], [(4, "hola 3", "otp",
+            "promo")])
+        self.assertEqual(spool.recover(), [])
+        spool.close()
+
+
+    def test_ids_continue(self):
+        spool = Spool(self.path)
+        spool.append(records(2))
+        spool = self.reopen(spool)
+        self.assertEqual([message.id for message in spool.append(records(1))],
+            [3])
+        spool.close()
+
+
+    def test_truncated_line(self):
+        spool = Spool(self.path)
+        spool.append(records(2))
+        spool.close()
+        with open(self.path, "a") as file:
+            file.write('{"id": 3, "destina')
+
+        spool = Spool(self.path)
+        self.assertEqual([message.id for message in spool.recover()], [1, 2])
+        spool.close()
+
+
+    def test_failed_recovery_is_final(self):
+        spool = Spool(self.path)
+        message, = spool.append(records(1, lane="vip"))
+        spool = self.reopen(spool)
+        recovered, = spool.recover()
+        spool.update(recovered.id, FAILED)
+        spool = self.reopen(spool)
+        self.assertEqual(spool.recover(), [])
+        spool.close()
+
+
+    def test_retried_message_recovered(self):
+        spool = Spool(self.path)
+        retried, lost = spool.append(records(2, key="k"))
+        for message in (retried, lost):
+            spool.dispatched(message)
+        spool.retrying(retried)
+        spool = self.reopen(spool)
+        self.assertEqual(spool.status, {1: QUEUED, 2: DISPATCHED})
+        recovered, = spool.recover()
+        self.assertEqual((recovered.id, recovered.text), (1, "hola 0"))
+        spool.close()
+
+
+    def test_compact(self):
+        spool = Spool(self.path, compact_every=3)
+        messages = spool.append(records(5, key="k"))
+        spool.dispatched(messages[3])
+        for message in messages[:2]:
+            spool.done(message)
+        self.assertEqual(len(spool.status), 5)
+        spool.done(messages[2], error=IOError("busy"))
+        self.assertEqual(spool.status, {4: DISPATCHED, 5: QUEUED})
+        with open(self.path) as file:
+            self.assertEqual(len(file.readlines()), 4)
+
+        spool.append(records(1))
+        spool = self.reopen(spool)
+        self.assertEqual(spool.status, {4: DISPATCHED, 5: QUEUED, 6: QUEUED})
+        self.assertEqual([message.id for message in spool.recover()], [5, 6])
+        spool.close()
+
+
+    def test_compact_on_open(self):
+        spool = Spool(self.path)
+        for message in spool.append(records(3)):
+            spool.done(message)
+        spool.close()
+
+        spool = Spool(self.path, compact_every=3)
+        self.assertEqual(spool.status, {})
+        self.assertEqual(spool.append(records(1))[0].id, 4)
+        spool.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
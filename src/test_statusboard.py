@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from statusboard import StatusBoard, Publisher, SENDING, field
+import os
+import shutil
+import tempfile
+import unittest
+
+"""
+    Status board slots, written by the metaserver and read by smsd top.
+"""
+
+
+class FakeScheduler(object):
+    def __init__(self, campaigns):
+        self.campaigns = campaigns
+
+
+    def report(self):
+        return {u"otp": {"queued": 1, "sent": 2, "failed": 0, "p99": .5}}
+
+
+class StatusBoardTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "status")
+        self.board = StatusBoard(self.path, create=True, modems=2, lanes=2,
+            campaigns=2)
+
+
+    def tearDown(self):
+        self.board.close()
+        shutil.rmtree(self.directory)
+
+
+    def test_field(self):
+        self.assertEqual(field(u"promo"), "promo")
+        self.assertEqual(field("/dev/serial/by-id/" + "x" * 40), "x" * 32)
+        self.assertEqual(field(u"ñ" * 20).decode("utf-8"), u"ñ" * 16)
+        # The cut half of the first ñ is dropped
+        self.assertEqual(field(u"ñ" * 17 + u"a").decode("utf-8"), u"ñ" * 15 +
+            u"a")
+
+
+    def test_modem_slot(self):
+        slot = self.board.modem(u"/dev/ttyUSB0")
+        slot.sent = 3
+        slot.publish(SENDING, u"campaña")
+        reader = StatusBoard(self.path)
+        name, state, campaign, sent, failed, updated = list(reader.modems)[0]
+        self.assertEqual((name, state, campaign.decode("utf-8"), sent),
+            ("/dev/ttyUSB0", SENDING, u"campaña", 3))
+        reader.close()
+
+
+    def test_publisher(self):
+        scheduler = FakeScheduler({u"promo": [3, 1, 1], u"año" * 20: [1, 1,
+            0]})
+        Publisher(self.board, scheduler).publish()
+        reader = StatusBoard(self.path)
+        self.assertEqual(list(reader.lanes), [("otp", 1, 2, 0, .5)])
+        self.assertEqual([(name, total) for name, total, sent, failed
+            in reader.campaigns], [("promo", 3), (field(u"año" * 20), 1)])
+        reader.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
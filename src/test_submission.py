@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from client import submit
+from scheduler import Scheduler
+from spool import Spool, SENT, FAILED
+from submission import Submission
+from threading import Event, Thread
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+"""
+    Submission service end to end: socket, spool, scheduler and a worker
+    sending through a fake gnokii.
+"""
+
+TIMEOUT = 5.
+
+
+class FakeGnokii(object):
+    def __init__(self):
+        self.sent = []
+        self.event = Event()
+
+
+    def sendsms(self, message, destination, **options):
+        if message == "boom":
+            raise ValueError("boom")
+        self.sent.append((destination, message))
+        self.event.set()
+        return "Send succeeded with reference 1!"
+
+
+    def monitor(self):
+        return ""
+
+
+class SubmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(os.path.join(self.directory, "spool.ndjson"))
+        self.scheduler = Scheduler(on_done=self.spool.done)
+        self.server = Submission(self.spool, self.scheduler,
+            os.path.join(self.directory, "smsd.sock"))
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for name in self.scheduler.workers.keys():
+            self.scheduler.remove_worker(name).join()
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+
+    def submit(self, *requests):
+        return submit(requests, self.server.server_address)
+
+
+    def test_idle_scheduler_dispatches(self):
+        gnokii = FakeGnokii()
+        self.scheduler.add_worker("modem", gnokii)
+        self.assertEqual(len(self.scheduler), 0)
+
+        replies = self.submit({"destination": "3874980340", "text": "hola"})
+        self.assertEqual(replies, [{"id": 1}])
+        self.assertTrue(gnokii.event.wait(TIMEOUT))
+        self.assertEqual(gnokii.sent, [("3874980340", "hola")])
+
+
+    def test_status(self):
+        gnokii = FakeGnokii()
+        self.scheduler.add_worker("modem", gnokii)
+        id = self.submit({"destination": "3874980340", "text": "hola"})[0][
+            "id"]
+        self.assertTrue(gnokii.event.wait(TIMEOUT))
+        for attempt in xrange(50):
+            status = self.submit({"op": "status", "id": id})[0]["status"]
+            if status == SENT:
+                break
+            time.sleep(.1)
+        self.assertEqual(status, SENT)
+
+
+    def test_error_fails_message(self):
+        gnokii = FakeGnokii()
+        worker = self.scheduler.add_worker("modem", gnokii)
+        replies = self.submit({"destination": "3874980340", "text": "boom"},
+            {"destination": "3874980340", "text": "hola"})
+        self.assertTrue(gnokii.event.wait(TIMEOUT))
+        self.assertEqual(gnokii.sent, [("3874980340", "hola")])
+        self.assertTrue(worker.is_alive())
+        self.assertEqual(self.spool.status[replies[0]["id"]], FAILED)
+
+
+    def test_unknown_lane(self):
+        replies = self.submit({"destination": "3874980340", "text": "hola",
+            "lane": "vip"})
+        self.assertIn("Unknown lane", replies[0]["error"])
+        self.assertEqual(self.spool.status, {})
+
+
+    def test_bad_at(self):
+        replies = self.submit({"destination": "3874980340", "text": "hola",
+            "at": "tomorrow"}, {"destination": "3874980340", "text": "hola",
+            "at": "4102444800"})
+        self.assertIn("error", replies[0])
+        self.assertEqual(replies[1], {"id": 1})
+        self.assertEqual(len(self.scheduler.timers), 1)
+
+
+    def test_not_an_object(self):
+        replies = self.server.process(['"abc"', '["destination"]', '{}',
+            'nojson'])
+        self.assertEqual(len(replies), 4)
+        self.assertTrue(all("error" in reply for reply in replies))
+
+
+    def test_missing_text(self):
+        replies = self.submit({"destination": "3874980340"})
+        self.assertIn("error", replies[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from scheduler import Scheduler
+from telemetry import Telemetry, parse_monitor, weight, MIN_WEIGHT
+import time
+import unittest
+
+"""
+    Parsing of gnokii --monitor, the dispatch weights derived from it and
+    their decay once the reading goes stale.
+"""
+
+GOOD = "RFLevel: 25\nBattery: 100 %\nPower Source: AC\nNetwork: 722 310\n"
+WEAK = "RFLevel: 20 %\nBattery: 10 %\nPower Source: battery\n" \
+    "Network: 722 310\n"
+UNREGISTERED = "RFLevel: 99\nNetwork: unknown\n"
+
+
+class FakeGnokii(object):
+    def __init__(self, *outputs):
+        self.outputs = list(outputs)
+
+
+    def monitor(self):
+        output = self.outputs.pop(0)
+        if isinstance(output, Exception):
+            raise output
+        return output
+
+
+class TelemetryTest(unittest.TestCase):
+    def test_parse_monitor(self):
+        reading = parse_monitor(GOOD)
+        self.assertAlmostEqual(reading["signal"], 25 / 31.)
+        self.assertEqual(reading["battery"], 100)
+        self.assertTrue(reading["registered"])
+        self.assertEqual(parse_monitor(WEAK)["signal"], .2)
+
+        reading = parse_monitor(UNREGISTERED)
+        self.assertEqual(reading["signal"], None)
+        self.assertFalse(reading["registered"])
+        self.assertEqual(parse_monitor(""), {"signal": None, "battery": None,
+            "power": None, "network": None, "registered": None})
+
+
+    def test_weight(self):
+        self.assertEqual(weight(None), 1.)
+        self.assertEqual(weight(parse_monitor(GOOD)), 1.)
+        self.assertEqual(weight(parse_monitor(UNREGISTERED)), MIN_WEIGHT)
+        self.assertEqual(weight(parse_monitor("")), 1.)
+        # .2 of signal is .4 of the good level, halved on low battery
+        self.assertAlmostEqual(weight(parse_monitor(WEAK)), .2)
+        self.assertEqual(weight(parse_monitor("RFLevel: 0\n")), MIN_WEIGHT)
+
+
+    def test_stale_reading_decays_to_full(self):
+        telemetry = Telemetry("modem", stale=.05)
+        self.assertEqual(telemetry.weight(), 1.)
+        self.assertAlmostEqual(telemetry.sample(FakeGnokii(WEAK)), .2)
+        time.sleep(.06)
+        self.assertEqual(telemetry.weight(), 1.)
+
+
+    def test_failed_sample_keeps_reading(self):
+        telemetry = Telemetry("modem", stale=60)
+        gnokii = FakeGnokii(UNREGISTERED, IOError("timeout"))
+        self.assertEqual(telemetry.sample(gnokii), MIN_WEIGHT)
+        self.assertEqual(telemetry.sample(gnokii), MIN_WEIGHT)
+
+
+    def test_due(self):
+        telemetry = Telemetry("modem", every=60, most=.05)
+        self.assertTrue(telemetry.due(True))
+        telemetry.sample(FakeGnokii(GOOD))
+        self.assertFalse(telemetry.due(True))
+        self.assertFalse(telemetry.due(False))
+        time.sleep(.06)
+        self.assertTrue(telemetry.due(False))
+
+
+    def test_weak_worker_defers(self):
+        scheduler = Scheduler()
+        scheduler.submit("3874980340", "hola", "bulk")
+        scheduler.weigh("weak", .2)
+        scheduler.waiting["strong"] = 1.
+        self.assertEqual(scheduler.get(timeout=.05, worker="weak"), None)
+        del scheduler.waiting["strong"]
+        self.assertNotEqual(scheduler.get(timeout=.05, worker="weak"), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
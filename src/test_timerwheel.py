@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from timerwheel import TimerWheel, Window, release_time, DAY
+import time
+import unittest
+
+"""
+    Timer wheel ticks, cascades and delivery windows.
+"""
+
+START = 1700000000
+
+
+class TimerWheelTest(unittest.TestCase):
+    def test_release_in_order(self):
+        wheel = TimerWheel(start=START)
+        for delay in (5, 1, 3):
+            wheel.add(START + delay, delay)
+        self.assertEqual(len(wheel), 3)
+        self.assertEqual(wheel.advance(START + 2), [1])
+        self.assertEqual(wheel.advance(START + 6), [3, 5])
+        self.assertEqual(len(wheel), 0)
+
+
+    def test_past_is_due_now(self):
+        wheel = TimerWheel(start=START)
+        wheel.add(START - 60, "late")
+        self.assertEqual(wheel.advance(START + 1), ["late"])
+
+
+    def test_cascade(self):
+        # Small wheels, the last one goes through the overflow heap
+        wheel = TimerWheel(slots=8, levels=2, start=START)
+        delays = (8 + 7, 8 ** 2 + 3, 8 ** 3 + 11)
+        for delay in delays:
+            wheel.add(START + delay, delay)
+        released = []
+        for delay in delays:
+            self.assertEqual(wheel.advance(START + delay), released)
+            released = wheel.advance(START + delay + 1)
+            self.assertEqual(released, [delay])
+            released = []
+
+
+class WindowTest(unittest.TestCase):
+    def test_inside(self):
+        window = Window.parse("09:00-21:00", 0)
+        noon = START - START % DAY + 12 * 3600
+        self.assertEqual(window.next(noon), noon)
+
+
+    def test_next_opening(self):
+        window = Window.parse("09:00-21:00", 0)
+        midnight = START - START % DAY
+        self.assertEqual(window.next(midnight + 22 * 3600), midnight + DAY +
+            9 * 3600)
+
+
+    def test_across_midnight(self):
+        window = Window.parse("22:00-06:00", -180)
+        midnight = START - START % DAY
+        # 02:00 at UTC-3
+        self.assertEqual(window.next(midnight + 5 * 3600), midnight +
+            5 * 3600)
+
+
+    def test_release_time(self):
+        self.assertEqual(release_time(), None)
+        self.assertEqual(release_time(time.time() - 60), None)
+        later = time.time() + 3600
+        self.assertEqual(release_time(later), later)
+
+
+    def test_release_time_spread(self):
+        now = time.time()
+        window = "%02d:00-%02d:00" % ((time.gmtime(now).tm_hour + 2) % 24,
+            (time.gmtime(now).tm_hour + 3) % 24)
+        at = release_time(now, window, 0, spread=60)
+        opening = Window.parse(window, 0).next(now)
+        self.assertTrue(opening <= at <= opening + 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
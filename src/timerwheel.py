@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+#-*- coding: UTF-8 -*-
+
+from collections import deque
+from debug import debug
+from threading import Lock, Thread
+import heapq
+import itertools
+import random
+import time
+
+"""
+    Deferred sends.
+
+    Messages with a future send time wait in a hierarchical timer wheel:
+    LEVELS wheels of SLOTS slots, level n slots spanning SLOTS ** n ticks.
+    Adding is O(1), and each tick only touches the slot that expires plus,
+    every SLOTS ticks, one slot of the upper level that cascades down. Times
+    beyond the wheels go to an overflow heap.
+
+    Delivery windows (quiet hours) are resolved when a message is submitted.
+    Messages pushed to a window opening get a random delay of up to SPREAD
+    seconds, and the Releaser hands at most BURST messages per tick to the
+    scheduler, so a window opening doesn't dump everything at once.
+
+    The send time is written to the spool with the message, so scheduled
+    messages survive a restart and go back into the wheel when recovered.
+"""
+
+TICK = 1.
+SLOTS = 256
+LEVELS = 3
+SPREAD = 300.
+BURST = 200
+DAY = 86400
+
+
+class TimerWheel(object):
+    def __init__(self, tick=TICK, slots=SLOTS, levels=LEVELS, start=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[[] for slot in xrange(slots)] for level
+            in xrange(levels)]
+        self.overflow = []
+        self.current = int((time.time() if start is None else start) / tick)
+        self.size = 0
+        self.lock = Lock()
+        self._ids = itertools.count()
+
+
+    def __len__(self):
+        return self.size
+
+
+    def add(self, when, item):
+        """
+        Schedule item for the time when, in seconds since the epoch.
+        """
+
+        with self.lock:
+            self._add(int(when / self.tick), item)
+            self.size += 1
+
+
+    def _add(self, due, item):
+        due = max(due, self.current)
+        span = 1
+        for level in xrange(self.levels):
+            # The lowest level whose slot still lies in this turn of the
+            # level above
+            if due // (span * self.slots) == self.current // (span *
+                self.slots):
+                self.wheels[level][due // span % self.slots].append((due,
+                    item))
+                return
+            span *= self.slots
+        heapq.heappush(self.overflow, (due, self._ids.next(), item))
+
+
+    def advance(self, now=None):
+        """
+        Process the ticks finished by now, returns the released items.
+        """
+
+        target = int((time.time() if now is None else now) / self.tick)
+        released = []
+        with self.lock:
+            if not self.size:
+                self.current = max(self.current, target)
+                return released
+
+            while self.current < target:
+                if not self.current % self.slots:
+                    self._cascade()
+                slot = self.wheels[0][self.current % self.slots]
+                if slot:
+                    released.extend(item for due, item in slot)
+                    del slot[:]
+                self.current += 1
+
+            self.size -= len(released)
+        return released
+
+
+    def _cascade(self):
+        span = self.slots ** self.levels
+        while self.overflow and self.overflow[0][0] // span == (
+            self.current // span):
+            due, id, item = heapq.heappop(self.overflow)
+            self._add(due, item)
+
+        for level in xrange(self.levels - 1, 0, -1):
+            span = self.slots ** level
+            if not self.current % span:
+                slot = self.wheels[level][self.current // span % self.slots]
+                items = slot[:]
+                del slot[:]
+                for due, item in items:
+                    self._add(due, item)
+
+
+class Window(object):
+    def __init__(self, start, end, offset=None):
+        """
+        Daily delivery window from start to end, "HH:MM", possibly across
+        midnight.
+
+        :offset: minutes east of UTC of the recipients, None for the local
+            time of the server.
+        """
+
+        self.start = self.seconds(start)
+        self.end = self.seconds(end)
+        self.offset = offset
+
+
+    @staticmethod
+    def seconds(clock):
+        hours, minutes = clock.split(":")
+        return int(hours) * 3600 + int(minutes) * 60
+
+
+    @classmethod
+    def parse(cls, window, offset=None):
+        """
+        Window from "HH:MM-HH:MM".
+        """
+
+        start, end = window.split("-")
+        return cls(start.strip(), end.strip(), offset)
+
+
+    def inside(self, second):
+        if self.start <= self.end:
+            return self.start <= second < self.end
+        return second >= self.start or second < self.end
+
+
+    def next(self, when):
+        """
+        when if it falls in the window, otherwise the next opening.
+        """
+
+        if self.offset is None:
+            local = time.localtime(when)
+            second = local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+        else:
+            second = int(when + self.offset * 60) % DAY
+        if self.inside(second):
+            return when
+        return when + (self.start - second) % DAY
+
+
+def release_time(at=None, window=None, offset=None, spread=SPREAD):
+    """
+    Send time for a message asked for at (None for now) within window
+    ("HH:MM-HH:MM"). Returns None when it can go right away.
+    """
+
+    now = time.time()
+    at = max(at or now, now)
+    if window:
+        opening = Window.parse(window, offset).next(at)
+        if opening > at:
+            at = opening + random.uniform(0, spread)
+    return at if at > now else None
+
+
+class Releaser(Thread):
+    def __init__(self, wheel, release, tick=TICK, burst=BURST):
+        """
+        Advances wheel every tick and calls release(item) for the due items,
+        at most burst per tick, the rest wait for the next tick.
+        """
+
+        Thread.__init__(self, name="releaser")
+        self.daemon = True
+        self.wheel = wheel
+        self.release = release
+        self.tick = tick
+        self.burst = burst
+        self.backlog = deque()
+
+
+    def run(self):
+        while True:
+            time.sleep(self.tick)
+            self.backlog.extend(self.wheel.advance())
+            for count in xrange(min(self.burst, len(self.backlog))):
+                self.release(self.backlog.popleft())
+            if self.backlog:
+                debug("Releaser: %d due items wait for the next tick" %
+                    len(self.backlog))